@@ -1,96 +1,426 @@
+import logging
 import numpy as np
-import pydub
-import wave
 import os
+import time
+from lib.AudioPipeline import AudioPipeline
+from lib.AudioWriter import AudioWriter
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+
+def _decode_pcm(raw: bytes, sample_width: int) -> np.ndarray:
+    """Decode little-endian PCM bytes into signed integer samples."""
+    if sample_width == 1:
+        # 8-bit WAV is unsigned, shift it to signed like pydub does
+        return (np.frombuffer(raw, dtype=np.uint8) ^ 0x80).view(np.int8)
+    if sample_width == 3:
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        data = np.zeros((len(packed), 4), dtype=np.uint8)
+        data[:, 1:] = packed
+        return data.view('<i4').reshape(-1) >> 8
+    return np.frombuffer(raw, dtype={2: '<i2', 4: '<i4'}[sample_width])
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Largest RIFF chunk size, a data chunk of this size runs to the end of the file
+_MAX_CHUNK_SIZE = 0xFFFFFFFF
+
+
+def _read_wav_header(file_path: str) -> dict:
+    """Parse the RIFF chunks of a WAV file and locate its data chunk."""
+    with open(file_path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"Not a RIFF/WAVE file: {file_path}")
+        file_size = os.fstat(f.fileno()).st_size
+        info = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_id = header[:4]
+            chunk_size = int.from_bytes(header[4:], 'little')
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                format_tag = int.from_bytes(fmt[0:2], 'little')
+                if format_tag == _WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    format_tag = int.from_bytes(fmt[24:26], 'little')
+                info = {
+                    'format_tag': format_tag,
+                    'channels': int.from_bytes(fmt[2:4], 'little'),
+                    'sample_rate': int.from_bytes(fmt[4:8], 'little'),
+                    'sample_width': int.from_bytes(fmt[14:16], 'little') // 8,
+                }
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if info is None:
+                    raise ValueError(f"WAV data chunk before fmt chunk: {file_path}")
+                offset = f.tell()
+                # streaming writers leave the size empty or too large, and a data chunk
+                # over 4 GiB keeps the largest 32-bit size (see AudioWriter)
+                if chunk_size in (0, _MAX_CHUNK_SIZE) or offset + chunk_size > file_size:
+                    chunk_size = file_size - offset
+                info['data_offset'] = offset
+                info['data_size'] = chunk_size
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if info is None or 'data_offset' not in info:
+        raise ValueError(f"WAV file without fmt/data chunk: {file_path}")
+    supported = (info['format_tag'] == _WAVE_FORMAT_PCM and info['sample_width'] in (1, 2, 3, 4)) or \
+                (info['format_tag'] == _WAVE_FORMAT_IEEE_FLOAT and info['sample_width'] == 4)
+    if not supported:
+        raise ValueError(f"Unsupported WAV format (tag: {info['format_tag']}, "
+                         f"{info['sample_width'] * 8}bit): {file_path}")
+    return info
+
+
+def _map_wav_samples(file_path: str, info: dict) -> np.ndarray:
+    """Memory-map the data chunk as a flat array of interleaved samples."""
+    if info['format_tag'] == _WAVE_FORMAT_IEEE_FLOAT:
+        dtype = np.dtype('<f4')
+    else:
+        dtype = np.dtype({1: 'u1', 2: '<i2', 3: 'u1', 4: '<i4'}[info['sample_width']])
+    frame_bytes = info['sample_width'] * info['channels']
+    n_items = (info['data_size'] // frame_bytes) * frame_bytes // dtype.itemsize
+    if n_items == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=info['data_offset'], shape=(n_items,))
+
+
+def _to_signed(samples: np.ndarray, info: dict) -> np.ndarray:
+    """Convert mapped samples to signed values; 16/32-bit and float data are returned as is."""
+    if info['format_tag'] == _WAVE_FORMAT_PCM and info['sample_width'] in (1, 3):
+        return _decode_pcm(samples, info['sample_width'])
+    return samples
+
+def _decode_samples(raw: bytes, info: dict) -> np.ndarray:
+    """Decode bytes read from a WAV data chunk (or a raw stream described like one)."""
+    if info['format_tag'] == _WAVE_FORMAT_IEEE_FLOAT:
+        return np.frombuffer(raw, dtype='<f4')
+    return _decode_pcm(raw, info['sample_width'])
+
+
+_LAYOUTS = ('interleaved', 'planar')
 
 class AudioData:
+    """
+    Audio samples with their format.
+    Samples are stored as one (frames, channels) array in one of two memory layouts:
+    'interleaved' (frame after frame, like a WAV data chunk; memory-mapped files stay a view)
+    or 'planar' (channel after channel, so every channel is contiguous).
+    Channel views and float working copies are created on first use and cached
+    until the samples are replaced.
+    """
+    __slots__ = ('_frames', '_layout', 'sample_rate', 'sample_width', 'channels',
+                 '_pipeline', '_channel_views', '_float_frames')
+
     # default 3.072M = 48K/4bytes/2ch
-    def __init__(self, data: np.ndarray, sample_rate: int, sample_width: int = 4, channels: int = 2):
-        self.data = data
+    def __init__(self, data: np.ndarray, sample_rate: int, sample_width: int = 4, channels: int = 2,
+                 layout: str = 'interleaved'):
+        """
+        :param data: Interleaved samples, or a (frames, channels) array.
+        :param layout: 'interleaved' or 'planar' storage.
+        """
+        if layout not in _LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}, expected one of {_LAYOUTS}")
         self.sample_rate = sample_rate
         self.sample_width = sample_width
         self.channels = channels
+        self._layout = layout
+        self.frames = data
+        # pending apply steps while in deferred mode (see defer)
+        self._pipeline = None
+
+    @property
+    def frames(self):
+        """(frames, channels) array of the samples in the storage layout."""
+        return self._frames
+
+    @frames.setter
+    def frames(self, data: np.ndarray):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape(-1, self.channels)
+        elif data.ndim != 2 or data.shape[1] != self.channels:
+            raise ValueError(f"Expected (frames, {self.channels}) samples, got shape {data.shape}")
+        # planar storage is the transposed (channels, frames) array, i.e. Fortran order
+        self._frames = np.asfortranarray(data) if self._layout == 'planar' else np.ascontiguousarray(data)
+        self._channel_views = {}
+        # float copies by dtype, and single channels by (dtype, channel)
+        self._float_frames = {}
+
+    @property
+    def data(self):
+        """Interleaved samples; a view for the interleaved layout, a copy for the planar one."""
+        return self._frames.reshape(-1)
+
+    @data.setter
+    def data(self, data: np.ndarray):
+        self.frames = data
+
+    @property
+    def layout(self):
+        return self._layout
+
+    def to_layout(self, layout: str):
+        """
+        Change the storage layout (copies the samples once if it differs).
+        :return: self
+        """
+        if layout not in _LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout}, expected one of {_LAYOUTS}")
+        if layout != self._layout:
+            self._layout = layout
+            self.frames = self._frames
+        return self
+
+    @property
+    def dtype(self):
+        return self._frames.dtype
+
+    @property
+    def n_frames(self):
+        return len(self._frames)
+
+    def channel(self, ch: int):
+        """Cached view of one channel (contiguous for the planar layout, never a copy)."""
+        view = self._channel_views.get(ch)
+        if view is None:
+            if not -self.channels <= ch < self.channels:
+                raise IndexError(f"channel {ch} out of range for {self.channels} channels")
+            view = self._channel_views[ch] = self._frames[:, ch]
+        return view
+
+    def float_frames(self, dtype=np.float32):
+        """
+        Float (frames, channels) working copy, converted once per dtype and cached.
+        It is planar whatever the storage layout, so its channels are contiguous.
+        In-place changes to `frames` are not reflected, assign `frames` instead.
+        """
+        dtype = np.dtype(dtype)
+        work = self._float_frames.get(dtype)
+        if work is None:
+            work = self._float_frames[dtype] = self._frames.astype(dtype, order='F')
+        return work
+
+    def float_channel(self, ch: int, dtype=np.float32):
+        """
+        Contiguous float copy of one channel, converted once per dtype and cached.
+        It is a column of the float_frames() copy when that exists, otherwise only this
+        channel is converted.
+        """
+        dtype = np.dtype(dtype)
+        work = self._float_frames.get(dtype)
+        if work is not None:
+            return work[:, ch]
+        view = self.channel(ch)
+        key = (dtype, ch % self.channels)
+        column = self._float_frames.get(key)
+        if column is None:
+            column = self._float_frames[key] = view.astype(dtype)
+        return column
 
     @classmethod
     def from_file(cls, file_path: str):
-        print(f"Load from: {file_path}")
-        audio_segment = pydub.AudioSegment.from_file(file_path)
-        # to do bit conversion
-        data = np.array(audio_segment.get_array_of_samples())
+        logger.info(f"Load from: {file_path}")
+        with Instrument.span('load', path=file_path) as span:
+            try:
+                audio = cls.from_wav(file_path)
+            except ValueError:
+                # compressed or non-PCM formats go through ffmpeg
+                import pydub
+                audio_segment = pydub.AudioSegment.from_file(file_path)
+                # to do bit conversion
+                data = np.array(audio_segment.get_array_of_samples())
+                audio = cls(
+                    data=data,
+                    sample_rate=audio_segment.frame_rate,
+                    sample_width=audio_segment.sample_width,
+                    channels=audio_segment.channels
+                )
+            span.set(nbytes=audio.frames.nbytes)
+        return audio
+
+    @classmethod
+    def from_wav(cls, file_path: str):
+        """
+        Load a PCM (8/16/24/32-bit int) or 32-bit float WAV file by memory-mapping its data chunk.
+        16/32-bit int and float data stay a read-only view of the file (no copy);
+        8-bit and 24-bit data are converted to signed int8/int32.
+        :return: AudioData, raises ValueError if the file is not a supported WAV file.
+        """
+        info = _read_wav_header(file_path)
+        samples = _map_wav_samples(file_path, info)
         return cls(
-            data=data,
-            sample_rate=audio_segment.frame_rate,
-            sample_width=audio_segment.sample_width,
-            channels=audio_segment.channels
+            data=_to_signed(samples, info),
+            sample_rate=info['sample_rate'],
+            sample_width=info['sample_width'],
+            channels=info['channels']
         )
 
+    @classmethod
+    def iter_file(cls, file_path: str, block_frames: int, start_frame: int = 0):
+        """
+        Read a PCM WAV file block by block without loading it into memory.
+        :param block_frames: Number of frames per yielded block.
+        :param start_frame: Frame to start reading from.
+        :return: Generator of AudioData blocks (the last one may be shorter).
+        """
+        info = _read_wav_header(file_path)
+        samples = _map_wav_samples(file_path, info)
+        # 24-bit data is mapped as bytes, so a frame may span more than `channels` items
+        items_per_frame = info['sample_width'] * info['channels'] // samples.itemsize
+        n_frames = len(samples) // items_per_frame
+        for pos in range(min(start_frame, n_frames), n_frames, block_frames):
+            block = samples[pos * items_per_frame:min(pos + block_frames, n_frames) * items_per_frame]
+            yield cls(
+                data=_to_signed(block, info),
+                sample_rate=info['sample_rate'],
+                sample_width=info['sample_width'],
+                channels=info['channels']
+            )
+
+    @classmethod
+    def iter_stream(cls, stream, sample_rate: int, sample_width: int, channels: int, block_frames: int):
+        """
+        Read raw interleaved little-endian PCM from a binary stream (e.g. a pipe) block by block.
+        :return: Generator of AudioData blocks, ending at the end of the stream.
+        """
+        info = {'format_tag': _WAVE_FORMAT_PCM, 'sample_width': sample_width}
+        frame_bytes = sample_width * channels
+        pending = b''
+        while True:
+            raw = stream.read(block_frames * frame_bytes - len(pending))
+            if not raw:
+                break
+            pending += raw
+            # pipes return short reads, keep the partial frame for the next block
+            n_bytes = len(pending) // frame_bytes * frame_bytes
+            if n_bytes:
+                yield cls(_decode_samples(pending[:n_bytes], info), sample_rate, sample_width, channels)
+                pending = pending[n_bytes:]
+
+    @classmethod
+    def follow_file(cls, file_path: str, block_frames: int, poll_sec: float = 0.2, idle_sec: float = 5.0):
+        """
+        Read a WAV file that is still being written, like `tail -f`.
+        New complete frames are yielded as soon as they are on disk (at most `block_frames` per block).
+        :param poll_sec: Interval between checks for new data.
+        :param idle_sec: Stop when the file has not grown (or not appeared) for this long.
+        :return: Generator of AudioData blocks.
+        """
+        pos = 0
+        last_growth = time.monotonic()
+        while True:
+            try:
+                # parsed again every poll: streaming writers fix the chunk sizes when they finish
+                info = _read_wav_header(file_path)
+            except (OSError, ValueError):
+                info = None
+            n_frames = 0
+            if info is not None:
+                frame_bytes = info['sample_width'] * info['channels']
+                n_frames = (info['data_size'] - pos) // frame_bytes
+            if n_frames <= 0:
+                if time.monotonic() - last_growth > idle_sec:
+                    return
+                time.sleep(poll_sec)
+                continue
+            with open(file_path, 'rb') as f:
+                f.seek(info['data_offset'] + pos)
+                raw = f.read(n_frames * frame_bytes)
+            n_frames = len(raw) // frame_bytes
+            pos += n_frames * frame_bytes
+            last_growth = time.monotonic()
+            for start in range(0, n_frames, block_frames):
+                block = raw[start * frame_bytes:min(start + block_frames, n_frames) * frame_bytes]
+                yield cls(_decode_samples(block, info), info['sample_rate'], info['sample_width'], info['channels'])
+
     @classmethod
     def from_sine(cls, duration: float, freq: float = 1000, amp: float = -1,
                   rate: int = 48000, width: int = 4, channels: int = 2):
-        print(f"Make sine wave: {rate}, {channels}ch, amp: {amp}, freq: {freq}Hz, {duration}s")
-        t = np.linspace(0., duration, int(rate * duration), endpoint=False)
-        nptype = [np.int8, np.int16, np.int32, np.int32][width-1]
-        if(amp < 0):
-            amp = np.iinfo(nptype).max * 0.9
-        mono_sine = (amp * np.sin(2. * np.pi * freq * t)).astype(nptype)
-        multi_sine = np.tile(mono_sine.reshape(-1, 1), (1, channels))
-        data = multi_sine.flatten()
-        return cls(data=data, sample_rate=rate, sample_width=width, channels=channels)
+        from lib.Stimulus import Stimulus
+        return Stimulus.generate('sine', duration, amp=amp, rate=rate, width=width, channels=channels,
+                                 cache=False, freq=freq)
 
     @classmethod
     def from_multi_sine(cls, duration: float, freqs: list, amp: float = -1,
                         rate: int = 48000, width: int = 4, channels: int = 2):
-        print(f"Make multi sine wave: {rate}, {channels}ch, amp: {amp}, freqs: {freqs}, {duration}s")
-        t = np.linspace(0., duration, int(rate * duration), endpoint=False)
-        nptype = [np.int8, np.int16, np.int32, np.int32][width-1]
-        data = np.zeros(int(rate * duration * channels), dtype=np.int64)
-        if(amp < 0):
-            amp = np.iinfo(nptype).max * 0.9
-        for freq in freqs:
-            mono_sine = (amp * np.sin(2. * np.pi * freq * t)).astype(nptype)
-            multi_sine = np.tile(mono_sine.reshape(-1, 1), (1, channels))
-            data += multi_sine.flatten().astype(np.int64)
-        data = (data // len(freqs)).astype(nptype)
-        return cls(data=data, sample_rate=rate, sample_width=width, channels=channels)
+        from lib.Stimulus import Stimulus
+        return Stimulus.generate('multi_sine', duration, amp=amp, rate=rate, width=width, channels=channels,
+                                 cache=False, freqs=list(freqs))
 
     # mixing audio data
     def mix(self, audio_data):
         if self.sample_rate != audio_data.sample_rate or self.channels != audio_data.channels:
             raise ValueError("Sample rate and channels must match to merge audio data.")
-        merged_data = self.data.copy().astype(np.int64) + audio_data.data.astype(np.int64)
+        merged_data = self.frames.astype(np.int64) + audio_data.frames.astype(np.int64)
         merged_data = merged_data//2
-        self.data = np.clip(merged_data, self.min_amp, self.max_amp).astype(self.data.dtype)
+        self.frames = np.clip(merged_data, self.min_amp, self.max_amp).astype(self.dtype)
         return self
 
-    def save(self, file_path: str):
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with wave.open(file_path, 'w') as wf:
-            wf.setnchannels(self.channels)
-            wf.setsampwidth(self.sample_width)
-            wf.setframerate(self.sample_rate)
-            wf.writeframes(self.data.tobytes())
-        print(f"Saved file: {file_path}")
+    def save(self, file_path: str, threads: int = None):
+        """
+        Save as WAV, or as FLAC for a .flac path (float samples as 32-bit float WAV).
+        The samples are streamed to the file in chunks, without a byte copy of the whole buffer.
+        :param threads: Encoder threads of FLAC output, all CPUs if None.
+        """
+        if self._pipeline is not None:
+            self.materialize()
+        with Instrument.span('save', nbytes=self.frames.nbytes, path=file_path), \
+                self._writer(file_path, threads) as writer:
+            writer.write(self.frames)
+        logger.info(f"Saved file: {file_path}")
         return self
 
+    def render(self, file_path: str, block_frames: int = 2 ** 16, threads: int = None):
+        """
+        Run the deferred apply steps block by block straight into a file (see save), so only
+        one block of the result is in memory. The steps stay pending and `frames` unchanged;
+        steps that need the whole signal raise ValueError (see materialize).
+        :return: self
+        """
+        if self._pipeline is None:
+            return self.save(file_path, threads)
+        with Instrument.span('render', nbytes=self.frames.nbytes, path=file_path, steps=len(self._pipeline)), \
+                self._writer(file_path, threads) as writer:
+            for block in self._pipeline.blocks(self, block_frames):
+                writer.write(block)
+        logger.info(f"Rendered {len(self._pipeline)} deferred functions to: {file_path}")
+        return self
+
+    def _writer(self, file_path: str, threads: int = None):
+        return AudioWriter(file_path, self.sample_rate, self.sample_width, self.channels,
+                           'float' if self.dtype.kind == 'f' else 'pcm', threads=threads)
+
     def copy(self):
-        return AudioData(
-            data=self.data.copy(),
+        audio_data = AudioData(
+            data=self.frames.copy(order='K'),
             sample_rate=self.sample_rate,
             sample_width=self.sample_width,
-            channels=self.channels
+            channels=self.channels,
+            layout=self.layout
         )
+        if self._pipeline is not None:
+            audio_data._pipeline = self._pipeline.copy()
+        return audio_data
 
     def getData(self, ch=None):
-        return self.data[ch::self.channels] if ch else self.data
+        """Samples of channel `ch` (see channel), or the interleaved samples if None."""
+        return self.data if ch is None else self.channel(ch)
 
     @property
     def max_val(self):
         """Maximum value based on data."""
-        return self.data.max()
+        return self.frames.max()
     @property
     def min_val(self):
         """Minimum value based on data."""
-        return self.data.min()
+        return self.frames.min()
 
     @property
     def max_amp(self):
@@ -110,6 +440,49 @@ class AudioData:
         :param func: Function to apply to the audio data.
         :return: self with modified data.
         """
-        self.data = func(self, *args, **kwargs)
-        print(f"Applied function: {func.__name__} with args: {args}, kwargs: {kwargs}")
+        if self._pipeline is not None:
+            self._pipeline.add(func, args, kwargs)
+            logger.info(f"Deferred function: {func.__name__} with args: {args}, kwargs: {kwargs}")
+            return self
+        with Instrument.span(f'apply.{func.__name__}', nbytes=self.frames.nbytes):
+            self.frames = func(self, *args, **kwargs)
+        logger.info(f"Applied function: {func.__name__} with args: {args}, kwargs: {kwargs}")
+        return self
+
+    def defer(self, dtype=np.float64):
+        """
+        Start recording apply steps instead of running them.
+        The steps run together on one float working buffer at materialize(), where
+        quantization happens once. Until then `data` is left unchanged.
+        :param dtype: Float type of the working buffer.
+        :return: self
+        """
+        if self._pipeline is None:
+            self._pipeline = AudioPipeline(dtype)
+        return self
+
+    def materialize(self, block_frames: int = None):
+        """
+        Run the deferred apply steps and store the result in `frames`.
+        :param block_frames: Process the signal in blocks of this many frames to bound the
+                             float working memory; steps that need the whole signal
+                             (cut_noise, zero-phase filters) then raise ValueError.
+        :return: self
+        """
+        pipeline = self._pipeline
+        if pipeline is None:
+            return self
+        with Instrument.span('materialize', nbytes=self.frames.nbytes, steps=len(pipeline),
+                             block_frames=block_frames):
+            if block_frames is None:
+                data = pipeline.run(self)
+            else:
+                data = np.empty_like(self.frames)
+                pos = 0
+                for block in pipeline.blocks(self, block_frames):
+                    data[pos:pos + len(block)] = block
+                    pos += len(block)
+        self.frames = data
+        self._pipeline = None
+        logger.info(f"Materialized {len(pipeline)} deferred functions")
         return self
\ No newline at end of file
@@ -1,39 +1,362 @@
+import logging
 import numpy as np
-from scipy.signal import correlate, coherence
+from scipy.signal import correlate, get_window, resample
 from lib.AudioData import AudioData
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
 
 class AudioEvaluator:
     """
     AudioEvaluator class for evaluating the similarity between original and recorded audio data.
     Provides methods to align signals, calculate mean squared error, and spectral coherence.
+    The metrics of an aligned channel pair come from one shared SpectralAnalysis.
     """
 
+    # Length the coarse search decimates the signals down to
+    COARSE_LENGTH = 2 ** 16
+    # Length of the native-rate window (and chunk) used to refine the coarse lag
+    REFINE_LENGTH = 2 ** 16
+    # Signals up to this length are refined with an exact correlation over their whole length
+    EXACT_LENGTH = 2 ** 22
+    # Elements processed at a time by the chunked reductions
+    CHUNK = 2 ** 20
+    # FFT segment size of the spectral coherence
+    COHERENCE_NPERSEG = 2048
+    # Coarse correlation peaks refined at the native rate; periodic content has several of similar height
+    REFINE_CANDIDATES = 8
+    # Smallest and largest half width of the native-rate range refined around a coarse peak, in decimated samples
+    REFINE_LOBE = 2
+    REFINE_SPAN = 256
+    # A refined range covers the part of its coarse peak within this fraction of the peak value
+    COARSE_TOLERANCE = 0.02
+    # Coarse correlation is interpolated by this factor before its peaks are ranked
+    COARSE_UPSAMPLE = 8
+    # Fine correlation peaks at least this fraction of the highest one in their range are scored exactly
+    REFINE_TOLERANCE = 0.9
+
+    @staticmethod
+    def _mean_std(data: np.ndarray):
+        """Mean and standard deviation computed in chunks to avoid full-size temporaries."""
+        chunk = AudioEvaluator.CHUNK
+        mean = sum(float(np.sum(data[i:i + chunk], dtype=np.float64)) for i in range(0, len(data), chunk)) / len(data)
+        var = sum(float(np.sum((data[i:i + chunk] - mean) ** 2)) for i in range(0, len(data), chunk)) / len(data)
+        return mean, np.sqrt(var)
+
+    @staticmethod
+    def _decimate(data: np.ndarray, factor: int, envelope: bool = False):
+        """Block-average decimation of a signal, or of its absolute value when `envelope` is set."""
+        n_blocks = len(data) // factor
+        blocks = data[:n_blocks * factor].reshape(n_blocks, factor)
+        step = max(1, AudioEvaluator.CHUNK // factor)
+        out = np.empty(n_blocks)
+        for i in range(0, n_blocks, step):
+            block = np.abs(blocks[i:i + step]) if envelope else blocks[i:i + step]
+            out[i:i + step] = block.mean(axis=1)
+        return out
+
+    @staticmethod
+    def _correlation_at(orig_data, rec_data, lag, orig_stats, rec_stats):
+        """Normalized cross-correlation at a single lag, as in the 'full' correlation of _align_and_truncate."""
+        orig_mean, orig_std = orig_stats
+        rec_mean, rec_std = rec_stats
+        if lag > 0:
+            length = min(len(orig_data) - lag, len(rec_data))
+            orig_part, rec_part = orig_data[lag:lag + length], rec_data[:length]
+        else:
+            length = min(len(rec_data) + lag, len(orig_data))
+            orig_part, rec_part = orig_data[:length], rec_data[-lag:-lag + length]
+        chunk = AudioEvaluator.CHUNK
+        total = 0.0
+        for i in range(0, length, chunk):
+            total += np.dot(orig_part[i:i + chunk] - orig_mean, rec_part[i:i + chunk] - rec_mean)
+        return total / (orig_std * len(orig_data) * rec_std)
+
+    @staticmethod
+    def _correlation_range(orig_data, rec_data, first_lag, last_lag, orig_stats, rec_stats):
+        """
+        Exact normalized cross-correlation for the lags first_lag..last_lag.
+        The recorded signal is processed in chunks with FFT correlations, so the cost is
+        linear in the signal length instead of a full-length FFT.
+        """
+        orig_mean, orig_std = orig_stats
+        rec_mean, rec_std = rec_stats
+        span = last_lag - first_lag
+        correlation = np.zeros(span + 1)
+        chunk = AudioEvaluator.REFINE_LENGTH
+        begin = max(0, -last_lag)
+        end = min(len(rec_data), len(orig_data) - first_lag)
+        for start in range(begin, end, chunk):
+            stop = min(start + chunk, end)
+            rec_part = rec_data[start:stop] - rec_mean
+            # Original samples outside the signal contribute nothing, like in the 'full' correlation
+            orig_part = np.zeros(stop - start + span)
+            o_start, o_stop = start + first_lag, stop + last_lag
+            valid_start, valid_stop = max(o_start, 0), min(o_stop, len(orig_data))
+            orig_part[valid_start - o_start:valid_stop - o_start] = orig_data[valid_start:valid_stop] - orig_mean
+            correlation += correlate(orig_part, rec_part, mode='valid', method='fft')
+        return correlation / (orig_std * len(orig_data) * rec_std)
+
+    @staticmethod
+    def _windowed_correlation(orig_data, rec_data, rec_dec, factor, first_lag, last_lag, orig_stats, rec_stats):
+        """
+        Approximate cross-correlation for the lags first_lag..last_lag on a single window
+        of REFINE_LENGTH samples, placed where the (decimated) recording is loudest.
+        """
+        length = AudioEvaluator.REFINE_LENGTH
+        begin = max(0, -first_lag)
+        end = min(len(rec_data), len(orig_data) - last_lag)
+        if end - begin < 1:
+            return np.array([AudioEvaluator._correlation_at(orig_data, rec_data, lag, orig_stats, rec_stats)
+                             for lag in range(first_lag, last_lag + 1)])
+        if end - begin > length:
+            rec_energy = np.convolve(rec_dec ** 2, np.ones(max(1, length // factor)), mode='valid')
+            first, last = -(-begin // factor), min((end - length) // factor, len(rec_energy) - 1)
+            if first <= last:
+                begin = (first + int(np.argmax(rec_energy[first:last + 1]))) * factor
+        length = min(length, end - begin)
+        rec_part = rec_data[begin:begin + length] - rec_stats[0]
+        orig_part = orig_data[begin + first_lag:begin + last_lag + length] - orig_stats[0]
+        return correlate(orig_part, rec_part, mode='valid', method='fft')
+
+    @staticmethod
+    def _parabolic_offset(left: float, center: float, right: float):
+        """Sub-sample offset of a peak from three neighbouring correlation values."""
+        denom = left - 2 * center + right
+        if denom == 0:
+            return 0.0
+        return float(np.clip(0.5 * (left - right) / denom, -0.5, 0.5))
+
+    @staticmethod
+    def _find_lag(orig_data: np.ndarray, rec_data: np.ndarray, max_lag: int = None, subsample: bool = False):
+        """
+        Coarse-to-fine search of the lag maximizing the cross-correlation.
+        The lag is first estimated on block-averaged signals (or their envelopes when most of
+        the energy is above the decimated Nyquist rate), then refined with a windowed
+        FFT correlation at the native rate around the candidate.
+        Args:
+            orig_data (np.ndarray): Original audio data.
+            rec_data (np.ndarray): Recorded audio data.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+                When set, only the first part of the signals (a few times `max_lag`) is searched.
+            subsample (bool): Refine the lag with parabolic interpolation.
+
+        Returns:
+            Tuple[int | float, float]: lag (float if `subsample`) and the peak correlation
+        """
+        with Instrument.span('normalize', nbytes=orig_data.nbytes + rec_data.nbytes):
+            orig_stats = AudioEvaluator._mean_std(orig_data)
+            rec_stats = AudioEvaluator._mean_std(rec_data)
+        if orig_stats[1] == 0 or rec_stats[1] == 0:
+            return 0, 0.0
+
+        lo, hi, n_orig, n_rec, factor = AudioEvaluator._lag_plan(len(orig_data), len(rec_data), max_lag)
+        orig_win, rec_win = orig_data[:n_orig], rec_data[:n_rec]
+        if factor == 1:
+            # Short signals: exact normalized correlation at the native rate
+            orig_norm = (orig_win - orig_stats[0]) / (orig_stats[1] * len(orig_data))
+            rec_norm = (rec_win - rec_stats[0]) / rec_stats[1]
+            correlation = correlate(orig_norm, rec_norm, mode='full')
+            return AudioEvaluator._exact_lag(correlation, orig_data, rec_data, lo, hi, n_rec, max_lag, subsample,
+                                             orig_stats, rec_stats)
+
+        # 1. Coarse search on decimated signals
+        rec_dec, envelope = AudioEvaluator._coarse_recording(rec_win, factor, rec_stats)
+        orig_dec = AudioEvaluator._coarse_signal(orig_win, factor, envelope)
+        correlation = correlate(orig_dec, rec_dec, mode='full', method='fft')
+        # 2. Refine at the native rate around the candidate
+        return AudioEvaluator._refine_lag(correlation, orig_data, rec_data, n_orig, n_rec, rec_dec, lo, hi, factor,
+                                          subsample, orig_stats, rec_stats)
+
+    @staticmethod
+    def _lag_plan(orig_len: int, rec_len: int, max_lag: int = None):
+        """
+        Search plan of _find_lag.
+        Returns:
+            Tuple[int, int, int, int, int]: lowest and highest lag, lengths of the original and
+            recorded search windows and the decimation factor of the coarse search (1: exact search)
+        """
+        lo, hi = -(rec_len - 1), orig_len - 1
+        n_orig, n_rec = orig_len, rec_len
+        if max_lag is not None:
+            lo, hi = max(lo, -max_lag), min(hi, max_lag)
+            # Lags are bounded, so a window a few times longer than the bound is enough
+            window = max(8 * max_lag, AudioEvaluator.COARSE_LENGTH) + max_lag
+            n_orig, n_rec = min(orig_len, window), min(rec_len, window)
+
+        factor = 1
+        while (n_orig + n_rec) // factor > 2 * AudioEvaluator.COARSE_LENGTH:
+            factor *= 2
+        return lo, hi, n_orig, n_rec, factor
+
+    @staticmethod
+    def _coarse_recording(rec_win: np.ndarray, factor: int, rec_stats):
+        """Zero-mean decimated recording and whether the envelope had to be used."""
+        rec_dec = AudioEvaluator._decimate(rec_win, factor)
+        # Most of the energy is above the decimated Nyquist rate, use the envelopes instead
+        envelope = bool(np.var(rec_dec) < 0.01 * rec_stats[1] ** 2)
+        if envelope:
+            rec_dec = AudioEvaluator._decimate(rec_win, factor, envelope=True)
+        rec_dec -= rec_dec.mean()
+        return rec_dec, envelope
+
     @staticmethod
-    def _align_and_truncate(orig_data: np.ndarray, rec_data: np.ndarray, rate: int):
+    def _coarse_signal(orig_win: np.ndarray, factor: int, envelope: bool):
+        """Zero-mean decimated original (or its envelope) for the coarse search."""
+        orig_dec = AudioEvaluator._decimate(orig_win, factor, envelope=envelope)
+        orig_dec -= orig_dec.mean()
+        return orig_dec
+
+    @staticmethod
+    def _exact_lag(correlation, orig_data, rec_data, lo, hi, n_rec, max_lag, subsample, orig_stats, rec_stats):
+        """Peak of the 'full' normalized correlation of the search windows."""
+        zero = n_rec - 1
+        correlation = correlation[zero + lo:zero + hi + 1]
+        peak = int(np.argmax(correlation))
+        lag = lo + peak
+        max_corr = correlation[peak]
+        if max_lag is not None:
+            max_corr = AudioEvaluator._correlation_at(orig_data, rec_data, lag, orig_stats, rec_stats)
+        if subsample and 0 < peak < len(correlation) - 1:
+            lag += AudioEvaluator._parabolic_offset(*correlation[peak - 1:peak + 2])
+        return lag, max_corr
+
+    @staticmethod
+    def _refine_lag(correlation, orig_data, rec_data, n_orig, n_rec, rec_dec, lo, hi, factor, subsample,
+                    orig_stats, rec_stats):
+        """
+        Refine the peaks of the coarse 'full' correlation at the native rate.
+        The fine correlation of a range only places its peaks: on periodic content (or a window
+        of a long signal) several of them are about as high, so each of those is scored by the
+        exact correlation over the whole signals, and the best one is climbed to the exact peak.
+        """
+        zero = len(rec_dec) - 1
+        lo_dec = max(-(-lo // factor), -(len(rec_dec) - 1))
+        hi_dec = min(hi // factor, n_orig // factor - 1)
+        correlation = correlation[zero + lo_dec:zero + hi_dec + 1]
+        exact = n_orig + n_rec <= 2 * AudioEvaluator.EXACT_LENGTH
+        # an exact range costs about as much wide as narrow, so close ranges are refined together
+        gap = AudioEvaluator.REFINE_LENGTH // 4 if exact else 0
+
+        best = None
+        for first, last in AudioEvaluator._coarse_lobes(correlation, lo_dec, factor, lo, hi, gap):
+            if exact:
+                refine = AudioEvaluator._correlation_range(orig_data[:n_orig], rec_data[:n_rec], first, last,
+                                                           orig_stats, rec_stats)
+            else:
+                refine = AudioEvaluator._windowed_correlation(orig_data, rec_data, rec_dec, factor,
+                                                              first, last, orig_stats, rec_stats)
+            for peak in AudioEvaluator._fine_peaks(refine):
+                lag = first + int(peak)
+                max_corr = AudioEvaluator._correlation_at(orig_data, rec_data, lag, orig_stats, rec_stats)
+                if best is None or max_corr > best[1]:
+                    best = (lag, max_corr)
+        lag, max_corr, left, right = AudioEvaluator._climb(orig_data, rec_data, *best, lo, hi, orig_stats, rec_stats)
+        if subsample and left is not None and right is not None:
+            lag += AudioEvaluator._parabolic_offset(left, max_corr, right)
+        return lag, max_corr
+
+    @staticmethod
+    def _climb(orig_data, rec_data, lag: int, corr: float, lo: int, hi: int, orig_stats, rec_stats):
+        """
+        Follow the exact correlation from a lag uphill to its local peak.
+        Returns:
+            Tuple[int, float, float, float]: lag of the peak, its correlation and the correlation
+            of the lags on each side of it (None outside lo..hi)
+        """
+        def at(other):
+            if not lo <= other <= hi:
+                return None
+            return AudioEvaluator._correlation_at(orig_data, rec_data, other, orig_stats, rec_stats)
+
+        left, right = at(lag - 1), at(lag + 1)
+        while right is not None and right > corr:
+            lag, left, corr, right = lag + 1, corr, right, at(lag + 2)
+        while left is not None and left > corr:
+            lag, right, corr, left = lag - 1, corr, left, at(lag - 2)
+        return lag, corr, left, right
+
+    @staticmethod
+    def _fine_peaks(refine: np.ndarray):
+        """
+        Local maxima of a fine correlation within REFINE_TOLERANCE of its highest value,
+        at most REFINE_CANDIDATES of them, highest first (the ends count as maxima).
+        """
+        rising = np.diff(refine) > 0
+        peaks = np.flatnonzero(np.concatenate(([True], rising)) & np.concatenate((~rising, [True])))
+        top = refine.max()
+        peaks = peaks[refine[peaks] >= top - (1 - AudioEvaluator.REFINE_TOLERANCE) * abs(top)]
+        return peaks[np.argsort(refine[peaks])[::-1][:AudioEvaluator.REFINE_CANDIDATES]]
+
+    @staticmethod
+    def _coarse_lobes(correlation: np.ndarray, lo_dec: int, factor: int, lo: int, hi: int, gap: int = 0):
+        """
+        Native-rate lag ranges around the highest coarse correlation peaks.
+        Peaks are ranked on the correlation interpolated by COARSE_UPSAMPLE: the blocks sample a
+        periodic correlation at an arbitrary phase, so the raw values of peaks of similar height
+        differ by more than the peaks do. A range covers the lags around its peak that stay within
+        COARSE_TOLERANCE of it (a block only places the lag to within REFINE_LOBE decimated
+        samples, a flat peak to within its whole top), at most REFINE_SPAN decimated samples on
+        each side; ranges less than `gap` lags apart are merged.
+        Returns:
+            List[Tuple[int, int]]: first and last lag of every range, within lo..hi
+        """
+        upsample = AudioEvaluator.COARSE_UPSAMPLE
+        if len(correlation) > 1:
+            correlation = resample(correlation, len(correlation) * upsample)
+        rising = np.diff(correlation) > 0
+        # local maxima, the ends count too
+        peaks = np.flatnonzero(np.concatenate(([True], rising)) & np.concatenate((~rising, [True])))
+        top = peaks[np.argsort(correlation[peaks])[::-1][:AudioEvaluator.REFINE_CANDIDATES]]
+
+        bounds = []
+        reach = AudioEvaluator.REFINE_SPAN * upsample
+        lobe = AudioEvaluator.REFINE_LOBE * upsample
+        for peak in top:
+            level = correlation[peak] - AudioEvaluator.COARSE_TOLERANCE * abs(correlation[peak])
+            start = max(peak - reach, 0)
+            below = correlation[start:peak + reach + 1] < level
+            left, right = np.flatnonzero(below[:peak - start]), np.flatnonzero(below[peak - start:])
+            first = start + left[-1] + 1 if len(left) else start
+            last = peak + right[0] - 1 if len(right) else start + len(below) - 1
+            first, last = min(first, peak - lobe) / upsample, max(last, peak + lobe) / upsample
+            bounds.append(((lo_dec + first) * factor, (lo_dec + last) * factor))
+
+        ranges = []
+        for first, last in sorted(bounds):
+            first, last = max(lo, int(np.floor(first))), min(hi, int(np.ceil(last)))
+            if ranges and first <= ranges[-1][1] + 1 + gap:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+            elif first <= last:
+                ranges.append((first, last))
+        return ranges
+
+    @staticmethod
+    def _align_and_truncate(orig_data: np.ndarray, rec_data: np.ndarray, rate: int,
+                            max_lag: int = None, subsample: bool = False):
         """
         Cross-correlate the original and recorded audio data to find the optimal alignment point.
         Args:
             orig_data (np.ndarray): Original audio data.
             rec_data (np.ndarray): Recorded audio data.
             rate (int): Sample rate of the audio data.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision (parabolic interpolation).
 
         Returns:
             Tuple[np.ndarray, np.ndarray, int, float]
         """
 
-        print("  - Normalize audio data and calculate cross-correlation...")
-        # Normalize the audio data
-        orig_norm = (orig_data - np.mean(orig_data)) / (np.std(orig_data) * len(orig_data))
-        rec_norm = (rec_data - np.mean(rec_data)) / np.std(rec_data)
-
-        # Calculate cross-correlation
-        correlation = correlate(orig_norm, rec_norm, mode='full')
-        # Find the lag that maximizes the correlation
-        lag_in_samples = np.argmax(correlation) - (len(rec_data) - 1)
-        max_corr = np.max(correlation)
-
-        print(f"  - Time Lag: {lag_in_samples} sample ({lag_in_samples/rate:.4f}s)")
+        logger.info("  - Normalize audio data and calculate cross-correlation...")
+        with Instrument.span('correlation', nbytes=orig_data.nbytes + rec_data.nbytes):
+            lag, max_corr = AudioEvaluator._find_lag(orig_data, rec_data, max_lag, subsample)
+        logger.info(f"  - Time Lag: {lag} sample ({lag/rate:.4f}s)")
+        aligned_orig, aligned_rec, _ = AudioEvaluator._aligned(orig_data, rec_data, int(round(lag)))
+        return aligned_orig, aligned_rec, lag, max_corr
 
+    @staticmethod
+    def _aligned(orig_data: np.ndarray, rec_data: np.ndarray, lag_in_samples: int):
+        """Overlapping parts of the signals at an integer lag and the start of the part in the original."""
         # Align the signals based on the lag
         if lag_in_samples > 0:  # If original starts later than recorded
             start_index = lag_in_samples
@@ -51,50 +374,294 @@ class AudioEvaluator:
         aligned_orig = aligned_orig[:min_len]
         aligned_rec = aligned_rec[:min_len]
 
-        return aligned_orig, aligned_rec, lag_in_samples, max_corr
+        return aligned_orig, aligned_rec, max(lag_in_samples, 0)
 
     @staticmethod
-    def evaluate(original: AudioData, recorded: AudioData):
+    def _welch_sums(orig_data: np.ndarray, rec_data: np.ndarray, nperseg: int):
         """
-        Measure the similarity between original and recorded audio.
+        Accumulate the Welch cross/auto spectra used by scipy.signal.coherence.
+        Segments use a Hann window, 50% overlap and constant detrending.
+        Args:
+            orig_data (np.ndarray): Original audio data.
+            rec_data (np.ndarray): Recorded audio data of the same length.
+            nperseg (int): FFT segment size.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, int]: sums of Pxy, Pxx, Pyy and the segment count
+        """
+        n_freqs = nperseg // 2 + 1
+        if len(orig_data) < nperseg:
+            return np.zeros(n_freqs, dtype=np.complex128), np.zeros(n_freqs), np.zeros(n_freqs), 0
+
+        orig_spec = AudioEvaluator._segment_spectra(orig_data, nperseg)
+        rec_spec = AudioEvaluator._segment_spectra(rec_data, nperseg)
+        return AudioEvaluator._cross_sums(orig_spec, rec_spec)
+
+    @staticmethod
+    def _segment_spectra(data: np.ndarray, nperseg: int):
+        """Spectra of the Welch segments of a signal (Hann window, 50% overlap, constant detrend)."""
+        window = get_window('hann', nperseg)
+        hop = nperseg - nperseg // 2
+        segments = np.lib.stride_tricks.sliding_window_view(data, nperseg)[::hop]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        return np.fft.rfft(segments * window, axis=1)
+
+    @staticmethod
+    def _cross_sums(orig_spec: np.ndarray, rec_spec: np.ndarray):
+        """Welch sums of Pxy, Pxx, Pyy and the segment count from matching segment spectra."""
+        pxy = np.sum(orig_spec.conj() * rec_spec, axis=0)
+        pxx = np.sum(np.abs(orig_spec) ** 2, axis=0)
+        pyy = np.sum(np.abs(rec_spec) ** 2, axis=0)
+        return pxy, pxx, pyy, len(orig_spec)
+
+    @staticmethod
+    def _coherence_from_sums(pxy: np.ndarray, pxx: np.ndarray, pyy: np.ndarray):
+        """Average magnitude squared coherence from accumulated Welch sums."""
+        denom = pxx * pyy
+        if not np.any(denom > 0):
+            return 0.0
+        cxy = np.abs(pxy) ** 2 / np.where(denom > 0, denom, np.inf)
+        return float(np.mean(cxy))
+
+    @staticmethod
+    def evaluate_stream(original_path: str, recorded_path: str, block_sec: float = 10.0,
+                        align_sec: float = 30.0, nperseg: int = 2048, max_lag: int = None):
+        """
+        Measure the similarity of two WAV files block by block with bounded memory.
+        The lag is searched once on the first `align_sec` seconds (all channels mixed down)
+        and reused for the whole file. MSE and Welch coherence are accumulated per block,
+        so peak memory depends on `block_sec` only, not on the file length.
 
         Args:
-            original (AudioData): Original audio data object.
-            recorded (AudioData): Recorded audio data object.
+            original_path (str): Path of the original WAV file.
+            recorded_path (str): Path of the recorded WAV file.
+            block_sec (float): Length of a processing block in seconds.
+            align_sec (float): Length of the window used for the lag search in seconds.
+            nperseg (int): FFT segment size of the coherence estimate.
+            max_lag (int): Largest absolute lag to search in samples, the whole window if None.
 
         Returns:
-            A dictionary containing similarity metrics for each channel.
+            A dictionary containing similarity metrics and per-block metrics for each channel.
         """
-        if original.channels != recorded.channels:
+        logger.info("[AudioEvaluator] Streaming audio similarity evaluation started...")
+        orig_head = next(AudioData.iter_file(original_path, 1))
+        rec_head = next(AudioData.iter_file(recorded_path, 1))
+        if orig_head.channels != rec_head.channels:
             raise ValueError("channels of original and recorded audio must match.")
+        if orig_head.sample_rate != rec_head.sample_rate:
+            raise ValueError("sample rate of original and recorded audio must match.")
+        rate = orig_head.sample_rate
+        channels = orig_head.channels
 
-        results = {}
-        print("\n[AudioEvaluator] Audio similarity evaluation started...")
-        for ch in range(original.channels):
-            print(f"===== Evaluating channel {ch} =====")
-            orig_ch_data = original.getData(ch=ch).astype(np.float64)
-            rec_ch_data = recorded.getData(ch=ch).astype(np.float64)
-
-            # 1. Align the signals and get the peak correlation value
-            aligned_orig, aligned_rec, lag, peak_corr = AudioEvaluator._align_and_truncate(orig_ch_data, rec_ch_data, original.sample_rate)
-
-            # 2. Calculate Mean Squared Error (MSE)
-            mse = np.mean((aligned_orig - aligned_rec) ** 2)
-
-            # 3. Calculate Spectral Coherence
-            # Measure how consistent the phase relationship is between the two signals across frequency bands
-            nperseg = min(len(aligned_orig), 2048) # FFT segment size
-            if nperseg > 0:
-                f, Cxy = coherence(aligned_orig, aligned_rec, fs=original.sample_rate, nperseg=nperseg)
-                avg_coherence = np.mean(Cxy)
-            else:
-                avg_coherence = 0.0
+        # 1. Find the lag once on a bounded window
+        align_frames = int(align_sec * rate)
+        orig_win = next(AudioData.iter_file(original_path, align_frames)).frames
+        rec_win = next(AudioData.iter_file(recorded_path, align_frames)).frames
+        _, _, lag, peak_corr = AudioEvaluator._align_and_truncate(
+            orig_win.astype(np.float64).sum(axis=1), rec_win.astype(np.float64).sum(axis=1), rate, max_lag)
+        del orig_win, rec_win
+
+        # 2. Accumulate MSE and coherence over aligned blocks
+        block_frames = max(int(block_sec * rate), nperseg)
+        orig_blocks = AudioData.iter_file(original_path, block_frames, start_frame=max(lag, 0))
+        rec_blocks = AudioData.iter_file(recorded_path, block_frames, start_frame=max(-lag, 0))
+
+        n_freqs = nperseg // 2 + 1
+        hop = nperseg - nperseg // 2
+        sq_err = np.zeros(channels)
+        pxy = np.zeros((channels, n_freqs), dtype=np.complex128)
+        pxx = np.zeros((channels, n_freqs))
+        pyy = np.zeros((channels, n_freqs))
+        blocks = [[] for _ in range(channels)]
+        # Samples kept from the previous block so Welch segments run across block borders
+        carry = [(np.empty(0), np.empty(0)) for _ in range(channels)]
+        n_frames = 0
+        for orig_block, rec_block in zip(orig_blocks, rec_blocks):
+            orig_frames = orig_block.frames
+            rec_frames = rec_block.frames
+            length = min(len(orig_frames), len(rec_frames))
+            start_sec = n_frames / rate
+            with Instrument.span('evaluate_stream.block', nbytes=orig_frames.nbytes + rec_frames.nbytes):
+                for ch in range(channels):
+                    orig_ch = orig_frames[:length, ch].astype(np.float64)
+                    rec_ch = rec_frames[:length, ch].astype(np.float64)
+                    block_err = np.sum((orig_ch - rec_ch) ** 2)
+                    sq_err[ch] += block_err
+
+                    orig_seg = np.concatenate((carry[ch][0], orig_ch))
+                    rec_seg = np.concatenate((carry[ch][1], rec_ch))
+                    b_pxy, b_pxx, b_pyy, n_seg = AudioEvaluator._welch_sums(orig_seg, rec_seg, nperseg)
+                    pxy[ch] += b_pxy
+                    pxx[ch] += b_pxx
+                    pyy[ch] += b_pyy
+                    carry[ch] = (orig_seg[n_seg * hop:], rec_seg[n_seg * hop:])
+
+                    blocks[ch].append({
+                        'start_sec': start_sec,
+                        'mean_squared_error': block_err / length if length else 0.0,
+                        'average_spectral_coherence': AudioEvaluator._coherence_from_sums(b_pxy, b_pxx, b_pyy)
+                    })
+            n_frames += length
+            if len(orig_frames) != len(rec_frames):
+                break
 
+        results = {}
+        for ch in range(channels):
             results[f'channel_{ch}'] = {
                 'lag_samples': lag,
                 'peak_cross_correlation': peak_corr,
-                'mean_squared_error': mse,
-                'average_spectral_coherence': avg_coherence
+                'mean_squared_error': sq_err[ch] / n_frames if n_frames else 0.0,
+                'average_spectral_coherence': AudioEvaluator._coherence_from_sums(pxy[ch], pxx[ch], pyy[ch]),
+                'blocks': blocks[ch]
             }
-        print("\n[AudioEvaluator] Done.")
-        return results
\ No newline at end of file
+        logger.info(f"  - Evaluated {n_frames} frames in {len(blocks[0])} blocks")
+        logger.info("[AudioEvaluator] Done.")
+        return results
+
+    @staticmethod
+    def analyze_channel(orig_ch_data: np.ndarray, rec_ch_data: np.ndarray, rate: int, max_lag: int = None,
+                        subsample: bool = False, full_scale: float = None, metrics=None, drift: bool = False):
+        """
+        Align one channel pair and run the shared spectral analysis on it.
+
+        Args:
+            orig_ch_data (np.ndarray): Original channel data (float).
+            rec_ch_data (np.ndarray): Recorded channel data (float).
+            rate (int): Sample rate of the audio data.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision.
+            full_scale (float): Largest sample magnitude of the recorded format, for the clipping ratio.
+            metrics (List[str]): Metrics to compute (see SpectralAnalysis.METRICS), the default set if None.
+            drift (bool): Track the lag along the recording and resample it onto the timeline of the
+                original before the metrics (see DriftTracker); adds 'drift_ppm' and 'lag_curve'.
+
+        Returns:
+            Tuple[dict, SpectralAnalysis]: metrics of the channel and the analysis they were computed from
+        """
+        from lib.SpectralAnalysis import SpectralAnalysis
+        # 1. Align the signals and get the peak correlation value
+        if drift:
+            from lib.DriftTracker import DriftTracker
+            track = DriftTracker.track(orig_ch_data, rec_ch_data, rate, max_lag)
+            aligned_orig, aligned_rec, orig_start, rec_start = DriftTracker.compensate(orig_ch_data, rec_ch_data,
+                                                                                       track)
+            # without resampling the signals are aligned at the constant lag, report that one
+            lag = track['lag']
+            if DriftTracker.negligible(track, len(rec_ch_data)):
+                lag = DriftTracker.constant_lag(track, len(rec_ch_data))
+            lag = lag if subsample else int(round(lag))
+            results = {'lag_samples': lag, 'peak_cross_correlation': track['peak_correlation'],
+                       'drift_ppm': track['drift_ppm']}
+        else:
+            aligned_orig, aligned_rec, lag, peak_corr = AudioEvaluator._align_and_truncate(
+                orig_ch_data, rec_ch_data, rate, max_lag, subsample)
+            lag_int = int(round(lag))
+            orig_start, rec_start = max(lag_int, 0), max(-lag_int, 0)
+            results = {'lag_samples': lag, 'peak_cross_correlation': peak_corr}
+
+        # 2. MSE, spectral coherence and the other metrics from one shared analysis
+        analysis = SpectralAnalysis(aligned_orig, aligned_rec, rate, full_scale, orig_start, rec_start)
+        with Instrument.span('metrics', nbytes=aligned_orig.nbytes + aligned_rec.nbytes, nperseg=analysis.nperseg):
+            results.update(analysis.metrics(metrics))
+        if drift:
+            results['lag_curve'] = track['curve']
+        return results, analysis
+
+    @staticmethod
+    def evaluate_channel(orig_ch_data: np.ndarray, rec_ch_data: np.ndarray, rate: int,
+                         max_lag: int = None, subsample: bool = False, full_scale: float = None):
+        """
+        Measure the similarity between one channel of original and recorded audio.
+
+        Args:
+            orig_ch_data (np.ndarray): Original channel data (float).
+            rec_ch_data (np.ndarray): Recorded channel data (float).
+            rate (int): Sample rate of the audio data.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision.
+            full_scale (float): Largest sample magnitude of the recorded format, for the clipping ratio.
+
+        Returns:
+            A dictionary containing similarity metrics of the channel.
+        """
+        return AudioEvaluator.analyze_channel(orig_ch_data, rec_ch_data, rate, max_lag, subsample, full_scale)[0]
+
+    @staticmethod
+    def analyze(original: AudioData, recorded: AudioData, max_lag: int = None, subsample: bool = False,
+                metrics=None, drift: bool = False):
+        """
+        Measure the similarity between original and recorded audio and keep the analyses.
+
+        Args:
+            original (AudioData): Original audio data object.
+            recorded (AudioData): Recorded audio data object.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision.
+            metrics (List[str]): Metrics to compute (see SpectralAnalysis.METRICS), the default set if None.
+            drift (bool): Compensate clock drift between the recording and the original (see analyze_channel).
+
+        Returns:
+            Tuple[dict, List[SpectralAnalysis]]: metrics for each channel and the analysis of each
+            channel, e.g. for Visualizer.plot_audio_data
+        """
+        if original.channels != recorded.channels:
+            raise ValueError("channels of original and recorded audio must match.")
+
+        results = {}
+        analyses = []
+        logger.info("[AudioEvaluator] Audio similarity evaluation started...")
+        with Instrument.span('evaluate', nbytes=original.frames.nbytes + recorded.frames.nbytes):
+            for ch in range(original.channels):
+                logger.info(f"===== Evaluating channel {ch} =====")
+                with Instrument.span('evaluate.channel', channel=ch):
+                    orig_ch_data = original.float_channel(ch, np.float64)
+                    rec_ch_data = recorded.float_channel(ch, np.float64)
+                    results[f'channel_{ch}'], analysis = AudioEvaluator.analyze_channel(
+                        orig_ch_data, rec_ch_data, original.sample_rate, max_lag, subsample,
+                        recorded.max_amp, metrics, drift)
+                    analyses.append(analysis)
+        logger.info("[AudioEvaluator] Done.")
+        return results, analyses
+
+    @staticmethod
+    def evaluate(original: AudioData, recorded: AudioData, max_lag: int = None, subsample: bool = False,
+                 drift: bool = False):
+        """
+        Measure the similarity between original and recorded audio.
+
+        Args:
+            original (AudioData): Original audio data object.
+            recorded (AudioData): Recorded audio data object.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision.
+            drift (bool): Compensate clock drift between the recording and the original (see analyze_channel).
+
+        Returns:
+            A dictionary containing similarity metrics for each channel.
+        """
+        return AudioEvaluator.analyze(original, recorded, max_lag, subsample, drift=drift)[0]
+
+    @staticmethod
+    def evaluate_many(original, recordings, max_lag: int = None, subsample: bool = False, batch_size: int = 64):
+        """
+        Measure the similarity between one original and many recordings.
+        The original is prepared once (normalization stats, padded FFTs, Welch segment spectra),
+        so every recording only costs its own transforms.
+
+        Args:
+            original (AudioData | PreparedReference): Original audio data, or an already prepared reference.
+            recordings (List[AudioData | str]): Recorded audio data objects or file paths.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            subsample (bool): Report the lag with sub-sample precision.
+            batch_size (int): Recordings loaded and correlated together.
+
+        Returns:
+            List[dict]: results of `evaluate` for each recording, in order.
+        """
+        from lib.PreparedReference import PreparedReference
+        logger.info(f"[AudioEvaluator] Evaluation of {len(recordings)} recordings started...")
+        with Instrument.span('evaluate_many', recordings=len(recordings)):
+            reference = original if isinstance(original, PreparedReference) else PreparedReference(original)
+            results = reference.evaluate(recordings, max_lag, subsample, batch_size)
+        logger.info("[AudioEvaluator] Done.")
+        return results
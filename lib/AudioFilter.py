@@ -1,110 +1,270 @@
+import functools
+import logging
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, sosfiltfilt
+
+logger = logging.getLogger(__name__)
+
+def _fused(buffer_op):
+    """
+    Attach the float working-buffer variant of an effect, used by deferred AudioData pipelines.
+    buffer_op(buf, ctx, *args, **kwargs) modifies a float (frames, channels) block in place
+    (or returns a new one) and clips it to the sample range like the eager effect, so a fused
+    chain saturates where the eager chain does; ctx is a lib.AudioPipeline.EffectContext.
+    """
+    def attach(func):
+        func.buffer_op = buffer_op
+        return func
+    return attach
+
+
+def _target_frames(sample_rate: int, target_sec):
+    """Frame positions of one or more target times in seconds."""
+    return (np.atleast_1d(np.asarray(target_sec, dtype=np.float64)) * sample_rate).astype(np.int64)
+
+
+def _pop_frames(frames, positions, target_channel, noise_level, noise_duration_samples):
+    """Frames touched by pops at `positions`, the noise added to each of them and the channel index."""
+    pop_frames = (positions[:, None] + np.arange(noise_duration_samples)).ravel()
+    pop_frames = pop_frames[(pop_frames >= 0) & (pop_frames < len(frames))]
+    # overlapping pops add up
+    pop_frames, counts = np.unique(pop_frames, return_counts=True)
+    return np.ix_(pop_frames, list(target_channel)), counts[:, None] * np.float64(noise_level)
+
+
+def _cut_frames(frames, positions, target_channel, noise_duration_samples):
+    """Remove `noise_duration_samples` frames at each position in place and zero-pad the end."""
+    n_frames = len(frames)
+    # a cut near the end zeroes the last `noise_duration_samples` frames, like one in the middle
+    starts = np.clip(positions, 0, max(n_frames - noise_duration_samples, 0))
+    # mark the cut ranges with +1/-1 edges, a frame is kept where no range covers it
+    edges = np.zeros(n_frames + 1, dtype=np.int64)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, np.minimum(starts + noise_duration_samples, n_frames), -1)
+    keep = np.cumsum(edges[:-1]) == 0
+    # overlapping cuts remove fewer frames than requested
+    remaining = int(np.count_nonzero(keep))
+    for channel_idx in target_channel:
+        frames[:remaining, channel_idx] = frames[keep, channel_idx]
+        frames[remaining:, channel_idx] = 0
+
+
+def _clip(buf, ctx):
+    return np.clip(buf, ctx.min_amp, ctx.max_amp, out=buf)
+
+
+def _dc_offset_buffer(buf, ctx, offset: int):
+    buf += offset
+    _clip(buf, ctx)
+
+
+def _clipping_buffer(buf, ctx, multiple: float):
+    buf *= multiple
+    _clip(buf, ctx)
+
+
+def _pop_noise_buffer(buf, ctx, target_sec, target_channel = [0],
+                      noise_level: int = None, noise_duration_samples: int = 5):
+    if noise_level is None:
+        noise_level = ctx.max_amp
+    positions = _target_frames(ctx.sample_rate, target_sec) - ctx.start
+    index, noise = _pop_frames(buf, positions, target_channel, noise_level, noise_duration_samples)
+    buf[index] = np.clip(buf[index] + noise, ctx.min_amp, ctx.max_amp)
+
+
+def _cut_noise_buffer(buf, ctx, target_sec, target_channel = [0],
+                      noise_duration_samples: int = 5):
+    if not ctx.whole:
+        raise ValueError("cut_noise moves samples across blocks and cannot run block by block.")
+    _cut_frames(buf, _target_frames(ctx.sample_rate, target_sec), target_channel, noise_duration_samples)
+
+
+def _normal_noise_buffer(buf, ctx, noise_level: int = 1000):
+    buf += np.random.normal(0, noise_level, buf.shape)
+    _clip(buf, ctx)
+
 
 class AudioNoise:
     """AudioFilter class for applying various filters to audio data.
     Provides methods to add DC offset, clipping, and pop noise to audio data.
     """
     @staticmethod
+    @_fused(_dc_offset_buffer)
     def dc_offset(audio_data, offset: int):
         """Add DC offset to the audio data."""
-        ndata = audio_data.data.copy()
+        ndata = audio_data.frames.copy(order='K')
         ndata = np.clip(ndata.astype(np.float32) + offset,
                         audio_data.min_amp, audio_data.max_amp).astype(ndata.dtype)
-        print(f"  - Add DC offset (Level: {offset})")
+        logger.info(f"  - Add DC offset (Level: {offset})")
         return ndata
 
     @staticmethod
+    @_fused(_clipping_buffer)
     def clipping(audio_data, multiple: float):
-        ndata = audio_data.data.copy()
+        ndata = audio_data.frames.copy(order='K')
         clipped_data = ndata.astype(np.float32) * multiple
         ndata = np.clip(clipped_data, audio_data.min_amp, audio_data.max_amp).astype(ndata.dtype)
-        print(f"  - Make a clipping (Gain: {multiple})")
+        logger.info(f"  - Make a clipping (Gain: {multiple})")
         return ndata
 
     @staticmethod
-    def pop_noise(audio_data, target_sec: float, target_channel = [0],
+    def _describe(target_sec):
+        return f"{target_sec}s" if np.isscalar(target_sec) else f"{len(target_sec)} positions"
+
+    @staticmethod
+    @_fused(_pop_noise_buffer)
+    def pop_noise(audio_data, target_sec, target_channel = [0],
                       noise_level: int = None, noise_duration_samples: int = 5):
+        """
+        Add pop noise to the audio data.
+        :param target_sec: Time of the pop in seconds, or an array of times to add many pops at once.
+        """
         if noise_level is None:
             noise_level = audio_data.max_amp
 
-        ndata = audio_data.data.copy()
-        pop_position = int(target_sec * audio_data.sample_rate)
-        for channel_idx in target_channel:
-            for i in range(noise_duration_samples):
-                ndata[(pop_position + i)* audio_data.channels + channel_idx] = \
-                    np.clip(ndata[(pop_position + i) * audio_data.channels + channel_idx] + noise_level,
-                            audio_data.min_amp, audio_data.max_amp)
-            print(f"  - Add pop noise({target_sec}s)")
-        else:
-            print(f"  - Failed to add pop")
-        return ndata
+        frames = audio_data.frames.copy(order='K')
+        positions = _target_frames(audio_data.sample_rate, target_sec)
+        index, noise = _pop_frames(frames, positions, target_channel, noise_level, noise_duration_samples)
+        # widen before adding so loud samples saturate instead of wrapping around
+        popped = frames[index].astype(np.float64) + noise
+        frames[index] = np.clip(popped, audio_data.min_amp, audio_data.max_amp)
+        logger.info(f"  - Add pop noise({AudioNoise._describe(target_sec)})")
+        return frames
 
     @staticmethod
-    def cut_noise(audio_data, target_sec: float, target_channel = [0],
+    @_fused(_cut_noise_buffer)
+    def cut_noise(audio_data, target_sec, target_channel = [0],
                   noise_duration_samples: int = 5):
-        ndata = audio_data.data.copy()
-        cut_position = int(target_sec * audio_data.sample_rate)
-        mono_data_len = len(ndata) // audio_data.channels
-        for cur_position in range(cut_position, mono_data_len - noise_duration_samples):
-            for channel_idx in target_channel:
-                ndata[cur_position * audio_data.channels + channel_idx] = \
-                    ndata[(cur_position + noise_duration_samples) * audio_data.channels + channel_idx]
-        for last_position in range(mono_data_len - noise_duration_samples, mono_data_len):
-            for channel_idx in target_channel:
-                ndata[last_position * audio_data.channels + channel_idx] = 0
-        return ndata
+        """
+        Cut samples out of the audio data; the following samples move forward and the end is zero-padded.
+        :param target_sec: Time of the cut in seconds, or an array of times (on the original timeline)
+                           to cut many segments at once.
+        """
+        frames = audio_data.frames.copy(order='K')
+        _cut_frames(frames, _target_frames(audio_data.sample_rate, target_sec),
+                    target_channel, noise_duration_samples)
+        logger.info(f"  - Cut audio ({AudioNoise._describe(target_sec)}, {noise_duration_samples} samples)")
+        return frames
 
     @staticmethod
+    @_fused(_normal_noise_buffer)
     def normalized_noise(audio_data, noise_level: int = 1000):
         """Add normalized noise to the audio data."""
-        ndata = audio_data.data.copy().astype(np.float32)
+        ndata = audio_data.frames.astype(np.float32, order='K')
         noise = np.random.normal(0, noise_level, ndata.shape).astype(ndata.dtype)
-        ndata = np.clip(ndata + noise, audio_data.min_amp, audio_data.max_amp).astype(audio_data.data.dtype)
-        print(f"  - Add normalized noise (Level: {noise_level})")
+        ndata = np.clip(ndata + noise, audio_data.min_amp, audio_data.max_amp).astype(audio_data.dtype)
+        logger.info(f"  - Add normalized noise (Level: {noise_level})")
         return ndata
 
     @staticmethod
+    @_fused(_normal_noise_buffer)
     def gaussian_noise(audio_data, noise_level: int = 1000):
         """Add Gaussian noise to the audio data."""
-        ndata = audio_data.data.copy().astype(np.float32)
+        ndata = audio_data.frames.astype(np.float32, order='K')
         noise = np.random.normal(0, noise_level, ndata.shape).astype(ndata.dtype)
-        ndata = np.clip(ndata + noise, audio_data.min_amp, audio_data.max_amp).astype(audio_data.data.dtype)
-        print(f"  - Add Gaussian noise (Level: {noise_level})")
+        ndata = np.clip(ndata + noise, audio_data.min_amp, audio_data.max_amp).astype(audio_data.dtype)
+        logger.info(f"  - Add Gaussian noise (Level: {noise_level})")
         return ndata
 
+@functools.lru_cache(maxsize=256)
+def _design_sos(filter_type: str, order: int, cutoffs: tuple, sample_rate: int):
+    """Butterworth filter in second-order sections, cached by (type, order, cutoffs, rate).
+    Callers get the shared array, so they copy it (astype) before use."""
+    nyquist = 0.5 * sample_rate
+    normal_cutoff = [cutoff / nyquist for cutoff in cutoffs]
+    sos = butter(order, normal_cutoff if len(normal_cutoff) > 1 else normal_cutoff[0],
+                 btype=filter_type, analog=False, output='sos')
+    return sos
+
+
+class FilterStream:
+    """
+    Stateful Butterworth filter for block-by-block processing.
+    Blocks of (frames, channels) data are filtered with the state carried over,
+    so the concatenated output equals filtering the whole signal at once.
+    """
+    def __init__(self, filter_type: str, cutoffs, sample_rate: int, channels: int,
+                 order: int = 4, dtype=np.float64):
+        self.sos = _design_sos(filter_type, order, tuple(np.atleast_1d(cutoffs).tolist()), sample_rate).astype(dtype)
+        self.channels = channels
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.zi = np.zeros((len(self.sos), 2, self.channels), dtype=self.dtype)
+
+    def process(self, block: np.ndarray):
+        """Filter the next (frames, channels) block and return it as a float array."""
+        out, self.zi = sosfilt(self.sos, np.asarray(block, dtype=self.dtype), axis=0, zi=self.zi)
+        return out
+
+
+def _filter_buffer(filter_type: str, order: int, zero_phase: bool, cutoffs, buf, ctx):
+    if ctx.whole:
+        sos = _design_sos(filter_type, order, tuple(cutoffs), ctx.sample_rate).astype(buf.dtype)
+        return _clip((sosfiltfilt if zero_phase else sosfilt)(sos, buf, axis=0), ctx)
+    if zero_phase:
+        raise ValueError("zero-phase filters need the whole signal and cannot run block by block.")
+    if 'stream' not in ctx.state:
+        ctx.state['stream'] = FilterStream(filter_type, cutoffs, ctx.sample_rate, ctx.channels, order, buf.dtype)
+    return _clip(ctx.state['stream'].process(buf), ctx)
+
+
+def _freq_pass_buffer(buf, ctx, cutoff_freq: float, filter_type: str = 'low',
+                      order: int = 4, zero_phase: bool = False):
+    return _filter_buffer(filter_type, order, zero_phase, [cutoff_freq], buf, ctx)
+
+
+def _band_pass_buffer(buf, ctx, low_cutoff: float, high_cutoff: float,
+                      order: int = 4, zero_phase: bool = False):
+    return _filter_buffer('band', order, zero_phase, [low_cutoff, high_cutoff], buf, ctx)
+
+
+def _band_stop_buffer(buf, ctx, low_cutoff: float, high_cutoff: float,
+                      order: int = 4, zero_phase: bool = False):
+    return _filter_buffer('bandstop', order, zero_phase, [low_cutoff, high_cutoff], buf, ctx)
+
+
 class AudioFilter:
+    """AudioFilter class for applying Butterworth filters to audio data.
+    Filters are designed once per (type, order, cutoffs, rate) as second-order sections
+    and applied to all channels at once on a float working buffer.
+    """
     @staticmethod
-    def freq_pass_filter(audio_data, cutoff_freq: float, filter_type: str = 'low'):
+    def _filter(audio_data, filter_type: str, cutoffs, order: int = 4,
+                zero_phase: bool = False, dtype=np.float64):
+        sos = _design_sos(filter_type, order, tuple(cutoffs), audio_data.sample_rate).astype(dtype)
+        work = audio_data.frames.astype(dtype, order='K')
+        if zero_phase:
+            filtered = sosfiltfilt(sos, work, axis=0)
+        else:
+            filtered = sosfilt(sos, work, axis=0)
+        filtered = np.clip(filtered, audio_data.min_amp, audio_data.max_amp, out=filtered)
+        return filtered.astype(audio_data.dtype)
+
+    @staticmethod
+    @_fused(_freq_pass_buffer)
+    def freq_pass_filter(audio_data, cutoff_freq: float, filter_type: str = 'low',
+                         order: int = 4, zero_phase: bool = False):
         """Apply a pass filter to the audio data."""
-        nyquist = 0.5 * audio_data.sample_rate
-        normal_cutoff = cutoff_freq / nyquist
-        b, a = butter(4, normal_cutoff, btype=filter_type, analog=False)
-        deinterleaved_data = audio_data.data.reshape(-1, audio_data.channels)
-        filtered_deinterleaved = np.apply_along_axis(lambda x: lfilter(b, a, x), 0, deinterleaved_data)
-        print(f"  - {filter_type.capitalize()} filter applied (Cutoff frequency: {cutoff_freq}Hz)")
-        return filtered_deinterleaved.flatten().astype(audio_data.data.dtype)
+        ndata = AudioFilter._filter(audio_data, filter_type, [cutoff_freq], order, zero_phase)
+        logger.info(f"  - {filter_type.capitalize()} filter applied (Cutoff frequency: {cutoff_freq}Hz)")
+        return ndata
 
     @staticmethod
-    def band_pass_filter(audio_data, low_cutoff: float, high_cutoff: float):
+    @_fused(_band_pass_buffer)
+    def band_pass_filter(audio_data, low_cutoff: float, high_cutoff: float,
+                         order: int = 4, zero_phase: bool = False):
         """Apply a band-pass filter to the audio data."""
-        nyquist = 0.5 * audio_data.sample_rate
-        low = low_cutoff / nyquist
-        high = high_cutoff / nyquist
-        b, a = butter(4, [low, high], btype='band', analog=False)
-        deinterleaved_data = audio_data.data.reshape(-1, audio_data.channels)
-        filtered_deinterleaved = np.apply_along_axis(lambda x: lfilter(b, a, x), 0, deinterleaved_data)
-        print(f"  - Band-pass filter applied (Low: {low_cutoff}Hz, High: {high_cutoff}Hz)")
-        return filtered_deinterleaved.flatten().astype(audio_data.data.dtype)
+        ndata = AudioFilter._filter(audio_data, 'band', [low_cutoff, high_cutoff], order, zero_phase)
+        logger.info(f"  - Band-pass filter applied (Low: {low_cutoff}Hz, High: {high_cutoff}Hz)")
+        return ndata
 
     @staticmethod
-    def band_stop_filter(audio_data, low_cutoff: float, high_cutoff: float):
+    @_fused(_band_stop_buffer)
+    def band_stop_filter(audio_data, low_cutoff: float, high_cutoff: float,
+                         order: int = 4, zero_phase: bool = False):
         """Apply a band-stop filter to the audio data."""
-        nyquist = 0.5 * audio_data.sample_rate
-        low = low_cutoff / nyquist
-        high = high_cutoff / nyquist
-        b, a = butter(4, [low, high], btype='bandstop', analog=False)
-        deinterleaved_data = audio_data.data.reshape(-1, audio_data.channels)
-        filtered_deinterleaved = np.apply_along_axis(lambda x: lfilter(b, a, x), 0, deinterleaved_data)
-        print(f"  - Band-stop filter applied (Low: {low_cutoff}Hz, High: {high_cutoff}Hz)")
-        return filtered_deinterleaved.flatten().astype(audio_data.data.dtype)
\ No newline at end of file
+        ndata = AudioFilter._filter(audio_data, 'bandstop', [low_cutoff, high_cutoff], order, zero_phase)
+        logger.info(f"  - Band-stop filter applied (Low: {low_cutoff}Hz, High: {high_cutoff}Hz)")
+        return ndata
@@ -0,0 +1,86 @@
+import numpy as np
+from lib.Instrument import Instrument
+
+
+class EffectContext:
+    """
+    Information handed to the float working-buffer variant of an effect (`func.buffer_op`).
+    One context is kept per pipeline step, so `state` survives from one block to the next.
+    """
+    def __init__(self, audio_data, whole: bool):
+        self.sample_rate = audio_data.sample_rate
+        self.channels = audio_data.channels
+        self.min_amp = audio_data.min_amp
+        self.max_amp = audio_data.max_amp
+        self.n_frames = audio_data.n_frames
+        # first frame of the current block and whether the block is the whole signal
+        self.start = 0
+        self.whole = whole
+        self.state = {}
+
+
+class AudioPipeline:
+    """
+    Deferred chain of AudioData.apply steps.
+    Steps whose function has a `buffer_op` run on one float (frames, channels) working buffer,
+    in place where possible; every step clips like its eager variant, but quantization to the
+    integer sample type happens once at the end instead of after every step.
+    """
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, func, args, kwargs):
+        self.steps.append((func, args, kwargs))
+
+    def copy(self):
+        pipeline = AudioPipeline(self.dtype)
+        pipeline.steps = list(self.steps)
+        return pipeline
+
+    def _quantize(self, buf, audio_data):
+        np.clip(buf, audio_data.min_amp, audio_data.max_amp, out=buf)
+        return buf.astype(audio_data.dtype)
+
+    def _run_step(self, buf, audio_data, step, ctx):
+        func, args, kwargs = step
+        buffer_op = getattr(func, 'buffer_op', None)
+        if buffer_op is not None:
+            out = buffer_op(buf, ctx, *args, **kwargs)
+            return buf if out is None else out
+        if not ctx.whole:
+            raise ValueError(f"{func.__name__} has no buffer_op and cannot run block by block.")
+        # Plain function: hand it a quantized copy, like an eager apply
+        tmp = audio_data.__class__(
+            data=self._quantize(buf.copy(), audio_data),
+            sample_rate=audio_data.sample_rate,
+            sample_width=audio_data.sample_width,
+            channels=audio_data.channels,
+            layout=audio_data.layout
+        )
+        return np.asarray(func(tmp, *args, **kwargs)).reshape(buf.shape).astype(self.dtype)
+
+    def run(self, audio_data):
+        """Run all steps over the whole signal and return the quantized (frames, channels) samples."""
+        buf = audio_data.frames.astype(self.dtype, order='K')
+        for step in self.steps:
+            with Instrument.span(f'apply.{step[0].__name__}', nbytes=buf.nbytes, deferred=True):
+                buf = self._run_step(buf, audio_data, step, EffectContext(audio_data, whole=True))
+        return self._quantize(buf, audio_data)
+
+    def blocks(self, audio_data, block_frames: int):
+        """
+        Run all steps block by block with bounded memory.
+        :return: Generator of quantized (frames, channels) blocks.
+        """
+        frames = audio_data.frames
+        contexts = [EffectContext(audio_data, whole=False) for _ in self.steps]
+        for start in range(0, len(frames), block_frames):
+            buf = frames[start:start + block_frames].astype(self.dtype)
+            for step, ctx in zip(self.steps, contexts):
+                ctx.start = start
+                buf = self._run_step(buf, audio_data, step, ctx)
+            yield self._quantize(buf, audio_data)
@@ -0,0 +1,213 @@
+import logging
+import os
+import shutil
+import subprocess
+import numpy as np
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+# RIFF sizes are 32-bit; larger files keep the maximum, which AudioData reads as 'up to the end of the file'
+_MAX_CHUNK_SIZE = 0xFFFFFFFF
+_FORMATS = ('wav', 'flac')
+
+
+def _encode_pcm(frames: np.ndarray, sample_width: int):
+    """
+    Encode signed integer samples as interleaved little-endian PCM.
+    16/32-bit samples that already are C-contiguous little-endian are returned as is (no copy).
+    :return: Bytes-like object
+    """
+    if sample_width == 1:
+        # 8-bit WAV is unsigned
+        return (np.ascontiguousarray(frames, dtype=np.int8).view(np.uint8) ^ 0x80)
+    if sample_width == 3:
+        # keep the low 3 bytes of each little-endian int32
+        return np.ascontiguousarray(frames, dtype='<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return np.ascontiguousarray(frames, dtype={2: '<i2', 4: '<i4'}[sample_width])
+
+
+def _flac_command():
+    """Path of the `flac` encoder and whether it encodes with several threads (flac >= 1.5)."""
+    path = shutil.which('flac')
+    if path is None:
+        return None, False
+    try:
+        usage = subprocess.run([path, '--help'], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None, False
+    return path, '--threads' in usage
+
+
+class AudioWriter:
+    """
+    Streaming writer of WAV and FLAC files.
+    Samples are appended block by block and written in chunks of CHUNK_FRAMES, so neither the
+    whole signal nor a full-size byte copy of it is ever held in memory. 16/32-bit interleaved
+    samples are written straight from their buffer; 8-bit, 24-bit and planar samples are
+    converted one chunk at a time.
+
+    WAV files get their header first, with empty sizes, and the sizes are filled in at close,
+    so a file still being written can be followed (see AudioData.follow_file).
+    FLAC is encoded by the `flac` command line tool (on several threads if it supports them),
+    or by the soundfile package when the tool is not installed.
+
+    Usage:
+        with AudioWriter(path, 48000, 3, 2) as writer:
+            for block in blocks:
+                writer.write(block)
+    """
+    # Frames converted and written per chunk
+    CHUNK_FRAMES = 2 ** 16
+
+    def __init__(self, file_path: str, sample_rate: int, sample_width: int, channels: int,
+                 sample_format: str = 'pcm', file_format: str = None, threads: int = None,
+                 compression: int = 5):
+        """
+        :param file_path: Output file, its directory is created if needed.
+        :param sample_width: Bytes per sample (1-4).
+        :param sample_format: 'pcm' (signed integers) or 'float' (32-bit float WAV).
+        :param file_format: 'wav' or 'flac', from the file extension if None.
+        :param threads: Encoder threads of FLAC output, all CPUs if None.
+        :param compression: FLAC compression level (0-8).
+        """
+        file_format = file_format or ('flac' if file_path.lower().endswith('.flac') else 'wav')
+        if file_format not in _FORMATS:
+            raise ValueError(f"Unknown file format: {file_format}, expected one of {_FORMATS}")
+        if sample_format not in ('pcm', 'float'):
+            raise ValueError(f"Unknown sample format: {sample_format}, expected 'pcm' or 'float'")
+        if sample_format == 'float' and (sample_width != 4 or file_format != 'wav'):
+            raise ValueError("Float samples are written as 32-bit float WAV only")
+        if sample_width not in (1, 2, 3, 4):
+            raise ValueError(f"Unsupported sample width: {sample_width}")
+        self.path = file_path
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.sample_format = sample_format
+        self.file_format = file_format
+        self.threads = threads or os.cpu_count() or 1
+        self.compression = compression
+        self.n_frames = 0
+        self._file = None
+        self._process = None
+        self._sound_file = None
+
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if file_format == 'wav':
+            self._file = open(file_path, 'wb')
+            self._write_wav_header(0)
+        else:
+            self._open_flac()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _wav_header(self, data_size: int):
+        tag = _WAVE_FORMAT_IEEE_FLOAT if self.sample_format == 'float' else _WAVE_FORMAT_PCM
+        block_align = self.sample_width * self.channels
+        fmt = (tag.to_bytes(2, 'little') + self.channels.to_bytes(2, 'little') +
+               self.sample_rate.to_bytes(4, 'little') + (self.sample_rate * block_align).to_bytes(4, 'little') +
+               block_align.to_bytes(2, 'little') + (self.sample_width * 8).to_bytes(2, 'little'))
+        chunks = b'fmt ' + len(fmt).to_bytes(4, 'little') + fmt
+        if tag != _WAVE_FORMAT_PCM:
+            # non-PCM formats carry an (empty) extension size and a fact chunk with the frame count
+            chunks = b'fmt ' + (len(fmt) + 2).to_bytes(4, 'little') + fmt + b'\0\0'
+            chunks += b'fact' + (4).to_bytes(4, 'little') + min(self.n_frames, _MAX_CHUNK_SIZE).to_bytes(4, 'little')
+        riff_size = min(4 + len(chunks) + 8 + data_size + data_size % 2, _MAX_CHUNK_SIZE)
+        return (b'RIFF' + riff_size.to_bytes(4, 'little') + b'WAVE' + chunks +
+                b'data' + min(data_size, _MAX_CHUNK_SIZE).to_bytes(4, 'little'))
+
+    def _write_wav_header(self, data_size: int):
+        self._file.seek(0)
+        self._file.write(self._wav_header(data_size))
+
+    def _open_flac(self):
+        command, threaded = _flac_command()
+        if command is not None:
+            args = [command, '--silent', '--force', f'-{self.compression}', '--force-raw-format',
+                    '--endian=little', '--sign=signed', f'--channels={self.channels}',
+                    f'--bps={self.sample_width * 8}', f'--sample-rate={self.sample_rate}']
+            if threaded:
+                args.append(f'--threads={self.threads}')
+            self._process = subprocess.Popen(args + ['-o', self.path, '-'], stdin=subprocess.PIPE)
+            return
+        try:
+            import soundfile
+        except ImportError:
+            raise RuntimeError("FLAC output needs the `flac` command line tool or the soundfile package")
+        if self.sample_width == 4:
+            raise ValueError("soundfile writes FLAC with up to 24 bits per sample")
+        subtype = {1: 'PCM_S8', 2: 'PCM_16', 3: 'PCM_24'}[self.sample_width]
+        self._sound_file = soundfile.SoundFile(self.path, 'w', self.sample_rate, self.channels, subtype, format='FLAC')
+
+    def _encode(self, frames: np.ndarray):
+        if self.sample_format == 'float':
+            return np.ascontiguousarray(frames, dtype='<f4')
+        if self._process is not None and self.sample_width == 1:
+            # raw input of the flac tool is signed
+            return np.ascontiguousarray(frames, dtype=np.int8)
+        return _encode_pcm(frames, self.sample_width)
+
+    def write(self, block):
+        """
+        Append samples.
+        :param block: AudioData, or (frames, channels) / interleaved array of samples in the output format.
+        :return: self
+        """
+        frames = getattr(block, 'frames', block)
+        frames = np.asarray(frames)
+        if frames.ndim == 1:
+            frames = frames.reshape(-1, self.channels)
+        if frames.shape[1] != self.channels:
+            raise ValueError(f"Expected (frames, {self.channels}) samples, got shape {frames.shape}")
+        with Instrument.span('write', nbytes=len(frames) * self.channels * self.sample_width, path=self.path):
+            for start in range(0, len(frames), AudioWriter.CHUNK_FRAMES):
+                chunk = frames[start:start + AudioWriter.CHUNK_FRAMES]
+                if self._sound_file is not None:
+                    # soundfile scales int32 input from full scale down to the subtype
+                    self._sound_file.write(np.left_shift(chunk, 32 - self.sample_width * 8, dtype=np.int32))
+                elif self._process is not None:
+                    self._process.stdin.write(self._encode(chunk))
+                else:
+                    self._file.write(self._encode(chunk))
+        self.n_frames += len(frames)
+        return self
+
+    def close(self):
+        """Finish the file: fill in the WAV sizes, or wait for the FLAC encoder."""
+        if self._file is not None:
+            data_size = self.n_frames * self.sample_width * self.channels
+            if data_size % 2:
+                self._file.write(b'\0')
+            self._write_wav_header(data_size)
+            self._file.close()
+            self._file = None
+        if self._process is not None:
+            self._process.stdin.close()
+            returncode = self._process.wait()
+            self._process = None
+            if returncode:
+                raise RuntimeError(f"flac exited with {returncode} writing {self.path}")
+        if self._sound_file is not None:
+            self._sound_file.close()
+            self._sound_file = None
+
+    @staticmethod
+    def save(file_path: str, blocks, sample_rate: int, sample_width: int, channels: int, **kwargs):
+        """
+        Write an iterable of blocks to a file.
+        :param kwargs: AudioWriter parameters (sample_format, file_format, threads, compression).
+        :return: Number of frames written
+        """
+        with AudioWriter(file_path, sample_rate, sample_width, channels, **kwargs) as writer:
+            for block in blocks:
+                writer.write(block)
+        logger.info(f"Saved file: {file_path} ({writer.n_frames} frames)")
+        return writer.n_frames
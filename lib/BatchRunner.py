@@ -0,0 +1,219 @@
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import numpy as np
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.ResultCache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+# Metrics written as CSV columns, in order
+CSV_METRICS = ['lag_samples', 'peak_cross_correlation', 'mean_squared_error', 'average_spectral_coherence',
+               'snr_db', 'thd_n_db', 'dc_offset', 'clipping_ratio']
+
+
+def _share(audio: AudioData):
+    """Copy audio into shared memory as planar (channels, frames) samples."""
+    frames = audio.frames
+    shape = (audio.channels, len(frames))
+    shm = shared_memory.SharedMemory(create=True, size=max(1, frames.nbytes))
+    planar = np.ndarray(shape, dtype=frames.dtype, buffer=shm.buf)
+    planar[:] = frames.T
+    return shm, (shm.name, shape, frames.dtype.str)
+
+
+def _attach(desc):
+    """Attach to shared audio created by _share; the parent keeps ownership and unlinks it."""
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _evaluate_shared_channel(orig_desc, rec_desc, ch: int, rate: int, max_lag: int = None, full_scale: float = None):
+    """Worker: evaluate one channel of a pair held in shared memory."""
+    orig_shm, orig = _attach(orig_desc)
+    rec_shm, rec = _attach(rec_desc)
+    try:
+        orig_ch_data = orig[ch].astype(np.float64)
+        rec_ch_data = rec[ch].astype(np.float64)
+    finally:
+        # Drop the views before closing the mappings
+        del orig, rec
+        orig_shm.close()
+        rec_shm.close()
+    metrics = AudioEvaluator.evaluate_channel(orig_ch_data, rec_ch_data, rate, max_lag, full_scale=full_scale)
+    return {key: value.item() if isinstance(value, np.generic) else value for key, value in metrics.items()}
+
+
+class BatchRunner:
+    """
+    BatchRunner class for evaluating many original/recorded pairs in parallel.
+    Pairs are read from a manifest, every channel of every pair is evaluated in a process pool,
+    and results are appended to a JSON Lines or CSV file as soon as a pair is finished.
+    Results of pairs whose files did not change since an earlier run are taken from the ResultCache.
+    """
+
+    @staticmethod
+    def read_manifest(manifest_path: str):
+        """
+        Read the list of pairs to evaluate.
+        A `.jsonl` manifest holds one {"input": ..., "output": ..., "id": ...} object per line,
+        any other file is read as CSV with `input`, `output` and optional `id` columns.
+        Relative paths are resolved against the manifest directory.
+
+        Returns:
+            List[dict]: pairs with 'id', 'input' and 'output' keys
+        """
+        base_dir = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path, newline='') as f:
+            if manifest_path.endswith('.jsonl'):
+                rows = [json.loads(line) for line in f if line.strip()]
+            else:
+                rows = list(csv.DictReader(f))
+
+        pairs = []
+        for idx, row in enumerate(rows):
+            if not row.get('input') or not row.get('output'):
+                raise ValueError(f"Manifest entry {idx} needs 'input' and 'output': {row}")
+            pairs.append({
+                'id': row.get('id') or str(idx),
+                'input': os.path.join(base_dir, row['input']),
+                'output': os.path.join(base_dir, row['output']),
+            })
+        return pairs
+
+    @staticmethod
+    def _write_result(writer, result_file, is_csv: bool, result: dict):
+        if is_csv:
+            base = [result['id'], result['input'], result['output']]
+            if result['status'] != 'ok':
+                writer.writerow(base + ['', result['status'], result['error']] + [''] * len(CSV_METRICS))
+            for ch, metrics in result.get('results', {}).items():
+                writer.writerow(base + [ch.split('_')[-1], result['status'], ''] +
+                                [metrics.get(key, '') for key in CSV_METRICS])
+        else:
+            result_file.write(json.dumps(ResultCache.plain_json(result), allow_nan=False) + '\n')
+        result_file.flush()
+
+    @staticmethod
+    def run(manifest_path: str, result_path: str, workers: int = None, max_lag: int = None):
+        """
+        Evaluate every pair of a manifest and write the results incrementally.
+        A pair that fails to load or evaluate is reported with status 'error' and does not stop the run.
+
+        Args:
+            manifest_path (str): Manifest listing the pairs (see read_manifest).
+            result_path (str): `.csv` for one row per channel, otherwise JSON Lines with one object per pair.
+            workers (int): Number of worker processes, all CPUs if None.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+
+        Returns:
+            Tuple[int, int]: number of pairs evaluated successfully and number of failed pairs
+        """
+        pairs = BatchRunner.read_manifest(manifest_path)
+        workers = workers or os.cpu_count() or 1
+        # Bound the shared memory held by pairs waiting for workers
+        max_pending_pairs = 2 * workers
+        logger.info(f"[BatchRunner] Evaluate {len(pairs)} pairs with {workers} workers -> {result_path}")
+
+        result_dir = os.path.dirname(result_path)
+        if result_dir:
+            os.makedirs(result_dir, exist_ok=True)
+        is_csv = result_path.endswith('.csv')
+        n_ok, n_failed, n_cached = 0, 0, 0
+        started = time.perf_counter()
+
+        with open(result_path, 'w', newline='') as result_file, \
+                ProcessPoolExecutor(max_workers=workers) as pool:
+            writer = csv.writer(result_file) if is_csv else None
+            if is_csv:
+                writer.writerow(['id', 'input', 'output', 'channel', 'status', 'error'] + CSV_METRICS)
+            futures = {}
+            active = []
+
+            def finish(job):
+                nonlocal n_ok, n_failed, n_cached
+                for shm in job['shms']:
+                    shm.close()
+                    shm.unlink()
+                result = {
+                    'id': job['id'], 'input': job['input'], 'output': job['output'],
+                    'status': 'ok' if job['error'] is None else 'error',
+                    'error': job['error'],
+                    'elapsed_sec': time.perf_counter() - job['started'],
+                    'results': {f'channel_{ch}': job['results'][ch] for ch in sorted(job['results'])},
+                    'cached': job['cached'],
+                }
+                if job['error'] is None:
+                    n_ok += 1
+                    if job['cached']:
+                        n_cached += 1
+                    elif job['key'] is not None:
+                        ResultCache.put(job['key'], result['results'])
+                else:
+                    n_failed += 1
+                    logger.warning(f"  - Failed {job['id']}: {job['error']}")
+                BatchRunner._write_result(writer, result_file, is_csv, result)
+
+            def collect(done):
+                for future in done:
+                    job, ch = futures.pop(future)
+                    try:
+                        job['results'][ch] = future.result()
+                    except Exception as e:
+                        job['error'] = job['error'] or f"channel {ch}: {type(e).__name__}: {e}"
+                    job['remaining'] -= 1
+                    if job['remaining'] == 0:
+                        active.remove(job)
+                        finish(job)
+
+            for pair in pairs:
+                while len(active) >= max_pending_pairs:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                job = dict(pair, shms=[], results={}, error=None, remaining=0, started=time.perf_counter(),
+                           key=None, cached=False)
+                try:
+                    job['key'] = ResultCache.evaluate_key([ResultCache.file_hash(pair['input']),
+                                                           ResultCache.file_hash(pair['output'])], max_lag)
+                    cached = ResultCache.get(job['key'])
+                    if cached is not None:
+                        job['results'] = {int(ch.split('_')[-1]): metrics for ch, metrics in cached.items()}
+                        job['cached'] = True
+                        finish(job)
+                        continue
+                    original = AudioData.from_file(pair['input'])
+                    recorded = AudioData.from_file(pair['output'])
+                    if original.channels != recorded.channels:
+                        raise ValueError("channels of original and recorded audio must match.")
+                    rate, channels, full_scale = original.sample_rate, original.channels, recorded.max_amp
+                    orig_shm, orig_desc = _share(original)
+                    job['shms'].append(orig_shm)
+                    rec_shm, rec_desc = _share(recorded)
+                    job['shms'].append(rec_shm)
+                    del original, recorded
+                    for ch in range(channels):
+                        future = pool.submit(_evaluate_shared_channel, orig_desc, rec_desc, ch, rate, max_lag,
+                                             full_scale)
+                        futures[future] = (job, ch)
+                        job['remaining'] += 1
+                except Exception as e:
+                    job['error'] = f"{type(e).__name__}: {e}"
+                if job['remaining'] == 0:
+                    finish(job)
+                else:
+                    active.append(job)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"[BatchRunner] Done: {n_ok} ok ({n_cached} cached), {n_failed} failed in {elapsed:.1f}s")
+        return n_ok, n_failed
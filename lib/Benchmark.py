@@ -0,0 +1,238 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy
+from scipy.signal import coherence
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.AudioFilter import AudioFilter, AudioNoise
+from lib.EventDetector import EventDetector
+from lib.Stimulus import Stimulus
+from lib.Visualizer import Visualizer
+
+logger = logging.getLogger(__name__)
+
+# Lag of the synthetic recording in samples
+BENCH_LAG = 480
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the library log while stages run, so its I/O is not timed."""
+    previous = logging.root.manager.disable
+    logging.disable(logging.INFO)
+    try:
+        yield
+    finally:
+        logging.disable(previous)
+
+
+def _load(case):
+    AudioData.from_file(case['input_path'])
+
+
+def _load_read(case):
+    # memory-mapped loading is lazy, this also pages every sample in
+    np.sum(AudioData.from_file(case['input_path']).frames, dtype=np.int64)
+
+
+def _pop_noise(case):
+    AudioNoise.pop_noise(case['orig'], target_sec=np.linspace(0, case['duration'] * 0.9, 100))
+
+
+def _cut_noise(case):
+    AudioNoise.cut_noise(case['orig'], target_sec=np.linspace(0, case['duration'] * 0.9, 100),
+                         target_channel=list(range(case['orig'].channels)))
+
+
+def _normalized_noise(case):
+    AudioNoise.normalized_noise(case['orig'], noise_level=case['orig'].max_amp * 0.02)
+
+
+def _band_pass(case):
+    AudioFilter.band_pass_filter(case['orig'], low_cutoff=100, high_cutoff=2000)
+
+
+def _align(case):
+    AudioEvaluator._align_and_truncate(case['orig_ch'], case['rec_ch'], case['orig'].sample_rate)
+
+
+def _coherence(case):
+    coherence(case['orig_ch'], case['rec_ch'], fs=case['orig'].sample_rate, nperseg=2048)
+
+
+def _evaluate(case):
+    AudioEvaluator.evaluate(case['orig'], case['rec'])
+
+
+def _events(case):
+    EventDetector.detect(case['orig'], case['rec'], max_lag=2 * BENCH_LAG)
+
+
+def _plot(case):
+    Visualizer.plot_audio_data(os.path.join(case['workdir'], 'plot.png'), case['orig'], case['rec'])
+
+
+# stage name -> function(case)
+STAGES = {
+    'load': _load,
+    'load_read': _load_read,
+    'pop_noise': _pop_noise,
+    'cut_noise': _cut_noise,
+    'normalized_noise': _normalized_noise,
+    'band_pass_filter': _band_pass,
+    'align': _align,
+    'coherence': _coherence,
+    'evaluate': _evaluate,
+    'events': _events,
+    'plot': _plot,
+}
+
+
+class Benchmark:
+    """
+    Benchmark class for timing the hot paths of the tool on synthetic inputs.
+    Every stage runs over a matrix of durations, channel counts, sample widths and rates,
+    with warmup runs, repeated timings and the peak traced allocation of one extra run.
+    Results are written as JSON and can be compared against a saved baseline.
+    """
+
+    @staticmethod
+    def _make_case(workdir: str, duration: float, channels: int, width: int, rate: int):
+        orig = Stimulus.generate('multi_sine', duration, rate=rate, width=width, channels=channels,
+                                 cache=False, freqs=[110, 440, 1000, 3500, 9000])
+        orig = orig.copy()
+        # recording: delayed and noisy copy of the original
+        rec_frames = np.roll(orig.frames, BENCH_LAG, axis=0)
+        rec = AudioData(rec_frames, rate, width, channels)
+        rec.frames = AudioNoise.normalized_noise(rec, noise_level=rec.max_amp * 0.01)
+        input_path = os.path.join(workdir, 'input.wav')
+        orig.save(input_path)
+        return {
+            'workdir': workdir, 'duration': duration, 'input_path': input_path,
+            'orig': orig, 'rec': rec,
+            'orig_ch': orig.float_channel(0, np.float64),
+            'rec_ch': rec.float_channel(0, np.float64),
+        }
+
+    @staticmethod
+    def _time_stage(func, case, repeat: int, warmup: int):
+        for _ in range(warmup):
+            func(case)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func(case)
+            timings.append(time.perf_counter() - started)
+        # peak memory is measured on a separate run, tracing slows the stage down
+        # (tracing may already run for the instrumentation, then it is left running)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func(case)
+            peak = tracemalloc.get_traced_memory()[1] - start
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        return timings, peak
+
+    @staticmethod
+    def run(durations=(1, 10), channels=(2,), widths=(2, 4), rates=(48000,),
+            stages=None, repeat: int = 3, warmup: int = 1):
+        """
+        Run the benchmark matrix.
+
+        Args:
+            durations, channels, widths, rates: Values of the input matrix.
+            stages (List[str]): Stages to run, all of STAGES if None.
+            repeat (int): Timed runs per stage.
+            warmup (int): Untimed runs before the timed ones.
+
+        Returns:
+            dict: {'meta': ..., 'results': [one entry per stage and input]}
+        """
+        stages = stages or list(STAGES)
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown benchmark stages: {sorted(unknown)}")
+
+        results = []
+        logger.info(f"[Benchmark] {len(stages)} stages, repeat {repeat}, warmup {warmup}")
+        with tempfile.TemporaryDirectory() as workdir:
+            for duration, n_ch, width, rate in itertools.product(durations, channels, widths, rates):
+                with _quiet():
+                    case = Benchmark._make_case(workdir, duration, n_ch, width, rate)
+                for stage in stages:
+                    with _quiet():
+                        timings, peak = Benchmark._time_stage(STAGES[stage], case, repeat, warmup)
+                    median = statistics.median(timings)
+                    entry = {
+                        'stage': stage, 'duration': duration, 'channels': n_ch, 'width': width, 'rate': rate,
+                        'median_sec': median, 'min_sec': min(timings), 'mean_sec': statistics.mean(timings),
+                        'repeat': repeat, 'peak_mem_bytes': peak,
+                        'frames_per_sec': duration * rate / median if median > 0 else None,
+                    }
+                    results.append(entry)
+                    logger.info(f"  - {stage:<18} {duration:>6}s {n_ch}ch {width * 8}bit {rate}Hz: "
+                                f"{median * 1000:10.2f} ms, peak {peak / 2 ** 20:8.1f} MiB")
+
+        meta = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        }
+        return {'meta': meta, 'results': results}
+
+    @staticmethod
+    def save(report: dict, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Saved benchmark: {path}")
+
+    @staticmethod
+    def compare(report: dict, baseline_path: str, threshold: float = 0.2, min_delta_sec: float = 0.001):
+        """
+        Compare median timings with a saved baseline report.
+        A stage regresses when it is more than `threshold` (relative) and `min_delta_sec`
+        (absolute) slower than the baseline entry with the same stage and input.
+
+        Returns:
+            List[dict]: regressed entries with their baseline timing and ratio
+        """
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        def key(entry):
+            return (entry['stage'], entry['duration'], entry['channels'], entry['width'], entry['rate'])
+        base = {key(entry): entry for entry in baseline['results']}
+
+        regressions = []
+        logger.info(f"[Benchmark] Compare with baseline {baseline_path} (threshold {threshold:.0%})")
+        for entry in report['results']:
+            old = base.get(key(entry))
+            if old is None:
+                continue
+            ratio = entry['median_sec'] / old['median_sec'] if old['median_sec'] > 0 else float('inf')
+            regressed = ratio > 1 + threshold and entry['median_sec'] - old['median_sec'] > min_delta_sec
+            mark = 'REGRESSION' if regressed else 'ok'
+            logger.info(f"  - {entry['stage']:<18} {entry['duration']:>6}s {entry['channels']}ch "
+                        f"{entry['width'] * 8}bit {entry['rate']}Hz: x{ratio:.2f} {mark}")
+            if regressed:
+                regressions.append(dict(entry, baseline_median_sec=old['median_sec'], ratio=ratio))
+        return regressions
@@ -0,0 +1,222 @@
+import logging
+import numpy as np
+import scipy.fft
+from lib.AudioEvaluator import AudioEvaluator
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+# Taps of the interpolation kernel and phases of the polyphase filter bank
+RESAMPLE_TAPS = 32
+RESAMPLE_PHASES = 1024
+# Kaiser window shape and cutoff (relative to Nyquist) of the interpolation kernel
+RESAMPLE_BETA = 8.0
+RESAMPLE_CUTOFF = 0.9
+
+
+def _kernel_bank(taps: int = RESAMPLE_TAPS, phases: int = RESAMPLE_PHASES):
+    """
+    Polyphase bank of windowed-sinc fractional delay filters.
+    Row p interpolates at fraction p / phases past the sample `taps // 2 - 1` of its window.
+    """
+    half = taps // 2
+    # distance of every tap from the interpolated position
+    x = np.arange(-half + 1, half + 1)[None, :] - (np.arange(phases) / phases)[:, None]
+    window = np.i0(RESAMPLE_BETA * np.sqrt(np.clip(1 - (x / half) ** 2, 0, None))) / np.i0(RESAMPLE_BETA)
+    bank = RESAMPLE_CUTOFF * np.sinc(RESAMPLE_CUTOFF * x) * window
+    # unity gain at DC for every phase
+    return bank / bank.sum(axis=1, keepdims=True)
+
+
+def _local_energy(data: np.ndarray, length: int):
+    """Centered energy of every window of `length` samples."""
+    cum = np.concatenate(([0.0], np.cumsum(data)))
+    cum2 = np.concatenate(([0.0], np.cumsum(data * data)))
+    sums = cum[length:] - cum[:-length]
+    return np.maximum(cum2[length:] - cum2[:-length] - sums * sums / length, 0.0)
+
+
+class DriftTracker:
+    """
+    Lag tracking of long recordings whose clock drifts against the original.
+    A constant lag is only right for a while: DAC and ADC clocks differ by tens of ppm, so
+    the recording slides by a few samples per minute. The lag is tracked segment by segment
+    with a short windowed FFT correlation, first around the lag of the whole recording and
+    then, for segments the drift has carried out of that window, around the lag of the nearest
+    tracked segment with a window widened by the drift possible in between. A line is
+    fitted to the lags (the slope is the drift), and the recording is resampled onto the
+    timeline of the original with a polyphase windowed-sinc interpolator before metrics are
+    computed. Every step costs a fixed amount per segment, so time grows linearly with the
+    duration.
+    """
+    # Length of a tracked segment in samples
+    SEGMENT = 2 ** 15
+    # Lags searched on each side of the seed lag
+    SEARCH = 256
+    # Largest drift followed from a tracked segment, widening the search with the distance to it
+    MAX_DRIFT_PPM = 1000
+    # Segments correlating less than this are not tracked (silence, noise, defects)
+    MIN_CORRELATION = 0.5
+    # Total fitted drift over the recording, in samples, below which it is not resampled
+    MIN_DRIFT_SAMPLES = 0.5
+    # Lags further than this from the first fit are left out of the second one
+    OUTLIER_SAMPLES = 2.0
+    # Output samples interpolated at a time
+    CHUNK = 2 ** 15
+
+    @staticmethod
+    def _segment_lag(orig_data: np.ndarray, segment: np.ndarray, start: int, seed: float, search: int):
+        """
+        Lag of one recorded segment, searched within `search` samples of `seed`.
+
+        Returns:
+            Tuple[float, float]: sub-sample lag and normalized peak correlation (None if the segment is silent)
+        """
+        segment = segment - segment.mean()
+        seg_energy = float(np.dot(segment, segment))
+        lo = max(start + int(round(seed)) - search, 0)
+        hi = min(start + int(round(seed)) + search + len(segment), len(orig_data))
+        if seg_energy == 0 or hi - lo < len(segment) + 2:
+            return None, None
+        window = orig_data[lo:hi]
+        nfft = scipy.fft.next_fast_len(len(window) + len(segment) - 1, real=True)
+        circular = scipy.fft.irfft(scipy.fft.rfft(window, nfft) * scipy.fft.rfft(segment, nfft).conj(), nfft)
+        # correlation of the segment with every full window of the original
+        correlation = circular[:len(window) - len(segment) + 1]
+        denom = np.sqrt(_local_energy(window, len(segment)) * seg_energy)
+        correlation = np.divide(correlation, denom, out=np.zeros_like(correlation), where=denom > 0)
+        peak = int(np.argmax(correlation))
+        offset = 0.0
+        if 0 < peak < len(correlation) - 1:
+            offset = AudioEvaluator._parabolic_offset(*correlation[peak - 1:peak + 2])
+        return lo + peak + offset - start, float(correlation[peak])
+
+    @staticmethod
+    def _tracked_lag(orig_data: np.ndarray, rec_data: np.ndarray, start: int, seed: float, search: int):
+        """Lag and correlation of the segment at `start`, None if it correlates too little to be tracked."""
+        segment_lag, correlation = DriftTracker._segment_lag(
+            orig_data, rec_data[start:start + DriftTracker.SEGMENT], start, seed, search)
+        if correlation is None or correlation < DriftTracker.MIN_CORRELATION:
+            return None
+        return segment_lag, correlation
+
+    @staticmethod
+    def track(orig_data: np.ndarray, rec_data: np.ndarray, rate: int, max_lag: int = None):
+        """
+        Track the lag along the recording and fit the drift.
+
+        Args:
+            orig_data (np.ndarray): Original channel data (float).
+            rec_data (np.ndarray): Recorded channel data (float).
+            rate (int): Sample rate of the audio data.
+            max_lag (int): Largest absolute lag of the initial search in samples, the whole range if None.
+
+        Returns:
+            dict: 'lag' (fitted lag at the first recorded sample), 'slope' (lag change per recorded
+            sample), 'drift_ppm', 'peak_correlation' (of the initial search) and 'curve', the tracked
+            lags as a list of {'time_sec', 'lag_samples', 'correlation'} at segment centers
+        """
+        with Instrument.span('correlation', nbytes=orig_data.nbytes + rec_data.nbytes):
+            lag, peak_corr = AudioEvaluator._find_lag(orig_data, rec_data, max_lag)
+        starts = range(0, len(rec_data) - DriftTracker.SEGMENT + 1, DriftTracker.SEGMENT)
+        tracked = {}
+        with Instrument.span('drift.track', nbytes=rec_data.nbytes, segment=DriftTracker.SEGMENT):
+            # 1. segments still near the lag of the whole recording
+            for start in starts:
+                found = DriftTracker._tracked_lag(orig_data, rec_data, start, float(lag), DriftTracker.SEARCH)
+                if found:
+                    tracked[start] = found
+            # 2. follow the drift from the tracked segments into the others, forwards then backwards
+            for order in (starts, reversed(starts)):
+                seed = None
+                for start in order:
+                    if start in tracked:
+                        seed = (start, tracked[start][0])
+                        continue
+                    if seed is None:
+                        continue
+                    search = DriftTracker.SEARCH + int(DriftTracker.MAX_DRIFT_PPM * 1e-6 * abs(start - seed[0]))
+                    found = DriftTracker._tracked_lag(orig_data, rec_data, start, seed[1], search)
+                    if found:
+                        tracked[start] = found
+                        seed = (start, found[0])
+        curve = [{'time_sec': (start + DriftTracker.SEGMENT / 2) / rate, 'lag_samples': segment_lag,
+                  'correlation': correlation} for start, (segment_lag, correlation) in sorted(tracked.items())]
+
+        intercept, slope = float(lag), 0.0
+        if len(curve) >= 2:
+            centers = np.array([point['time_sec'] for point in curve]) * rate
+            lags = np.array([point['lag_samples'] for point in curve])
+            slope, intercept = np.polyfit(centers, lags, 1)
+            # refit without segments that locked onto a wrong peak
+            inliers = np.abs(lags - (intercept + slope * centers)) <= DriftTracker.OUTLIER_SAMPLES
+            if 2 <= np.count_nonzero(inliers) < len(lags):
+                slope, intercept = np.polyfit(centers[inliers], lags[inliers], 1)
+        drift_ppm = float(slope) * 1e6
+        logger.info(f"  - Tracked {len(curve)} segments, drift {drift_ppm:+.2f} ppm, "
+                    f"lag {intercept:.2f} -> {intercept + slope * len(rec_data):.2f} samples")
+        return {'lag': float(intercept), 'slope': float(slope), 'drift_ppm': drift_ppm,
+                'peak_correlation': peak_corr, 'curve': curve}
+
+    @staticmethod
+    def resample(rec_data: np.ndarray, positions: np.ndarray):
+        """
+        Interpolate a signal at fractional positions with the polyphase filter bank.
+
+        Args:
+            rec_data (np.ndarray): Signal to interpolate, at least RESAMPLE_TAPS samples.
+            positions (np.ndarray): Fractional sample positions at least RESAMPLE_TAPS / 2 samples
+                from the ends of the signal (closer ones are interpolated from the outermost taps).
+
+        Returns:
+            np.ndarray: interpolated samples (float64)
+        """
+        bank = _kernel_bank()
+        # the taps of output sample i are row `first[i]` of a strided view of the signal
+        windows = np.lib.stride_tricks.sliding_window_view(rec_data, RESAMPLE_TAPS)
+        out = np.empty(len(positions))
+        with Instrument.span('drift.resample', nbytes=out.nbytes, taps=RESAMPLE_TAPS):
+            for i in range(0, len(positions), DriftTracker.CHUNK):
+                pos = positions[i:i + DriftTracker.CHUNK]
+                base = np.floor(pos)
+                phase = np.minimum(np.round((pos - base) * RESAMPLE_PHASES).astype(np.int64), RESAMPLE_PHASES - 1)
+                first = np.clip(base.astype(np.int64) - (RESAMPLE_TAPS // 2 - 1), 0, len(windows) - 1)
+                out[i:i + len(pos)] = np.einsum('ij,ij->i', bank[phase], windows[first])
+        return out
+
+    @staticmethod
+    def negligible(track: dict, n_frames: int):
+        """Whether the fitted drift adds up to less than MIN_DRIFT_SAMPLES over `n_frames` recorded samples."""
+        return abs(track['slope']) * n_frames < DriftTracker.MIN_DRIFT_SAMPLES
+
+    @staticmethod
+    def constant_lag(track: dict, n_frames: int):
+        """Fitted lag at the middle of the recording, the constant lag that fits all of it best."""
+        return track['lag'] + track['slope'] * n_frames / 2
+
+    @staticmethod
+    def compensate(orig_data: np.ndarray, rec_data: np.ndarray, track: dict):
+        """
+        Align the signals with the tracked drift.
+        Recorded sample i lines up with original sample lag + (1 + slope) * i. When the drift adds
+        up to less than MIN_DRIFT_SAMPLES over the recording, the signals are aligned at the fitted
+        lag of the middle of the recording, like AudioEvaluator._aligned.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, int, int]: aligned original, recording resampled onto
+            the original's timeline, start of the aligned part in the original and in the recording
+        """
+        lag, slope = track['lag'], track['slope']
+        if DriftTracker.negligible(track, len(rec_data)):
+            lag_int = int(round(DriftTracker.constant_lag(track, len(rec_data))))
+            aligned_orig, aligned_rec, orig_start = AudioEvaluator._aligned(orig_data, rec_data, lag_int)
+            return aligned_orig, aligned_rec, orig_start, max(-lag_int, 0)
+        # original samples whose recorded position has all interpolation taps within the recording
+        half = RESAMPLE_TAPS // 2
+        first = max(int(np.ceil(lag + (1 + slope) * (half - 1))), 0)
+        last = min(int(np.floor(lag + (1 + slope) * (len(rec_data) - 1 - half))), len(orig_data) - 1)
+        if last < first:
+            return orig_data[:0], rec_data[:0].astype(np.float64), first, 0
+        positions = (np.arange(first, last + 1) - lag) / (1 + slope)
+        aligned_rec = DriftTracker.resample(rec_data, positions)
+        return orig_data[first:last + 1], aligned_rec, first, int(round(positions[0]))
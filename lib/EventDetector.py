@@ -0,0 +1,315 @@
+import collections
+import logging
+import numpy as np
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+# Event types, in reporting order
+EVENT_TYPES = ['pop', 'dropout', 'cut', 'dc_step', 'clipping']
+# Events of these types add up their severity when merged, the others keep the largest
+_SUMMED = {'clipping'}
+# Events located at one block boundary; nearby ones are the same step seen from two chunks
+_STEPS = {'cut', 'dc_step'}
+
+
+def _runs(index: np.ndarray, max_gap: int = 0):
+    """
+    Start and end (exclusive) of the runs of consecutive sorted indices (e.g. of np.flatnonzero(mask)),
+    runs at most `max_gap` apart joined, and the number of indices in each run.
+    """
+    if len(index) == 0:
+        return index, index, index
+    breaks = np.flatnonzero(np.diff(index) > max_gap + 1)
+    first = np.concatenate(([0], breaks + 1))
+    last = np.concatenate((breaks, [len(index) - 1]))
+    return index[first], index[last] + 1, last - first + 1
+
+
+def _block_means(data: np.ndarray, block: int):
+    """Means of consecutive blocks (the last one may be shorter)."""
+    n_full = len(data) // block
+    means = data[:n_full * block].reshape(n_full, block).mean(axis=1)
+    if len(data) > n_full * block:
+        means = np.append(means, data[n_full * block:].mean())
+    return means
+
+
+def _window_mean(values: np.ndarray, k: int):
+    """Mean of every value with its `k` neighbours on each side (fewer at the ends)."""
+    cum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(len(values))
+    lo, hi = np.maximum(idx - k, 0), np.minimum(idx + k + 1, len(values))
+    return (cum[hi] - cum[lo]) / (hi - lo)
+
+
+def _side_means(values: np.ndarray, k: int):
+    """Mean of the `k` values before and of the `k` values from each boundary i = k..len - k."""
+    cum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(k, len(values) - k + 1)
+    return (cum[idx] - cum[idx - k]) / k, (cum[idx + k] - cum[idx]) / k
+
+
+class EventDetector:
+    """
+    Detector of short defects in a recording: pops, dropouts, cuts, DC steps and clipping runs.
+    Works on the aligned residual (recorded - original) and the recorded signal with
+    vectorized block statistics (strided block means, cumulative sums over blocks), chunk by
+    chunk, so time and memory grow linearly with the length and any length can be scanned.
+
+    Every event is a dict with 'type', 'channel', 'start_sec', 'end_sec' (in the timeline of the
+    recording), 'lag_samples' (original frame = recorded frame + lag) and 'severity':
+      - pop: peak of the residual derivative over its local level (dB)
+      - dropout: level of the original lost in the flat part of the recording (dBFS)
+      - cut: jump of the residual level where the recording loses sync (dB)
+      - dc_step: size of the step of the residual mean (dBFS)
+      - clipping: number of samples at full scale
+    """
+    # Samples per processing chunk, a multiple of BLOCK
+    CHUNK = 2 ** 22
+    # Samples per block of the block statistics
+    BLOCK = 256
+    # Runs closer than this many samples are one event
+    MERGE_GAP = 32
+
+    # A pop: residual derivative POP_RATIO times above its level over POP_CONTEXT blocks each side
+    POP_RATIO = 10.0
+    POP_CONTEXT = 8
+    # Smallest pop (and cut, DC step) reported, relative to full scale
+    LEVEL_FLOOR = 0.01
+    # A dropout: at least this many equal recorded samples while the original is not silent
+    DROPOUT_MIN_SAMPLES = 64
+    # Blocks on each side compared for cuts and DC steps
+    STEP_BLOCKS = 8
+    # A cut: residual level rising by this much
+    CUT_STEP_DB = 20.0
+    # A DC step: residual mean moving by this many times the spread of the block means
+    DC_STEP_RATIO = 4.0
+    # Samples within this fraction of full scale count as clipped
+    CLIP_TOLERANCE = 1e-3
+    CLIP_MIN_SAMPLES = 3
+
+    @staticmethod
+    def _chunk_events(o: np.ndarray, r: np.ndarray, core: slice, clip_level: float, types):
+        """
+        Raw events of one chunk of normalized signals, as (type, start, end, severity) in chunk samples.
+        Statistics use the margin around `core`, events are only taken inside it.
+        """
+        B = EventDetector.BLOCK
+        events = []
+        res = r - o
+
+        def flagged(mask):
+            # flagged samples inside the core
+            return core.start + np.flatnonzero(mask[core])
+
+        if 'pop' in types:
+            d = np.abs(np.diff(res, prepend=res[:1]))
+            level = np.sqrt(_window_mean(_block_means(d * d, B), EventDetector.POP_CONTEXT))
+            level = np.maximum(level, EventDetector.LEVEL_FLOOR / EventDetector.POP_RATIO)
+            # compare block by block against the threshold of the block, without a per-sample level
+            n_full = len(d) // B
+            threshold = EventDetector.POP_RATIO * level
+            mask = np.empty(len(d), dtype=bool)
+            mask[:n_full * B] = (d[:n_full * B].reshape(n_full, B) > threshold[:n_full, None]).ravel()
+            mask[n_full * B:] = d[n_full * B:] > threshold[-1]
+            starts, ends, _ = _runs(flagged(mask), EventDetector.MERGE_GAP)
+            for start, end in zip(starts, ends):
+                peak = start + int(np.argmax(d[start:end]))
+                events.append(('pop', start, end, 20 * np.log10(d[peak] / level[peak // B])))
+
+        if 'dropout' in types:
+            flat = np.zeros(len(r), dtype=bool)
+            flat[1:] = r[1:] == r[:-1]
+            starts, ends, _ = _runs(flagged(flat))
+            # the first sample of a run of equal samples is not flagged by the comparison
+            starts = np.maximum(starts - 1, core.start)
+            long_run = (ends - starts >= EventDetector.DROPOUT_MIN_SAMPLES) | (starts <= core.start) | \
+                       (ends >= core.stop)
+            for start, end in zip(starts[long_run], ends[long_run]):
+                if abs(r[start]) < clip_level:
+                    # the level of the original is measured once the parts from all chunks are joined
+                    events.append(('dropout', start, end, 0.0))
+
+        if 'cut' in types or 'dc_step' in types:
+            k = EventDetector.STEP_BLOCKS
+            n_blocks = len(res) // B
+            blocks = res[:n_blocks * B].reshape(n_blocks, B)
+            first, last = -(-core.start // B), core.stop // B
+            if n_blocks >= 2 * k:
+                boundary = np.arange(k, n_blocks - k + 1)
+                in_range = (boundary >= first) & (boundary <= last)
+                if 'cut' in types:
+                    energy = np.mean(blocks * blocks, axis=1)
+                    before, after = _side_means(energy, k)
+                    # flagged on the median after the boundary: a sustained rise, not a single loud block (a pop);
+                    # located on the mean, which peaks exactly at the onset
+                    median = np.median(np.lib.stride_tricks.sliding_window_view(energy, k)[k:], axis=1)
+                    flag = (median > 10 ** (EventDetector.CUT_STEP_DB / 10) * before) & \
+                           (median > EventDetector.LEVEL_FLOOR ** 2) & in_range
+                    # a cut after silence (or in a bit-exact copy) is measured from the level floor, not from zero
+                    floor = EventDetector.LEVEL_FLOOR ** 2
+                    step_db = 10 * np.log10(np.maximum(after, floor) / np.maximum(before, floor))
+                    events.extend(EventDetector._step_events('cut', flag, step_db, boundary))
+                if 'dc_step' in types:
+                    means = blocks.mean(axis=1)
+                    before, after = _side_means(means, k)
+                    sq_before, sq_after = _side_means(means * means, k)
+                    spread = np.sqrt(np.maximum(sq_before - before ** 2, 0) + np.maximum(sq_after - after ** 2, 0))
+                    step = np.abs(after - before)
+                    flag = (step > EventDetector.LEVEL_FLOOR) & (step > EventDetector.DC_STEP_RATIO * spread) & in_range
+                    events.extend(EventDetector._step_events('dc_step', flag, 20 * np.log10(np.maximum(step, 1e-300)),
+                                                             boundary))
+
+        if 'clipping' in types:
+            starts, ends, counts = _runs(flagged(np.abs(r) >= clip_level), EventDetector.MERGE_GAP)
+            for start, end, count in zip(starts, ends, counts):
+                events.append(('clipping', start, end, int(count)))
+        return events
+
+    @staticmethod
+    def _step_events(kind: str, flag: np.ndarray, score: np.ndarray, boundary: np.ndarray):
+        """One event per run of flagged block boundaries, at the boundary with the highest score."""
+        B = EventDetector.BLOCK
+        events = []
+        starts, ends, _ = _runs(np.flatnonzero(flag))
+        for start, end in zip(starts, ends):
+            peak = start + int(np.argmax(score[start:end]))
+            events.append((kind, boundary[peak] * B, boundary[peak] * B + B, float(score[peak])))
+        return events
+
+    @staticmethod
+    def _merge(events):
+        """Join events of the same type closer than MERGE_GAP (e.g. split by a chunk border)."""
+        merged = []
+        for event in sorted(events, key=lambda e: (e[0], e[1])):
+            kind = event[0]
+            gap = EventDetector.STEP_BLOCKS * EventDetector.BLOCK if kind in _STEPS else EventDetector.MERGE_GAP
+            if not merged or merged[-1][0] != kind or event[1] - merged[-1][2] > gap:
+                merged.append(event)
+            elif kind in _STEPS:
+                # keep the location with the highest score
+                merged[-1] = max(merged[-1], event, key=lambda e: e[3])
+            else:
+                _, start, end, severity = merged[-1]
+                severity = severity + event[3] if kind in _SUMMED else max(severity, event[3])
+                merged[-1] = (kind, start, max(end, event[2]), severity)
+        return merged
+
+    @staticmethod
+    def detect_channel(orig: np.ndarray, rec: np.ndarray, rate: int, channel: int = 0, rec_start: int = 0,
+                       lag: int = 0, full_scale: float = None, types=None):
+        """
+        Detect events in one aligned channel pair.
+
+        Args:
+            orig (np.ndarray): Aligned original channel (any numeric type).
+            rec (np.ndarray): Aligned recorded channel, same length as `orig`.
+            rate (int): Sample rate.
+            channel (int): Channel number stored with the events.
+            rec_start (int): Frame of the recording the aligned signals start at.
+            lag (int): Lag of the pair, stored with the events.
+            full_scale (float): Largest sample magnitude of the recorded format, the largest
+                magnitude of the original if None.
+            types (List[str]): Event types to detect, all of EVENT_TYPES if None.
+
+        Returns:
+            List[dict]: events sorted by time
+        """
+        types = set(types or EVENT_TYPES)
+        unknown = types - set(EVENT_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown event types: {sorted(unknown)}")
+        n = min(len(orig), len(rec))
+        chunk = EventDetector.CHUNK
+        if full_scale is None:
+            full_scale = max((float(np.max(np.abs(orig[i:i + chunk]))) for i in range(0, n, chunk)), default=0.0)
+        scale = full_scale or 1.0
+        clip_level = 1 - EventDetector.CLIP_TOLERANCE
+        margin = max(EventDetector.POP_CONTEXT, EventDetector.STEP_BLOCKS) * EventDetector.BLOCK
+
+        raw = []
+        with Instrument.span('events', nbytes=n * (orig.itemsize + rec.itemsize), channel=channel):
+            for start in range(0, n, chunk):
+                lo, hi = max(start - margin, 0), min(start + chunk + margin, n)
+                o = orig[lo:hi].astype(np.float64) / scale
+                r = rec[lo:hi].astype(np.float64) / scale
+                core = slice(start - lo, min(start + chunk, n) - lo)
+                raw.extend((kind, lo + s, lo + e, severity)
+                           for kind, s, e, severity in EventDetector._chunk_events(o, r, core, clip_level, types))
+            merged = EventDetector._merge(raw)
+
+        kept = []
+        for kind, start, end, severity in merged:
+            if kind == 'dropout':
+                if end - start < EventDetector.DROPOUT_MIN_SAMPLES:
+                    continue
+                severity = np.sqrt(np.mean((orig[start:end].astype(np.float64) / scale) ** 2))
+                if severity < EventDetector.LEVEL_FLOOR:
+                    continue
+                severity = 20 * np.log10(severity)
+            elif kind == 'clipping' and severity < EventDetector.CLIP_MIN_SAMPLES:
+                continue
+            kept.append((kind, start, end, severity))
+
+        # The residual jumps where other defects start: those jumps are part of that event, not a cut,
+        # and the discontinuities at the edges of dropouts, cuts and DC steps are not pops
+        near = 2 * EventDetector.BLOCK
+        onsets = {kind: [(s, e) for k, s, e, _ in kept if k == kind] for kind in EVENT_TYPES}
+        causes = {'cut': onsets['dropout'] + onsets['clipping'] + onsets['dc_step'],
+                  'pop': onsets['dropout'] + onsets['cut'] + onsets['dc_step']}
+        events = []
+        for kind, start, end, severity in kept:
+            if kind == 'cut' and any(abs(start - s) <= near for s, _ in causes['cut']):
+                continue
+            if kind == 'pop' and any(s - near <= start and end <= e + near for s, e in causes['pop']):
+                continue
+            events.append({
+                'type': kind, 'channel': channel,
+                'start_sec': (rec_start + int(start)) / rate, 'end_sec': (rec_start + int(end)) / rate,
+                'severity': float(severity) if kind != 'clipping' else int(severity), 'lag_samples': int(lag),
+            })
+        return sorted(events, key=lambda e: (e['start_sec'], EVENT_TYPES.index(e['type'])))
+
+    @staticmethod
+    def detect(original: AudioData, recorded: AudioData, max_lag: int = None, analyses=None, types=None):
+        """
+        Detect events in every channel of a recording.
+
+        Args:
+            original (AudioData): Original audio data object.
+            recorded (AudioData): Recorded audio data object.
+            max_lag (int): Largest absolute lag to search in samples, the whole range if None.
+            analyses (List[SpectralAnalysis]): Analyses of AudioEvaluator.analyze; their aligned
+                signals are reused instead of searching the lag again.
+            types (List[str]): Event types to detect, all of EVENT_TYPES if None.
+
+        Returns:
+            List[dict]: events of all channels sorted by time
+        """
+        if original.channels != recorded.channels:
+            raise ValueError("channels of original and recorded audio must match.")
+        logger.info("[EventDetector] Event detection started...")
+        events = []
+        for ch in range(original.channels):
+            if analyses is not None:
+                analysis = analyses[ch]
+                events += EventDetector.detect_channel(analysis.orig, analysis.rec, analysis.rate, ch,
+                                                       analysis.rec_start, analysis.orig_start - analysis.rec_start,
+                                                       analysis.full_scale, types)
+                continue
+            # integer samples are converted chunk by chunk, no full float copy is made
+            orig, rec = original.channel(ch), recorded.channel(ch)
+            with Instrument.span('correlation', nbytes=orig.nbytes + rec.nbytes):
+                lag, _ = AudioEvaluator._find_lag(orig, rec, max_lag)
+            aligned_orig, aligned_rec, orig_start = AudioEvaluator._aligned(orig, rec, lag)
+            events += EventDetector.detect_channel(aligned_orig, aligned_rec, original.sample_rate, ch,
+                                                   max(-lag, 0), lag, recorded.max_amp, types)
+        events.sort(key=lambda e: (e['start_sec'], e['channel'], EVENT_TYPES.index(e['type'])))
+        counts = collections.Counter(event['type'] for event in events)
+        logger.info(f"  - {len(events)} events: " + (', '.join(f"{counts[kind]} {kind}" for kind in EVENT_TYPES
+                                                             if counts[kind]) or 'none'))
+        logger.info("[EventDetector] Done.")
+        return events
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+class SilentSink:
+    """Sink that drops every span; spans are still measured (e.g. to benchmark the overhead)."""
+    def emit(self, record: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class LogSink:
+    """Sink writing one human readable line per span to a logger, indented by nesting depth."""
+    def __init__(self, level: int = logging.INFO, log: logging.Logger = None):
+        self.level = level
+        self.log = log or logger
+
+    def emit(self, record: dict):
+        if not self.log.isEnabledFor(self.level):
+            return
+        line = f"{'  ' * record['depth']}[span] {record['name']}: {record['wall_sec'] * 1000:.2f} ms " \
+               f"(cpu {record['cpu_sec'] * 1000:.2f} ms"
+        if record['bytes']:
+            line += f", {record['bytes'] / 2 ** 20:.1f} MiB"
+        if record['peak_bytes'] is not None:
+            line += f", peak {record['peak_bytes'] / 2 ** 20:.1f} MiB"
+        self.log.log(self.level, line + ')')
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """Sink appending one JSON object per span to a file."""
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def emit(self, record: dict):
+        self.file.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ChromeTraceSink:
+    """Sink collecting spans as complete ('X') trace events, written on close for chrome://tracing or Perfetto."""
+    def __init__(self, path: str):
+        self.path = path
+        self.events = []
+
+    def emit(self, record: dict):
+        args = dict(record['attrs'], cpu_ms=record['cpu_sec'] * 1000, bytes=record['bytes'])
+        if record['peak_bytes'] is not None:
+            args['peak_bytes'] = record['peak_bytes']
+        self.events.append({
+            'name': record['name'], 'cat': record['name'].split('.')[0], 'ph': 'X',
+            'ts': record['start_sec'] * 1e6, 'dur': record['wall_sec'] * 1e6,
+            'pid': record['pid'], 'tid': record['tid'], 'args': args,
+        })
+
+    def close(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+class _NullSpan:
+    """Shared no-op span returned while instrumentation is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed region: wall time, CPU time (process-wide, includes numpy threads), bytes processed
+    and, with memory tracking, the peak traced allocation above the allocation at entry.
+    """
+    __slots__ = ('name', 'bytes', 'attrs', 'depth', '_wall', '_cpu', '_mem_start', '_mem_peak')
+
+    def __init__(self, name: str, nbytes: int, attrs: dict):
+        self.name = name
+        self.bytes = nbytes
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Add attributes known only inside the span (e.g. a result size)."""
+        if 'nbytes' in attrs:
+            self.bytes = attrs.pop('nbytes')
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = Instrument._stack()
+        self.depth = len(stack)
+        if Instrument._track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # hand the peak so far to the enclosing span before resetting it for this one
+            if stack:
+                stack[-1]._mem_peak = max(stack[-1]._mem_peak, peak)
+            tracemalloc.reset_peak()
+            self._mem_start = self._mem_peak = current
+        stack.append(self)
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        stack = Instrument._stack()
+        stack.pop()
+        peak_bytes = None
+        if Instrument._track_memory:
+            peak = max(self._mem_peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = peak - self._mem_start
+            if stack:
+                stack[-1]._mem_peak = max(stack[-1]._mem_peak, peak)
+        Instrument._emit({
+            'name': self.name, 'start_sec': self._wall - Instrument._epoch, 'wall_sec': wall, 'cpu_sec': cpu,
+            'bytes': int(self.bytes), 'peak_bytes': peak_bytes, 'depth': self.depth,
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'attrs': self.attrs,
+        })
+        return False
+
+
+class Instrument:
+    """
+    Instrumentation of the pipeline stages with named spans:
+
+        with Instrument.span('load', nbytes=..., path=...) as span:
+            ...
+
+    Spans are only measured while at least one sink is configured; otherwise span()
+    returns a shared no-op context manager, so instrumented code costs one function call.
+    Peak allocation uses tracemalloc, which slows Python allocations down, so it is off by default.
+    """
+    _sinks = []
+    _track_memory = False
+    _started_tracemalloc = False
+    _epoch = time.perf_counter()
+    _local = threading.local()
+
+    @staticmethod
+    def configure(sinks, track_memory: bool = False):
+        """
+        Replace the sinks (closing the previous ones).
+        :param sinks: List of sinks (SilentSink, LogSink, JsonLinesSink, ChromeTraceSink);
+                      an empty list disables the instrumentation.
+        :param track_memory: Record the peak traced allocation of every span.
+        """
+        Instrument.close()
+        Instrument._sinks = list(sinks)
+        Instrument._track_memory = bool(track_memory) and bool(Instrument._sinks)
+        if Instrument._track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            Instrument._started_tracemalloc = True
+
+    @staticmethod
+    def close():
+        """Flush and close the sinks and disable the instrumentation."""
+        sinks, Instrument._sinks = Instrument._sinks, []
+        for sink in sinks:
+            sink.close()
+        if Instrument._started_tracemalloc:
+            tracemalloc.stop()
+            Instrument._started_tracemalloc = False
+        Instrument._track_memory = False
+
+    @staticmethod
+    def enabled():
+        return bool(Instrument._sinks)
+
+    @staticmethod
+    def span(name: str, nbytes: int = 0, **attrs):
+        """
+        Span around a stage.
+        :param nbytes: Bytes of audio the stage processes.
+        :param attrs: Extra attributes stored with the span.
+        """
+        if not Instrument._sinks:
+            return _NULL_SPAN
+        return Span(name, nbytes, attrs)
+
+    @staticmethod
+    def _stack():
+        stack = getattr(Instrument._local, 'stack', None)
+        if stack is None:
+            stack = Instrument._local.stack = []
+        return stack
+
+    @staticmethod
+    def _emit(record: dict):
+        for sink in Instrument._sinks:
+            sink.emit(record)
+
+    @staticmethod
+    def sink_for(path: str):
+        """Sink writing to `path`: JSON lines for .jsonl files, a Chrome trace otherwise."""
+        return JsonLinesSink(path) if path.endswith('.jsonl') else ChromeTraceSink(path)
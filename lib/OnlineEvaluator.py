@@ -0,0 +1,267 @@
+import collections
+import logging
+import numpy as np
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+
+class _RingBuffer:
+    """Fixed-capacity FIFO of (frames, channels) samples."""
+    def __init__(self, capacity: int, channels: int, dtype=np.float64):
+        self.buf = np.zeros((capacity, channels), dtype=dtype)
+        self.start = 0
+        self.size = 0
+
+    @property
+    def free(self):
+        return len(self.buf) - self.size
+
+    def write(self, frames: np.ndarray):
+        if len(frames) > self.free:
+            raise ValueError(f"Ring buffer overflow: {len(frames)} frames, {self.free} free")
+        end = (self.start + self.size) % len(self.buf)
+        first = min(len(frames), len(self.buf) - end)
+        self.buf[end:end + first] = frames[:first]
+        self.buf[:len(frames) - first] = frames[first:]
+        self.size += len(frames)
+
+    def peek(self, n: int):
+        """Oldest `n` frames (a view unless they wrap around the end of the buffer)."""
+        n = min(n, self.size)
+        if self.start + n <= len(self.buf):
+            return self.buf[self.start:self.start + n]
+        return np.concatenate((self.buf[self.start:], self.buf[:self.start + n - len(self.buf)]))
+
+    def consume(self, n: int):
+        n = min(n, self.size)
+        self.start = (self.start + n) % len(self.buf)
+        self.size -= n
+
+
+class _RunningStats:
+    """
+    Per-channel sums for MSE and correlation, mergeable (Chan et al.) so blocks can be combined
+    without keeping their samples: count, means, centered second moments and co-moment.
+    """
+    def __init__(self, channels: int):
+        self.n = 0
+        self.mean_x = np.zeros(channels)
+        self.mean_y = np.zeros(channels)
+        self.m2_x = np.zeros(channels)
+        self.m2_y = np.zeros(channels)
+        self.c_xy = np.zeros(channels)
+        self.sq_err = np.zeros(channels)
+
+    @classmethod
+    def of_block(cls, x: np.ndarray, y: np.ndarray):
+        stats = cls(x.shape[1])
+        stats.n = len(x)
+        if stats.n:
+            stats.mean_x, stats.mean_y = x.mean(axis=0), y.mean(axis=0)
+            dx, dy = x - stats.mean_x, y - stats.mean_y
+            stats.m2_x = np.einsum('ij,ij->j', dx, dx)
+            stats.m2_y = np.einsum('ij,ij->j', dy, dy)
+            stats.c_xy = np.einsum('ij,ij->j', dx, dy)
+            err = x - y
+            stats.sq_err = np.einsum('ij,ij->j', err, err)
+        return stats
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        dx, dy = other.mean_x - self.mean_x, other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        self.mean_x = self.mean_x + dx * other.n / n
+        self.mean_y = self.mean_y + dy * other.n / n
+        self.m2_x = self.m2_x + other.m2_x + dx * dx * weight
+        self.m2_y = self.m2_y + other.m2_y + dy * dy * weight
+        self.c_xy = self.c_xy + other.c_xy + dx * dy * weight
+        self.sq_err = self.sq_err + other.sq_err
+        self.n = n
+        return self
+
+    def mse(self):
+        return self.sq_err / self.n if self.n else np.zeros_like(self.sq_err)
+
+    def correlation(self):
+        denom = np.sqrt(self.m2_x * self.m2_y)
+        return np.divide(self.c_xy, denom, out=np.zeros_like(denom), where=denom > 0)
+
+
+class OnlineEvaluator:
+    """
+    Incremental evaluation of a live recording against a known reference.
+    Recorded frames are pushed as they arrive and kept in a ring buffer. The lag to the
+    reference is searched once, on the first `align_sec` of the recording, and then locked.
+    From there every block of `block_sec` is scored against the aligned reference and folded
+    into running statistics (MSE, correlation, Welch coherence sums), so the work per pushed
+    frame is constant and the memory is bounded by the rolling window, not the stream length.
+
+    Metrics use the keys of AudioEvaluator.evaluate; the correlation is the normalized
+    correlation at the locked lag.
+    """
+
+    def __init__(self, reference: AudioData, window_sec: float = 5.0, block_sec: float = 0.5,
+                 align_sec: float = 3.0, max_lag: int = None, nperseg: int = 2048):
+        """
+        :param reference: Played reference audio (a memory-mapped file is fine, it is read block by block).
+        :param window_sec: Length of the rolling window of the emitted metrics.
+        :param block_sec: Metrics are updated every `block_sec` of recording (the latency bound).
+        :param align_sec: Recording needed before the lag is locked.
+        :param max_lag: Largest absolute lag to search in samples, `align_sec` worth of frames if None.
+        :param nperseg: FFT segment size of the coherence estimate.
+        """
+        self.reference = reference
+        self.rate = reference.sample_rate
+        self.channels = reference.channels
+        self.block_frames = max(int(block_sec * self.rate), 1)
+        self.align_frames = max(int(align_sec * self.rate), nperseg)
+        self.max_lag = self.align_frames if max_lag is None else max_lag
+        self.window_blocks = max(int(round(window_sec / block_sec)), 1)
+        self.nperseg = nperseg
+        self.hop = nperseg - nperseg // 2
+        self.ring = _RingBuffer(max(self.align_frames, self.block_frames) + self.block_frames, self.channels)
+
+        self.lag = None
+        self.lag_correlation = None
+        # recorded frames consumed (scored or skipped) so far
+        self.position = 0
+        self.total = _RunningStats(self.channels)
+        n_freqs = nperseg // 2 + 1
+        self.total_spectra = [np.zeros((self.channels, n_freqs), dtype=np.complex128),
+                              np.zeros((self.channels, n_freqs)), np.zeros((self.channels, n_freqs))]
+        # (stats, spectra) of the blocks in the rolling window
+        self.window = collections.deque(maxlen=self.window_blocks)
+        # Samples kept from the previous block so Welch segments run across block borders
+        self.carry = (np.empty((0, self.channels)), np.empty((0, self.channels)))
+
+    @property
+    def locked(self):
+        return self.lag is not None
+
+    def push(self, block):
+        """
+        Add recorded frames.
+        :param block: AudioData block or (frames, channels) array of recorded samples.
+        :return: List of updates, one per completed block:
+                 {'time_sec', 'lag_samples', 'results': {'channel_N': rolling-window metrics}}
+        """
+        frames = block.frames if isinstance(block, AudioData) else np.asarray(block).reshape(-1, self.channels)
+        updates = []
+        pos = 0
+        while pos < len(frames):
+            n = min(self.ring.free, len(frames) - pos)
+            self.ring.write(frames[pos:pos + n])
+            pos += n
+            updates.extend(self._process())
+        return updates
+
+    def flush(self):
+        """Score the frames left in the ring buffer (a final, shorter block)."""
+        updates = self._process()
+        if not self.locked and self.ring.size >= self.nperseg:
+            self._lock()
+            updates.extend(self._process())
+        if self.locked and self.ring.size:
+            updates.append(self._score(self.ring.size))
+        return updates
+
+    def _process(self):
+        updates = []
+        if not self.locked:
+            if self.ring.size < self.align_frames:
+                return updates
+            self._lock()
+        while self.ring.size >= self.block_frames:
+            updates.append(self._score(self.block_frames))
+        return updates
+
+    def _lock(self):
+        """Find the lag on the buffered start of the recording (channel sum, like evaluate_stream)."""
+        rec = self.ring.peek(self.ring.size).sum(axis=1)
+        ref = self.reference.frames[:len(rec) + self.max_lag].astype(np.float64).sum(axis=1)
+        with Instrument.span('online.lock', nbytes=rec.nbytes + ref.nbytes):
+            lag, self.lag_correlation = AudioEvaluator._find_lag(ref, rec, self.max_lag)
+        self.lag = int(lag)
+        logger.info(f"  - Locked lag: {self.lag} samples ({self.lag / self.rate:.4f}s), "
+                    f"correlation {self.lag_correlation:.4f}")
+
+    def _score(self, n_frames: int):
+        """Score the oldest `n_frames` of the ring buffer and return the rolling update."""
+        with Instrument.span('online.block', nbytes=n_frames * self.channels * 8):
+            rec = self.ring.peek(n_frames)
+            # recorded frame i lines up with reference frame i + lag
+            ref_start = self.position + self.lag
+            first = min(max(-ref_start, 0), n_frames)
+            last = max(min(self.reference.n_frames - ref_start, n_frames), first)
+            ref = self.reference.frames[ref_start + first:ref_start + last].astype(np.float64)
+            rec = rec[first:last]
+
+            stats = _RunningStats.of_block(ref, rec)
+            spectra = self._spectra(ref, rec)
+            self.total.merge(stats)
+            for acc, part in zip(self.total_spectra, spectra):
+                acc += part
+            self.window.append((stats, spectra))
+            time_sec = self.position / self.rate
+            self.ring.consume(n_frames)
+            self.position += n_frames
+            return {'time_sec': time_sec, 'lag_samples': self.lag, 'results': self._results(*self._window_sums())}
+
+    def _spectra(self, ref: np.ndarray, rec: np.ndarray):
+        """Welch sums of one block per channel, continuing the segments of the previous block."""
+        ref_seg = np.concatenate((self.carry[0], ref))
+        rec_seg = np.concatenate((self.carry[1], rec))
+        sums = [AudioEvaluator._welch_sums(ref_seg[:, ch], rec_seg[:, ch], self.nperseg)
+                for ch in range(self.channels)]
+        n_seg = sums[0][3]
+        self.carry = (ref_seg[n_seg * self.hop:], rec_seg[n_seg * self.hop:])
+        return [np.array([s[i] for s in sums]) for i in range(3)]
+
+    def _window_sums(self):
+        stats = _RunningStats(self.channels)
+        for block_stats, _ in self.window:
+            stats.merge(block_stats)
+        spectra = [sum(block_spectra[i] for _, block_spectra in self.window) for i in range(3)]
+        return stats, spectra
+
+    def _results(self, stats, spectra):
+        mse, corr = stats.mse(), stats.correlation()
+        return {
+            f'channel_{ch}': {
+                'lag_samples': self.lag,
+                'peak_cross_correlation': float(corr[ch]),
+                'mean_squared_error': float(mse[ch]),
+                'average_spectral_coherence': AudioEvaluator._coherence_from_sums(
+                    spectra[0][ch], spectra[1][ch], spectra[2][ch]),
+            }
+            for ch in range(self.channels)
+        }
+
+    def metrics(self):
+        """Metrics over everything scored so far, in the format of AudioEvaluator.evaluate."""
+        if not self.locked:
+            return {}
+        return self._results(self.total, self.total_spectra)
+
+    @staticmethod
+    def follow(reference_path: str, recorded_path: str, poll_sec: float = 0.2, idle_sec: float = 5.0, **kwargs):
+        """
+        Evaluate a WAV recording while it is being written.
+        :param kwargs: OnlineEvaluator parameters (window_sec, block_sec, align_sec, max_lag, nperseg).
+        :return: Generator of rolling updates; the last one holds the totals under 'total'.
+        """
+        evaluator = OnlineEvaluator(AudioData.from_file(reference_path), **kwargs)
+        for block in AudioData.follow_file(recorded_path, evaluator.block_frames, poll_sec, idle_sec):
+            if block.channels != evaluator.channels:
+                raise ValueError("channels of original and recorded audio must match.")
+            yield from evaluator.push(block)
+        updates = evaluator.flush()
+        yield from updates[:-1]
+        final = updates[-1] if updates else {'time_sec': evaluator.position / evaluator.rate,
+                                             'lag_samples': evaluator.lag, 'results': {}}
+        yield dict(final, total=evaluator.metrics())
@@ -0,0 +1,160 @@
+import collections
+import logging
+import numpy as np
+import scipy.fft
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.Instrument import Instrument
+from lib.SpectralAnalysis import SpectralAnalysis
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedReference:
+    """
+    Original audio prepared once for scoring many recordings against it.
+    Holds per channel what AudioEvaluator.evaluate would otherwise recompute for every recording:
+    the float samples, their mean/std, the padded FFTs of the (decimated) lag-search signals
+    and the spectra of the Welch segments, which seed the SpectralAnalysis of every recording.
+    Each recording then only costs its own transforms, and recordings of the same length are
+    correlated with one batched FFT. Lags and time domain metrics match AudioEvaluator.evaluate;
+    the Welch segments follow the grid of the original, so spectral metrics can differ slightly.
+    """
+    # Padded reference FFTs kept for the lag search, by (channel, factor, envelope, window, nfft)
+    FFT_CACHE_SIZE = 32
+
+    def __init__(self, original: AudioData, max_spectra_bytes: int = 2 ** 28):
+        """
+        :param original: Original audio data.
+        :param max_spectra_bytes: Keep the Welch segment spectra only if all channels fit in this
+                                  many bytes; otherwise they are computed per recording.
+        """
+        self.sample_rate = original.sample_rate
+        self.channels = original.channels
+        self.nperseg = AudioEvaluator.COHERENCE_NPERSEG
+        self.hop = self.nperseg - self.nperseg // 2
+        with Instrument.span('prepare', nbytes=original.frames.nbytes):
+            self.data = [original.float_channel(ch, np.float64) for ch in range(self.channels)]
+            self.stats = [AudioEvaluator._mean_std(data) for data in self.data]
+            self._ffts = collections.OrderedDict()
+
+            n_frames = original.n_frames
+            n_seg = (n_frames - self.nperseg) // self.hop + 1 if n_frames >= self.nperseg else 0
+            spectra_bytes = self.channels * n_seg * (self.nperseg // 2 + 1) * 16
+            self.spectra = None
+            if n_seg and spectra_bytes <= max_spectra_bytes:
+                self.spectra = [AudioEvaluator._segment_spectra(data, self.nperseg) for data in self.data]
+        logger.info(f"  - Prepared reference: {self.channels}ch, {n_frames} frames, "
+                    f"segment spectra {'kept' if self.spectra else 'not kept'}")
+
+    def _orig_fft(self, ch: int, factor: int, envelope: bool, n_orig: int, nfft: int):
+        """Padded FFT of the lag-search signal of the original, as correlated in AudioEvaluator._find_lag."""
+        key = (ch, factor, envelope, n_orig, nfft)
+        spectrum = self._ffts.get(key)
+        if spectrum is None:
+            data = self.data[ch]
+            if factor == 1:
+                mean, std = self.stats[ch]
+                signal = (data[:n_orig] - mean) / (std * len(data))
+            else:
+                signal = AudioEvaluator._coarse_signal(data[:n_orig], factor, envelope)
+            spectrum = self._ffts[key] = scipy.fft.rfft(signal, nfft)
+            if len(self._ffts) > PreparedReference.FFT_CACHE_SIZE:
+                self._ffts.popitem(last=False)
+        else:
+            self._ffts.move_to_end(key)
+        return spectrum
+
+    def find_lags(self, ch: int, recordings, max_lag: int = None, subsample: bool = False):
+        """
+        Lag and peak correlation of every recorded channel against channel `ch` of the original.
+        :param recordings: List of float recorded channels.
+        :return: List of (lag, peak correlation) like AudioEvaluator._find_lag.
+        """
+        orig, orig_stats = self.data[ch], self.stats[ch]
+        lags = [(0, 0.0)] * len(recordings)
+        groups = collections.defaultdict(list)
+        for i, rec in enumerate(recordings):
+            rec_stats = AudioEvaluator._mean_std(rec)
+            if orig_stats[1] == 0 or rec_stats[1] == 0:
+                continue
+            lo, hi, n_orig, n_rec, factor = AudioEvaluator._lag_plan(len(orig), len(rec), max_lag)
+            if factor == 1:
+                signal, envelope = (rec[:n_rec] - rec_stats[0]) / rec_stats[1], False
+                n_orig_signal = n_orig
+            else:
+                signal, envelope = AudioEvaluator._coarse_recording(rec[:n_rec], factor, rec_stats)
+                n_orig_signal = n_orig // factor
+            # power-of-two padding, so recordings of similar length share the reference FFT
+            nfft = 1 << int(n_orig_signal + len(signal) - 2).bit_length()
+            groups[(factor, envelope, n_orig, n_orig_signal, len(signal), nfft)].append(
+                (i, signal, rec, rec_stats, lo, hi, n_rec))
+
+        for (factor, envelope, n_orig, n_orig_signal, n_signal, nfft), members in groups.items():
+            orig_spec = self._orig_fft(ch, factor, envelope, n_orig, nfft)
+            # one batched FFT for all recordings of the group
+            rec_spec = scipy.fft.rfft(np.stack([member[1] for member in members]), nfft, axis=1, workers=-1)
+            circular = scipy.fft.irfft(rec_spec.conj() * orig_spec, nfft, axis=1, workers=-1)
+            # reorder the circular correlation like correlate(..., mode='full')
+            full = np.concatenate((circular[:, nfft - (n_signal - 1):], circular[:, :n_orig_signal]), axis=1)
+            for (i, signal, rec, rec_stats, lo, hi, n_rec), correlation in zip(members, full):
+                if factor == 1:
+                    lags[i] = AudioEvaluator._exact_lag(correlation, orig, rec, lo, hi, n_rec, max_lag, subsample,
+                                                        orig_stats, rec_stats)
+                else:
+                    lags[i] = AudioEvaluator._refine_lag(correlation, orig, rec, n_orig, n_rec, signal, lo, hi,
+                                                         factor, subsample, orig_stats, rec_stats)
+        return lags
+
+    def _analysis(self, ch: int, aligned_orig: np.ndarray, aligned_rec: np.ndarray, orig_start: int,
+                  rec_start: int, full_scale: float):
+        """
+        SpectralAnalysis of an aligned pair on the segment grid of the kept spectra.
+        The Welch segments start at the first segment boundary of the original inside the aligned
+        part (less than a hop in), so its spectra are reused whatever the lag.
+        """
+        orig_spectra = None
+        skip = -orig_start % self.hop
+        if self.spectra is not None and len(aligned_orig) - skip >= self.nperseg:
+            first = (orig_start + skip) // self.hop
+            n_seg = (len(aligned_orig) - skip - self.nperseg) // self.hop + 1
+            orig_spectra = self.spectra[ch][first:first + n_seg]
+        else:
+            # too short for a whole segment on the grid, or no spectra kept: transform this part again
+            skip = 0
+        return SpectralAnalysis(aligned_orig, aligned_rec, self.sample_rate, full_scale, orig_start, rec_start,
+                                self.nperseg, orig_spectra, skip)
+
+    def evaluate(self, recordings, max_lag: int = None, subsample: bool = False, batch_size: int = 64,
+                 metrics=None):
+        """
+        Evaluate recordings against the prepared original.
+        :param recordings: List of AudioData or file paths.
+        :param batch_size: Recordings loaded and correlated together.
+        :param metrics: Metrics to compute (see SpectralAnalysis.METRICS), the default set if None.
+        :return: List of results in the format of AudioEvaluator.evaluate, in the order of `recordings`.
+        """
+        results = []
+        for start in range(0, len(recordings), batch_size):
+            batch = [AudioData.from_file(rec) if isinstance(rec, str) else rec
+                     for rec in recordings[start:start + batch_size]]
+            for rec in batch:
+                if rec.channels != self.channels:
+                    raise ValueError("channels of original and recorded audio must match.")
+            batch_results = [{} for _ in batch]
+            for ch in range(self.channels):
+                rec_chs = [rec.float_channel(ch, np.float64) for rec in batch]
+                with Instrument.span('correlation', nbytes=sum(rec.nbytes for rec in rec_chs),
+                                     recordings=len(rec_chs)):
+                    lags = self.find_lags(ch, rec_chs, max_lag, subsample)
+                for result, audio, rec, (lag, peak_corr) in zip(batch_results, batch, rec_chs, lags):
+                    lag_int = int(round(lag))
+                    aligned_orig, aligned_rec, orig_start = AudioEvaluator._aligned(self.data[ch], rec, lag_int)
+                    analysis = self._analysis(ch, aligned_orig, aligned_rec, orig_start, max(-lag_int, 0),
+                                              audio.max_amp)
+                    with Instrument.span('metrics', nbytes=aligned_orig.nbytes + aligned_rec.nbytes):
+                        result[f'channel_{ch}'] = {'lag_samples': lag, 'peak_cross_correlation': peak_corr}
+                        result[f'channel_{ch}'].update(analysis.metrics(metrics))
+            results.extend(batch_results)
+            logger.info(f"  - Evaluated {len(results)}/{len(recordings)} recordings")
+        return results
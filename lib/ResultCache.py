@@ -0,0 +1,330 @@
+import functools
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the cache changes
+CACHE_VERSION = 1
+
+_HASH_CHUNK = 2 ** 20
+
+
+def _to_json(value):
+    """numpy scalars/arrays in results as plain JSON values."""
+    # numpy is not imported here, the CLI imports this module at startup
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Cannot store {type(value).__name__} in the result cache")
+
+
+def _dir_size(path: str):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class ResultCache:
+    """
+    Persistent on-disk cache of evaluation results and rendered images.
+    Entries are content addressed: the key hashes the kind of work, the content of the input
+    audio, the parameters and a fingerprint of the library source, so any change to one of
+    them is a miss and stale entries are never returned. File hashes are remembered by
+    (size, mtime), so unchanged files are not read again. The cache is bounded in size and
+    evicts the least recently used entries. A running estimate of its size is kept next to
+    the entries, so storing an entry only walks the cache once the estimate exceeds the bound.
+    """
+    # Disabled with --no-cache
+    enabled = True
+    # Size bound of the stored entries
+    max_bytes = 2 ** 30
+
+    @staticmethod
+    def cache_dir():
+        """Directory of cached results ($KAST_CACHE_DIR/results, ~/.cache/kast/results by default)."""
+        root = os.environ.get('KAST_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'kast')
+        return os.path.join(root, 'results')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def fingerprint():
+        """Hash of the library source; results computed by other code are not reused."""
+        digest = hashlib.blake2b(str(CACHE_VERSION).encode(), digest_size=16)
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            digest.update(os.path.basename(path).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def audio_hash(audio):
+        """Content hash of AudioData samples and format."""
+        import numpy as np
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(json.dumps([audio.sample_rate, audio.sample_width, audio.channels,
+                                  audio.dtype.str]).encode())
+        frames = audio.frames
+        step = max(1, _HASH_CHUNK // max(1, frames.itemsize * audio.channels))
+        for start in range(0, len(frames), step):
+            digest.update(np.ascontiguousarray(frames[start:start + step]).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_hash(path: str):
+        """Content hash of a file, remembered by path, size and modification time."""
+        stat = os.stat(path)
+        memo_path = os.path.join(ResultCache.cache_dir(), 'files',
+                                 hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + '.json')
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+            if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+                return memo['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                digest.update(chunk)
+        memo = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        tmp_path = f"{memo_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_path)
+        return memo['hash']
+
+    @staticmethod
+    def key(kind: str, inputs, params: dict = None):
+        """
+        Key of a cache entry.
+        :param kind: Kind of work, e.g. 'evaluate' or 'plot'.
+        :param inputs: Content hashes of the inputs (see audio_hash, file_hash).
+        :param params: JSON-serializable parameters that change the result.
+        """
+        desc = {'kind': kind, 'inputs': list(inputs), 'params': params or {},
+                'fingerprint': ResultCache.fingerprint()}
+        return hashlib.sha256(json.dumps(desc, sort_keys=True, default=_to_json).encode()).hexdigest()
+
+    @staticmethod
+    def _entry_dir(key: str):
+        return os.path.join(ResultCache.cache_dir(), 'entries', key)
+
+    @staticmethod
+    def get(key: str, files: dict = None):
+        """
+        Look up an entry and mark it as recently used.
+        :param files: {name: destination path}; stored files are copied there on a hit.
+        :return: The stored result, or None on a miss (or when the cache is disabled).
+        """
+        if not ResultCache.enabled:
+            return None
+        entry_dir = ResultCache._entry_dir(key)
+        result_path = os.path.join(entry_dir, 'result.json')
+        try:
+            with open(result_path) as f:
+                result = json.load(f)
+            for name, dest in (files or {}).items():
+                if os.path.dirname(dest):
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(os.path.join(entry_dir, name), dest)
+        except (OSError, ValueError):
+            return None
+        # the modification time of result.json orders the entries for eviction
+        os.utime(result_path)
+        return result
+
+    @staticmethod
+    def put(key: str, result, files: dict = None):
+        """
+        Store an entry, then evict least recently used entries above max_bytes.
+        :param result: JSON-serializable result (numpy scalars are converted).
+        :param files: {name: source path} of files stored with the entry.
+        """
+        if not ResultCache.enabled:
+            return
+        entry_dir = ResultCache._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            for name, src in (files or {}).items():
+                shutil.copyfile(src, os.path.join(tmp_dir, name))
+            with open(os.path.join(tmp_dir, 'result.json'), 'w') as f:
+                json.dump(result, f, default=_to_json)
+            size = _dir_size(tmp_dir)
+            if os.path.isdir(entry_dir):
+                size -= _dir_size(entry_dir)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            size = 0
+        total = ResultCache._add_usage(size)
+        if total is None or total > ResultCache.max_bytes:
+            ResultCache.evict()
+
+    @staticmethod
+    def _usage_path():
+        return os.path.join(ResultCache.cache_dir(), 'usage.json')
+
+    @staticmethod
+    def _write_usage(total: int):
+        path = ResultCache._usage_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'bytes': total}, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _add_usage(size: int):
+        """
+        Add the size of a stored entry to the running estimate of the cache size.
+        Concurrent stores may lose an update; the next eviction walk sets the exact size again.
+        :return: The new estimate, or None when there is none yet.
+        """
+        try:
+            with open(ResultCache._usage_path()) as f:
+                total = int(json.load(f)['bytes']) + size
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        ResultCache._write_usage(total)
+        return total
+
+    @staticmethod
+    def evict(max_bytes: int = None):
+        """Remove least recently used entries until the cache fits `max_bytes` (max_bytes if None)."""
+        max_bytes = ResultCache.max_bytes if max_bytes is None else max_bytes
+        entries_dir = os.path.join(ResultCache.cache_dir(), 'entries')
+        if not os.path.isdir(entries_dir):
+            return 0
+        entries = []
+        for name in os.listdir(entries_dir):
+            path = os.path.join(entries_dir, name)
+            try:
+                used = os.path.getmtime(os.path.join(path, 'result.json'))
+            except OSError:
+                continue
+            entries.append((used, _dir_size(path), path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        ResultCache._write_usage(total)
+        if removed:
+            logger.info(f"  - Evicted {removed} cached results")
+        return removed
+
+    @staticmethod
+    def clear():
+        """Remove all cached results and remembered file hashes."""
+        cache_dir = ResultCache.cache_dir()
+        if not os.path.isdir(cache_dir):
+            return 0
+        entries_dir = os.path.join(cache_dir, 'entries')
+        removed = len(os.listdir(entries_dir)) if os.path.isdir(entries_dir) else 0
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return removed
+
+    @staticmethod
+    def plain_json(value):
+        """
+        Results as strict JSON values: numpy scalars/arrays become plain values and non-finite
+        floats (e.g. the SNR of identical signals) become None, which JSON has no literal for.
+        """
+        if hasattr(value, 'tolist'):
+            value = value.tolist()
+        if isinstance(value, float):
+            return value if math.isfinite(value) else None
+        if isinstance(value, dict):
+            return {key: ResultCache.plain_json(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [ResultCache.plain_json(item) for item in value]
+        return value
+
+    @staticmethod
+    def evaluate_key(inputs, max_lag: int = None, subsample: bool = False, drift: bool = False):
+        """Key of AudioEvaluator.evaluate results, shared by evaluate and BatchRunner."""
+        return ResultCache.key('evaluate', inputs, {'max_lag': max_lag, 'subsample': subsample, 'drift': drift})
+
+    @staticmethod
+    def evaluate(original_path: str, recorded_path: str, max_lag: int = None, subsample: bool = False,
+                 plot_path: str = None, start_sec: float = None, end_sec: float = None, drift: bool = False):
+        """
+        AudioEvaluator.evaluate of two files, reused while the files and the library are unchanged.
+        :param plot_path: Also plot the pair there; the plot shares the spectral analysis of the evaluation.
+        :param drift: Compensate clock drift (see AudioEvaluator.analyze_channel).
+        """
+        inputs = [ResultCache.file_hash(original_path), ResultCache.file_hash(recorded_path)]
+        key = ResultCache.evaluate_key(inputs, max_lag, subsample, drift)
+        plot_key = None
+        if plot_path is not None:
+            plot_key = ResultCache.key('plot', inputs, {'start_sec': start_sec, 'end_sec': end_sec, 'analysis': True,
+                                                        'drift': drift})
+        started = time.perf_counter()
+        results = ResultCache.get(key)
+        if results is not None:
+            logger.info(f"[ResultCache] Reuse evaluation of '{recorded_path}' ({time.perf_counter() - started:.3f}s)")
+        plotted = plot_key is None or ResultCache.get(plot_key, files={os.path.basename(plot_path): plot_path}) is not None
+        if plot_key is not None and plotted:
+            logger.info(f"[ResultCache] Reuse plot '{plot_path}'")
+        if results is not None and plotted:
+            return results
+
+        from lib.AudioData import AudioData
+        from lib.AudioEvaluator import AudioEvaluator
+        original, recorded = AudioData.from_file(original_path), AudioData.from_file(recorded_path)
+        analyzed, analyses = AudioEvaluator.analyze(original, recorded, max_lag, subsample, drift=drift)
+        if results is None:
+            results = analyzed
+            ResultCache.put(key, results)
+        if not plotted:
+            from lib.Visualizer import Visualizer
+            Visualizer.plot_audio_data(plot_path, original, recorded, start_sec, end_sec, analyses)
+            ResultCache.put(plot_key, {}, files={os.path.basename(plot_path): plot_path})
+        return results
+
+    @staticmethod
+    def plot(path: str, original_path: str, recorded_path: str, start_sec: float = None, end_sec: float = None):
+        """Visualizer.plot_audio_data of two files, copied from the cache while they and the library are unchanged."""
+        key = ResultCache.key('plot', [ResultCache.file_hash(original_path), ResultCache.file_hash(recorded_path)],
+                              {'start_sec': start_sec, 'end_sec': end_sec})
+        name = os.path.basename(path)
+        if ResultCache.get(key, files={name: path}) is not None:
+            logger.info(f"[ResultCache] Reuse plot '{path}'")
+            return
+        from lib.AudioData import AudioData
+        from lib.Visualizer import Visualizer
+        Visualizer.plot_audio_data(path, AudioData.from_file(original_path), AudioData.from_file(recorded_path),
+                                   start_sec, end_sec)
+        ResultCache.put(key, {}, files={name: path})
+
+    @staticmethod
+    def detect_events(original_path: str, recorded_path: str, max_lag: int = None, plot_path: str = None):
+        """EventDetector.detect of two files (and Visualizer.plot_events to `plot_path`), reused while unchanged."""
+        key = ResultCache.key('events', [ResultCache.file_hash(original_path), ResultCache.file_hash(recorded_path)],
+                              {'max_lag': max_lag, 'plot': plot_path is not None})
+        files = {os.path.basename(plot_path): plot_path} if plot_path else None
+        events = ResultCache.get(key, files=files)
+        if events is not None:
+            logger.info(f"[ResultCache] Reuse {len(events)} events of '{recorded_path}'")
+            return events
+        from lib.AudioData import AudioData
+        from lib.EventDetector import EventDetector
+        original, recorded = AudioData.from_file(original_path), AudioData.from_file(recorded_path)
+        events = EventDetector.detect(original, recorded, max_lag)
+        if plot_path:
+            from lib.Visualizer import Visualizer
+            Visualizer.plot_events(plot_path, original, recorded, events)
+        ResultCache.put(key, events, files=files)
+        return events
@@ -0,0 +1,250 @@
+import logging
+import numpy as np
+from scipy.signal import get_window
+from lib.AudioEvaluator import AudioEvaluator
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+# Octave band centers of the band response
+OCTAVE_BANDS = [31.5, 63, 125, 250, 500, 1000, 2000, 4000, 8000, 16000]
+# Bands this far below the strongest band of the original are not excited and reported as None
+BAND_FLOOR_DB = -60
+# Measurement band of THD+N in Hz
+THD_N_BAND = (20, 20000)
+# Bins on each side of the fundamental removed for THD+N: the Hann main lobe is +-2 bins,
+# the wider notch keeps the sidelobes of a clean tone below about -50 dB
+THD_N_FUNDAMENTAL_BINS = 5
+
+# product name -> function(analysis)
+PRODUCTS = {}
+# metric name -> function(analysis), with the products it needs in `func.requires`
+METRICS = {}
+
+
+def _product(func):
+    PRODUCTS[func.__name__.lstrip('_')] = func
+    return func
+
+
+def metric(*requires):
+    """
+    Register a metric computed from the products of a SpectralAnalysis.
+    The products are computed once per analysis and shared by every metric that requires them.
+    """
+    def register(func):
+        func.requires = requires
+        METRICS[func.__name__] = func
+        return func
+    return register
+
+
+@_product
+def _orig_spectra(analysis):
+    return AudioEvaluator._segment_spectra(analysis.orig[analysis.segment_start:], analysis.nperseg)
+
+
+@_product
+def _rec_spectra(analysis):
+    return AudioEvaluator._segment_spectra(analysis.rec[analysis.segment_start:], analysis.nperseg)
+
+
+@_product
+def _cross_sums(analysis):
+    return AudioEvaluator._cross_sums(analysis.product('orig_spectra'), analysis.product('rec_spectra'))
+
+
+@_product
+def _rec_psd(analysis):
+    """Welch average of the recorded power spectrum (unscaled)."""
+    return np.mean(np.abs(analysis.product('rec_spectra')) ** 2, axis=0)
+
+
+@_product
+def _error(analysis):
+    return {'mse': np.mean((analysis.orig - analysis.rec) ** 2), 'orig_power': np.mean(analysis.orig ** 2)}
+
+
+@_product
+def _rec_levels(analysis):
+    clipped = 0
+    if analysis.full_scale is not None:
+        clipped = int(np.count_nonzero(np.abs(analysis.rec) >= analysis.full_scale))
+    return {'mean': float(np.mean(analysis.rec)), 'clipped': clipped}
+
+
+def _db(ratio: float):
+    if ratio <= 0:
+        return float('-inf')
+    return float(10 * np.log10(ratio))
+
+
+@metric('error')
+def mean_squared_error(analysis):
+    return analysis.product('error')['mse']
+
+
+@metric('cross_sums')
+def average_spectral_coherence(analysis):
+    pxy, pxx, pyy, _ = analysis.product('cross_sums')
+    return AudioEvaluator._coherence_from_sums(pxy, pxx, pyy)
+
+
+@metric('error')
+def snr_db(analysis):
+    """Power of the original over the power of the difference to it."""
+    error = analysis.product('error')
+    if error['mse'] == 0:
+        return float('inf')
+    return _db(error['orig_power'] / error['mse'])
+
+
+@metric('rec_psd')
+def thd_n_db(analysis):
+    """Power in THD_N_BAND outside the strongest tone of the recording, relative to all power in the band."""
+    psd = analysis.product('rec_psd')
+    freqs = analysis.freqs
+    # bins 0 and 1 hold the main lobe of the (detrended) DC component
+    band = np.flatnonzero((freqs >= THD_N_BAND[0]) & (freqs <= THD_N_BAND[1]))
+    band = band[band >= 2]
+    if len(band) == 0:
+        return None
+    total = float(np.sum(psd[band]))
+    if total == 0:
+        return None
+    peak = band[np.argmax(psd[band])]
+    lo, hi = max(peak - THD_N_FUNDAMENTAL_BINS, band[0]), min(peak + THD_N_FUNDAMENTAL_BINS, band[-1])
+    return _db((total - float(np.sum(psd[lo:hi + 1]))) / total)
+
+
+@metric('cross_sums')
+def band_response_db(analysis):
+    """Recorded over original power per octave band, None for bands the original does not excite."""
+    _, pxx, pyy, _ = analysis.product('cross_sums')
+    freqs = analysis.freqs
+    bands = {}
+    for center in OCTAVE_BANDS:
+        in_band = (freqs >= center / np.sqrt(2)) & (freqs < center * np.sqrt(2))
+        if np.any(in_band):
+            bands[f'{center:g}'] = (float(np.sum(pxx[in_band])), float(np.sum(pyy[in_band])))
+    if not bands:
+        return {}
+    floor = max(orig for orig, _ in bands.values()) * 10 ** (BAND_FLOOR_DB / 10)
+    return {name: _db(rec / orig) if orig > floor and orig > 0 else None for name, (orig, rec) in bands.items()}
+
+
+@metric('rec_levels')
+def dc_offset(analysis):
+    return analysis.product('rec_levels')['mean']
+
+
+@metric('rec_levels')
+def clipping_ratio(analysis):
+    """Fraction of recorded samples at full scale."""
+    if analysis.full_scale is None or len(analysis.rec) == 0:
+        return None
+    return analysis.product('rec_levels')['clipped'] / len(analysis.rec)
+
+
+class SpectralAnalysis:
+    """
+    Shared analysis of one aligned channel pair.
+    The Welch segment spectra (Hann window, 50% overlap, constant detrend, as in
+    scipy.signal.coherence) of both signals and the products derived from them are computed
+    once, on demand, and shared by every metric and by the spectrogram of the visualizer.
+    A metric declares the products it needs, so adding a metric over existing products adds
+    no FFT work.
+    """
+    # Metrics of AudioEvaluator.evaluate, in order
+    DEFAULT_METRICS = ['mean_squared_error', 'average_spectral_coherence', 'snr_db', 'thd_n_db',
+                       'band_response_db', 'dc_offset', 'clipping_ratio']
+
+    def __init__(self, orig: np.ndarray, rec: np.ndarray, rate: int, full_scale: float = None,
+                 orig_start: int = 0, rec_start: int = 0, nperseg: int = None, orig_spectra: np.ndarray = None,
+                 segment_start: int = 0):
+        """
+        :param orig: Aligned original channel (float).
+        :param rec: Aligned recorded channel (float), same length as `orig`.
+        :param rate: Sample rate.
+        :param full_scale: Largest sample magnitude of the recorded format, for the clipping ratio.
+        :param orig_start: Frame of the original the aligned signals start at (for spectrogram times).
+        :param rec_start: Frame of the recording the aligned signals start at.
+        :param nperseg: FFT segment size, AudioEvaluator.COHERENCE_NPERSEG if None.
+        :param orig_spectra: Already computed segment spectra of `orig` (e.g. from a PreparedReference).
+        :param segment_start: Sample of the aligned signals the first Welch segment starts at, so the
+                              segments line up with `orig_spectra`; the time domain metrics use all samples.
+        """
+        self.orig = orig
+        self.rec = rec
+        self.rate = rate
+        self.full_scale = full_scale
+        self.orig_start = orig_start
+        self.rec_start = rec_start
+        self.segment_start = segment_start
+        self.nperseg = min(len(orig) - segment_start, nperseg or AudioEvaluator.COHERENCE_NPERSEG)
+        self.hop = self.nperseg - self.nperseg // 2
+        self._products = {}
+        if orig_spectra is not None:
+            self._products['orig_spectra'] = orig_spectra
+
+    @property
+    def freqs(self):
+        return np.fft.rfftfreq(self.nperseg, 1 / self.rate)
+
+    def product(self, name: str):
+        """Product of the analysis, computed on first use."""
+        value = self._products.get(name)
+        if value is None:
+            with Instrument.span(f'analysis.{name}', nbytes=self.orig.nbytes + self.rec.nbytes):
+                value = self._products[name] = PRODUCTS[name](self)
+        return value
+
+    def metrics(self, names=None):
+        """
+        Compute metrics from the shared products.
+        :param names: Metric names (keys of METRICS), DEFAULT_METRICS if None.
+        :return: {name: value}; metrics needing spectra are None when the signals are empty.
+        """
+        names = names or SpectralAnalysis.DEFAULT_METRICS
+        unknown = set(names) - set(METRICS)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {sorted(unknown)}")
+        if self.nperseg == 0:
+            return {name: 0.0 if name == 'average_spectral_coherence' else None for name in names}
+        # every product needed is computed once, before the metrics read it
+        for product in dict.fromkeys(p for name in names for p in METRICS[name].requires):
+            self.product(product)
+        return {name: METRICS[name](self) for name in names}
+
+    def spectrogram(self, which: str, n_cols: int, start_sec: float = None, end_sec: float = None):
+        """
+        PSD spectrogram of one signal from the shared segment spectra.
+        Neighbouring segments are averaged so there are at most `n_cols` time frames.
+        :param which: 'orig' or 'rec'.
+        :param start_sec: Only frames from this time (in the timeline of that signal's file).
+        :param end_sec: Only frames up to this time.
+        :return: f, t, Sxx with t in seconds of the file of the signal
+        """
+        spectra = self.product(f'{which}_spectra')
+        offset = (self.orig_start if which == 'orig' else self.rec_start) + self.segment_start
+        t = (offset + np.arange(len(spectra)) * self.hop + self.nperseg / 2) / self.rate
+        keep = np.ones(len(t), dtype=bool)
+        if start_sec is not None:
+            keep &= t >= start_sec
+        if end_sec is not None:
+            keep &= t <= end_sec
+        first = int(np.argmax(keep)) if np.any(keep) else 0
+        n = int(np.count_nonzero(keep))
+        power = np.abs(spectra[first:first + n]) ** 2
+        t = t[first:first + n]
+
+        group = max(1, -(-n // max(n_cols, 1)))
+        n_groups = -(-n // group)
+        edges = np.arange(n_groups) * group
+        if n:
+            power = np.add.reduceat(power, edges, axis=0) / np.diff(np.append(edges, n))[:, None]
+            t = np.add.reduceat(t, edges) / np.diff(np.append(edges, n))
+        window_power = np.sum(get_window('hann', self.nperseg) ** 2) if self.nperseg else 1.0
+        Sxx = power / (self.rate * window_power)
+        Sxx[:, 1:(self.nperseg + 1) // 2] *= 2
+        return self.freqs, t, Sxx.T
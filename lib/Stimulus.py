@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from lib.AudioData import AudioData
+from lib.AudioWriter import AudioWriter
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+# Bump when the synthesis changes, so cached stimuli are generated again
+STIMULUS_VERSION = 1
+
+# Kellet's pinking filter (-3 dB/octave)
+_PINK_B = np.array([0.049922035, -0.095993537, 0.050612699, -0.004408786])
+_PINK_A = np.array([1, -2.494956002, 2.017265875, -0.522189400])
+
+
+class Stimulus:
+    """
+    Stimulus class for synthesizing test signals.
+    Signals are synthesized block by block in float32 (multi-tones by rotating a per-block
+    sin/cos table, i.e. one small matrix product per block) and written straight into the
+    integer output. Deterministic stimuli are kept in an on-disk cache keyed by a hash of
+    their parameters and loaded as memory-mapped arrays on later runs.
+
+    Kinds and their parameters:
+        sine:        freq
+        multi_sine:  freqs
+        chirp:       f0, f1 (logarithmic sweep over the whole duration)
+        white_noise: seed
+        pink_noise:  seed
+        mls:         nbits (maximum length sequence, repeated)
+    """
+    # Frames synthesized per block
+    BLOCK = 2 ** 16
+
+    @staticmethod
+    def cache_dir():
+        """Directory of cached stimuli ($KAST_CACHE_DIR/stimuli, ~/.cache/kast/stimuli by default)."""
+        root = os.environ.get('KAST_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'kast')
+        return os.path.join(root, 'stimuli')
+
+    @staticmethod
+    def _key(kind: str, n_frames: int, rate: int, width: int, channels: int, amp: float, params: dict):
+        desc = {'kind': kind, 'frames': n_frames, 'rate': rate, 'width': width, 'channels': channels,
+                'amp': amp, 'params': params, 'version': STIMULUS_VERSION}
+        return hashlib.sha256(json.dumps(desc, sort_keys=True, default=float).encode()).hexdigest()
+
+    @staticmethod
+    def _multi_sine_blocks(n_frames: int, rate: int, freqs):
+        """Average of sines at `freqs`, each block computed from one sin/cos table."""
+        w = 2. * np.pi * np.asarray(freqs, dtype=np.float64) / rate
+        n = np.arange(Stimulus.BLOCK, dtype=np.float64)[:, None]
+        sin_table = np.sin(n * w).astype(np.float32)
+        cos_table = np.cos(n * w).astype(np.float32)
+        for start in range(0, n_frames, Stimulus.BLOCK):
+            length = min(Stimulus.BLOCK, n_frames - start)
+            # sin(w*n + phase) = sin(w*n)*cos(phase) + cos(w*n)*sin(phase)
+            phase = np.mod(w * start, 2. * np.pi)
+            block = sin_table[:length] @ np.cos(phase).astype(np.float32) + \
+                    cos_table[:length] @ np.sin(phase).astype(np.float32)
+            yield block / len(w)
+
+    @staticmethod
+    def _chirp_blocks(n_frames: int, rate: int, f0: float, f1: float):
+        from scipy import signal
+        duration = n_frames / rate
+        for start in range(0, n_frames, Stimulus.BLOCK):
+            t = np.arange(start, min(start + Stimulus.BLOCK, n_frames)) / rate
+            yield signal.chirp(t, f0, duration, f1, method='logarithmic').astype(np.float32)
+
+    @staticmethod
+    def _noise_blocks(n_frames: int, seed, pink: bool = False):
+        """Gaussian noise with a standard deviation of 1/4, so it rarely exceeds full scale."""
+        from scipy import signal
+        rng = np.random.default_rng(seed)
+        if pink:
+            impulse = np.zeros(2 ** 16)
+            impulse[0] = 1
+            gain = np.sqrt(np.sum(signal.lfilter(_PINK_B, _PINK_A, impulse) ** 2))
+            zi = np.zeros(len(_PINK_A) - 1)
+        for start in range(0, n_frames, Stimulus.BLOCK):
+            block = rng.standard_normal(min(Stimulus.BLOCK, n_frames - start), dtype=np.float32)
+            if pink:
+                block, zi = signal.lfilter(_PINK_B, _PINK_A, block, zi=zi)
+                block = (block / gain).astype(np.float32)
+            yield np.clip(block * np.float32(0.25), -1, 1)
+
+    @staticmethod
+    def _mls_blocks(n_frames: int, nbits: int):
+        from scipy import signal
+        sequence = signal.max_len_seq(nbits)[0].astype(np.float32) * 2 - 1
+        for start in range(0, n_frames, Stimulus.BLOCK):
+            index = np.arange(start, min(start + Stimulus.BLOCK, n_frames)) % len(sequence)
+            yield sequence[index]
+
+    @staticmethod
+    def _blocks(kind: str, n_frames: int, rate: int, params: dict):
+        """Generator of mono float32 blocks in [-1, 1]."""
+        if kind == 'sine':
+            return Stimulus._multi_sine_blocks(n_frames, rate, [params['freq']])
+        if kind == 'multi_sine':
+            return Stimulus._multi_sine_blocks(n_frames, rate, params['freqs'])
+        if kind == 'chirp':
+            return Stimulus._chirp_blocks(n_frames, rate, params.get('f0', 20.), params.get('f1', rate / 2 * 0.9))
+        if kind in ('white_noise', 'pink_noise'):
+            return Stimulus._noise_blocks(n_frames, params.get('seed'), pink=kind == 'pink_noise')
+        if kind == 'mls':
+            return Stimulus._mls_blocks(n_frames, params.get('nbits', 16))
+        raise ValueError(f"Unknown stimulus kind: {kind}")
+
+    @staticmethod
+    def _nptype(width: int):
+        return [np.int8, np.int16, np.int32, np.int32][width-1]
+
+    @staticmethod
+    def _amp(amp: float, width: int):
+        """Peak amplitude, 90% of full scale if negative."""
+        return (2 ** (width * 8 - 1) - 1) * 0.9 if amp < 0 else amp
+
+    @staticmethod
+    def _quantize(block: np.ndarray, amp: float, nptype):
+        return (block * np.float32(amp)).astype(nptype)
+
+    @staticmethod
+    def generate(kind: str, duration: float, amp: float = -1, rate: int = 48000, width: int = 4,
+                 channels: int = 2, cache: bool = True, **params):
+        """
+        Synthesize a stimulus, identical on every channel.
+        :param kind: One of sine, multi_sine, chirp, white_noise, pink_noise, mls.
+        :param amp: Peak amplitude, 90% of full scale if negative.
+        :param cache: Load/store the stimulus in the on-disk cache. Noise without a `seed`
+                      is random and never cached.
+        :param params: Parameters of the kind (see the class docstring).
+        :return: AudioData (backed by a memory-mapped cache file when cached)
+        """
+        n_frames = int(rate * duration)
+        nptype = Stimulus._nptype(width)
+        amp = Stimulus._amp(amp, width)
+        if kind in ('white_noise', 'pink_noise') and params.get('seed') is None:
+            cache = False
+
+        path = None
+        if cache:
+            key = Stimulus._key(kind, n_frames, rate, width, channels, amp, params)
+            path = os.path.join(Stimulus.cache_dir(), f"{key}.npy")
+            if os.path.exists(path):
+                logger.info(f"Load cached {kind} stimulus: {path}")
+                data = np.load(path, mmap_mode='r')
+                return AudioData(data=data, sample_rate=rate, sample_width=width, channels=channels)
+
+        logger.info(f"Make {kind} stimulus: {rate}, {channels}ch, amp: {amp}, {params}, {duration}s")
+        if path is None:
+            data = np.empty(n_frames * channels, dtype=nptype)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=nptype, shape=(n_frames * channels,))
+        frames = data.reshape(-1, channels)
+        with Instrument.span('stimulus', nbytes=data.nbytes, kind=kind, cached=path is not None):
+            pos = 0
+            for block in Stimulus._blocks(kind, n_frames, rate, params):
+                frames[pos:pos + len(block)] = Stimulus._quantize(block, amp, nptype)[:, None]
+                pos += len(block)
+
+        if path is not None:
+            data.flush()
+            del frames, data
+            os.replace(tmp_path, path)
+            data = np.load(path, mmap_mode='r')
+        return AudioData(data=data, sample_rate=rate, sample_width=width, channels=channels)
+
+    @staticmethod
+    def write(file_path: str, kind: str, duration: float, amp: float = -1, rate: int = 48000, width: int = 4,
+              channels: int = 2, threads: int = None, **params):
+        """
+        Synthesize a stimulus block by block straight into a WAV or FLAC file (see AudioWriter).
+        Only one block is in memory, so the length is bounded by the disk, not the memory.
+        Parameters as in generate; the samples are identical to those of generate.
+        :param threads: Encoder threads of FLAC output.
+        :return: Number of frames written
+        """
+        n_frames = int(rate * duration)
+        nptype = Stimulus._nptype(width)
+        amp = Stimulus._amp(amp, width)
+        logger.info(f"Write {kind} stimulus: {rate}, {channels}ch, amp: {amp}, {params}, {duration}s to {file_path}")
+        with Instrument.span('stimulus', nbytes=n_frames * channels * width, kind=kind, path=file_path), \
+                AudioWriter(file_path, rate, width, channels, threads=threads) as writer:
+            for block in Stimulus._blocks(kind, n_frames, rate, params):
+                block = Stimulus._quantize(block, amp, nptype)
+                writer.write(np.broadcast_to(block[:, None], (len(block), channels)))
+        return n_frames
+
+    @staticmethod
+    def clear_cache():
+        """Remove all cached stimuli."""
+        cache_dir = Stimulus.cache_dir()
+        if not os.path.isdir(cache_dir):
+            return 0
+        removed = 0
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npy') or name.endswith('.tmp'):
+                os.remove(os.path.join(cache_dir, name))
+                removed += 1
+        return removed
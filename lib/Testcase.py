@@ -1,16 +1,40 @@
+import logging
 import os
-from lib.AudioData import AudioData
-from lib.Visualizer import Visualizer
-from lib.AudioFilter import AudioFilter, AudioNoise
-from lib.AudioEvaluator import AudioEvaluator
+from lib.Stimulus import Stimulus
+from lib.ResultCache import ResultCache
+
+logger = logging.getLogger(__name__)
 
 class Testcase:
+    # Files written by create_audio_test
+    TEST_FILES = ['input.wav', 'output.wav']
+
+    @staticmethod
+    def _test_audio_unchanged(target_dir, key):
+        """Whether target_dir still holds the test audio generated by this library version."""
+        generated = ResultCache.get(key)
+        if generated is None:
+            return False
+        for name in Testcase.TEST_FILES:
+            path = f"{target_dir}/{name}"
+            if not os.path.exists(path) or ResultCache.file_hash(path) != generated.get(name):
+                return False
+        return True
+
     @staticmethod
     def create_audio_test(target_dir):
         # mkdirs target_dir
         os.makedirs(target_dir, exist_ok=True)
+        key = ResultCache.key('testcase', [])
+        if Testcase._test_audio_unchanged(target_dir, key):
+            logger.info(f"Test audio in '{target_dir}' is up to date, skip generation")
+            return
+        # scipy.signal is only needed to generate
+        from lib.AudioFilter import AudioFilter, AudioNoise
+
         # 1. Make sine
-        input_audio = AudioData.from_sine(
+        input_audio = Stimulus.generate(
+            'sine',
             duration=3,
             freq=10,
             rate=48000,
@@ -21,8 +45,9 @@ class Testcase:
         # 2. Copy from input
         output_audio = input_audio.copy()
 
-        # 3. Add noise
-        output_audio.apply(AudioNoise.clipping, multiple=0.8) \
+        # 3. Add noise (deferred, the whole chain is quantized once at materialize)
+        output_audio.defer() \
+                    .apply(AudioNoise.clipping, multiple=0.8) \
                     .apply(AudioNoise.dc_offset, offset=output_audio.max_amp * 0.2) \
                     .apply(AudioNoise.pop_noise, target_sec=1.0) \
                     .apply(AudioNoise.pop_noise, target_sec=2.2, target_channel=[1],
@@ -31,6 +56,7 @@ class Testcase:
         # # add normalized noise with 2% of max value
         # #output_audio = input_audio.copy()
         output_audio.apply(AudioNoise.normalized_noise, noise_level=output_audio.max_amp * 0.02)
+        output_audio.materialize()
 
         # # add normalized noise with 20% of max data
         # output_audio = input_audio.copy()
@@ -65,44 +91,84 @@ class Testcase:
 
         input_audio.save(f"{target_dir}/input.wav")
         output_audio.save(f"{target_dir}/output.wav")
+        ResultCache.put(key, {name: ResultCache.file_hash(f"{target_dir}/{name}") for name in Testcase.TEST_FILES})
 
     @staticmethod
-    def visualize_audio_test(input_dir, output_dir):
+    def visualize_audio_test(input_dir, output_dir, start_sec=None, end_sec=None):
         os.makedirs(input_dir, exist_ok=True)
         os.makedirs(output_dir, exist_ok=True)
-        input_audio = AudioData.from_file(f"{input_dir}/input.wav")
-        output_audio = AudioData.from_file(f"{input_dir}/output.wav")
         path = f"{output_dir}/visualized_audio.png"
-        Visualizer.plot_audio_data(path, input_audio, output_audio)
+        ResultCache.plot(path, f"{input_dir}/input.wav", f"{input_dir}/output.wav", start_sec, end_sec)
 
     @staticmethod
-    def evaluate_audio_test(input_dir):
+    def evaluate_audio_test(input_dir, output_dir=None):
         """
-        evaluate audio test
+        evaluate audio test, and plot it to output_dir from the same analysis if given
         """
-        input_audio = AudioData.from_file(f"{input_dir}/input.wav")
-        output_audio = AudioData.from_file(f"{input_dir}/output.wav")
-        
-        evaluation_results = AudioEvaluator.evaluate(input_audio, output_audio)
+        plot_path = None
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            plot_path = f"{output_dir}/visualized_audio.png"
+        evaluation_results = ResultCache.evaluate(f"{input_dir}/input.wav", f"{input_dir}/output.wav",
+                                                  plot_path=plot_path)
+        Testcase.print_evaluation(evaluation_results)
 
+    @staticmethod
+    def detect_events_test(input_dir, output_dir=None):
+        """
+        detect pops, dropouts, cuts, DC steps and clipping in the test recording
+        """
+        plot_path = None
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            plot_path = f"{output_dir}/events.png"
+        events = ResultCache.detect_events(f"{input_dir}/input.wav", f"{input_dir}/output.wav", plot_path=plot_path)
+        Testcase.print_events(events)
+
+    @staticmethod
+    def print_evaluation(results):
+        """
+        print evaluation results per channel
+        """
         # 보기 쉽게 결과 출력
         print("\n\n================================")
         print("    Correlation Evaluation Results")
         print("================================")
-        for ch, metrics in evaluation_results.items():
+        for ch, metrics in results.items():
             print(f"\n▶ Channel {ch.split('_')[-1]}")
             for key, value in metrics.items():
                 # Show key in a more readable format
                 key_name = key.replace('_', ' ').title()
                 if isinstance(value, float):
                     print(f"  - {key_name}: {value:.4f}")
+                elif isinstance(value, dict):
+                    print(f"  - {key_name}:")
+                    for band, band_value in value.items():
+                        print(f"      {band:>6} Hz: " + ('-' if band_value is None else f"{band_value:+.2f}"))
+                elif isinstance(value, list):
+                    # lag curve of drift tracking: first and last point
+                    print(f"  - {key_name}: {len(value)} points" + (
+                        f", {value[0]['lag_samples']:.2f} -> {value[-1]['lag_samples']:.2f} samples" if value else ''))
                 else:
                     print(f"  - {key_name}: {value}")
         print("\n================================")
 
+    @staticmethod
+    def print_events(events):
+        """
+        print detected events, one line per event
+        """
+        print("\n================================")
+        print(f"    Detected Events ({len(events)})")
+        print("================================")
+        for event in events:
+            print(f"  - {event['start_sec']:9.4f}s ch{event['channel']} {event['type']:<9} "
+                  f"{event['end_sec'] - event['start_sec']:.4f}s, severity {event['severity']:.4g}")
+        print("\n================================")
+
     @staticmethod
     def run_test(args):
-        print(args)
+        logger.info(args)
         Testcase.create_audio_test(args.input)
-        Testcase.visualize_audio_test(args.input, args.output)
-        Testcase.evaluate_audio_test(args.input)
\ No newline at end of file
+        Testcase.evaluate_audio_test(args.input, args.output)
+        Testcase.detect_events_test(args.input, args.output)
\ No newline at end of file
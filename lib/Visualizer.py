@@ -1,27 +1,83 @@
+import itertools
+import logging
 import numpy as np
 from scipy import signal
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from lib.Instrument import Instrument
+
+logger = logging.getLogger(__name__)
 
 class Visualizer:
     """
     Visualizer class for plotting audio data.
     Provides methods to plot waveforms and spectrograms of audio files.
+    Waveforms are reduced to a min/max envelope per pixel column and spectrograms are
+    computed on at most one frame per pixel column, so plot time depends on the output
+    resolution instead of the input length.
     """
+    # Segment size of the spectrogram frames
+    NPERSEG = 256
+
+    @staticmethod
+    def _envelope(data, n_cols: int):
+        """
+        Min/max envelope of a signal with one (min, max) pair per column.
+        :return: (index, value) arrays tracing the envelope as vertical strokes,
+                 or the samples themselves when there are fewer than 2 per column.
+        """
+        if len(data) <= 2 * n_cols:
+            return np.arange(len(data)), data
+        edges = np.linspace(0, len(data), n_cols + 1).astype(np.int64)[:-1]
+        lo = np.minimum.reduceat(data, edges)
+        hi = np.maximum.reduceat(data, edges)
+        return np.repeat(edges, 2), np.column_stack((lo, hi)).ravel()
+
     @staticmethod
-    def plot_wave(fig, axs, data, rate, color, label, alpha=0.5, title="", xlabel="", ylabel=""):
-        time = np.arange(len(data))/rate
-        axs.plot(time, data, color, label=label, alpha=alpha)
+    def _spectrogram(frames, rate, n_cols: int, nperseg: int = None):
+        """
+        PSD spectrogram of all channels of a (frames, channels) array in one pass.
+        Uses scipy.signal.spectrogram defaults (Tukey window, constant detrend, density scaling),
+        but the hop grows with the signal length so there are at most `n_cols` time frames.
+        :return: f, t, Sxx with Sxx of shape (channels, freqs, times)
+        """
+        nperseg = nperseg or Visualizer.NPERSEG
+        nperseg = min(nperseg, len(frames))
+        hop = max(nperseg - nperseg // 8, -(-(len(frames) - nperseg) // max(n_cols, 1)))
+        starts = np.arange(0, len(frames) - nperseg + 1, hop)
+        window = signal.get_window(('tukey', .25), nperseg)
+
+        segments = np.lib.stride_tricks.sliding_window_view(frames, nperseg, axis=0)[starts]
+        segments = segments.astype(np.float32)  # (times, channels, nperseg)
+        segments -= segments.mean(axis=-1, keepdims=True)
+        spectrum = np.fft.rfft(segments * window, axis=-1)
+        Sxx = np.abs(spectrum) ** 2 / (rate * np.sum(window ** 2))
+        Sxx[..., 1:(nperseg + 1) // 2] *= 2
+        f = np.fft.rfftfreq(nperseg, 1 / rate)
+        t = (starts + nperseg / 2) / rate
+        return f, t, np.transpose(Sxx, (1, 2, 0))
+
+    @staticmethod
+    def plot_wave(fig, axs, data, rate, color, label, alpha=0.5, title="", xlabel="", ylabel="", start_sec=0.0):
+        n_cols = int(fig.get_figwidth() * fig.dpi)
+        index, values = Visualizer._envelope(data, n_cols)
+        axs.plot(start_sec + index / rate, values, color, label=label, alpha=alpha, rasterized=True)
         if(title): axs.set_title(title)
         if(xlabel): axs.set_xlabel(xlabel)
         if(ylabel): axs.set_ylabel(ylabel)
         axs.legend()
         axs.grid(True)
-        axs.set_xlim(0, len(data)/rate)
+        axs.set_xlim(start_sec, start_sec + len(data)/rate)
 
     @staticmethod
-    def plot_spectrum(fig, axs, data, rate, title="", xlabel="", ylabel=""):
-        f, t, Sxx = signal.spectrogram(data, rate)
-        im1 = axs.pcolormesh(t, f, 10 * np.log10(Sxx + 1e-9), shading='gouraud', cmap='magma')
+    def plot_spectrum(fig, axs, data, rate, title="", xlabel="", ylabel="", start_sec=0.0, spectrum=None):
+        """Plot a spectrogram; `spectrum` is a precomputed (f, t, Sxx) of this channel."""
+        if spectrum is None:
+            f, t, Sxx = Visualizer._spectrogram(data.reshape(-1, 1), rate, int(fig.get_figwidth() * fig.dpi))
+            spectrum = (f, t, Sxx[0])
+        f, t, Sxx = spectrum
+        im1 = axs.pcolormesh(start_sec + t, f, 10 * np.log10(Sxx + 1e-9), shading='nearest', cmap='magma',
+                             rasterized=True)
         if(title): axs.set_title(title)
         if(xlabel): axs.set_xlabel(xlabel)
         if(ylabel): axs.set_ylabel(ylabel)
@@ -30,36 +86,117 @@ class Visualizer:
         fig.colorbar(im1, ax=axs, format='%+2.0f dB', label='Intensity [dB]')
 
     @staticmethod
-    def plot_audio_data(path, orig, rec):
-        """Plot wave form and spectrum of audio data."""
-        print(f"\n[Visualizer] plot '{path}' as file...")
-        
+    def _window(audio, start_sec=None, end_sec=None):
+        """(frames, channels) view of the time window; only this part of a memory-mapped file is read."""
+        start = int((start_sec or 0) * audio.sample_rate)
+        end = None if end_sec is None else int(end_sec * audio.sample_rate)
+        return audio.frames[start:end]
+
+    @staticmethod
+    def plot_audio_data(path, orig, rec, start_sec=None, end_sec=None, analyses=None):
+        """
+        Plot wave form and spectrum of audio data.
+        :param start_sec: Start of the time window to plot, the beginning if None.
+        :param end_sec: End of the time window to plot, the end if None.
+        :param analyses: SpectralAnalysis per channel (see AudioEvaluator.analyze); the spectrograms
+                         are then taken from its segment spectra instead of a separate STFT.
+        """
+        logger.info(f"[Visualizer] plot '{path}' as file...")
+        offset = start_sec or 0.0
+        orig_frames = Visualizer._window(orig, start_sec, end_sec)
+        rec_frames = Visualizer._window(rec, start_sec, end_sec)
+        with Instrument.span('plot', nbytes=orig_frames.nbytes + rec_frames.nbytes, path=path):
+            Visualizer._plot_frames(path, orig, rec, orig_frames, rec_frames, offset, analyses, end_sec)
+
+    @staticmethod
+    def _plot_frames(path, orig, rec, orig_frames, rec_frames, offset, analyses=None, end_sec=None):
+
         # wave, orig spectrum, rec spectrum
         n_plot = orig.channels + \
                  orig.channels + \
                  rec.channels
 
-        fig, axs = plt.subplots(n_plot, 1, figsize=(15, 12))
+        fig = Figure(figsize=(15, 12))
+        FigureCanvasAgg(fig)
+        axs = np.atleast_1d(fig.subplots(n_plot, 1))
         fig.suptitle('Original vs. Recorded', fontsize=16)
+        n_cols = int(fig.get_figwidth() * fig.dpi)
 
         plot_pos = 0
         # plot wave form
-        for ch in range(orig.channels):
-            Visualizer.plot_wave(fig, axs[ch + plot_pos], orig.getData(ch), orig.sample_rate, 'b-', 'Original', 0.8)
-            Visualizer.plot_wave(fig, axs[ch + plot_pos], rec.getData(ch), rec.sample_rate, 'r-', 'Recorded', 0.6,
-                                    f'Full Waveform Comparison - {ch} channel', 'Time (s)', 'Amplitude')
+        with Instrument.span('plot.wave'):
+            for ch in range(orig.channels):
+                Visualizer.plot_wave(fig, axs[ch + plot_pos], orig_frames[:, ch], orig.sample_rate, 'b-', 'Original',
+                                     0.8, start_sec=offset)
+                Visualizer.plot_wave(fig, axs[ch + plot_pos], rec_frames[:, ch], rec.sample_rate, 'r-', 'Recorded',
+                                     0.6, f'Full Waveform Comparison - {ch} channel', 'Time (s)', 'Amplitude', offset)
         plot_pos += orig.channels
 
-        for ch in range(orig.channels):
-            Visualizer.plot_spectrum(fig, axs[ch + plot_pos], orig.getData(ch), orig.sample_rate,
-                                    f'Original Spectrogram - {ch} channel', 'Time [sec]', 'Frequency [Hz]')
-        plot_pos += orig.channels
+        # one STFT pass per signal (or the analysis of the evaluation), shared by its spectrogram panels
+        for which, audio, frames, label in (('orig', orig, orig_frames, 'Original'),
+                                            ('rec', rec, rec_frames, 'Recorded')):
+            with Instrument.span('plot.spectrogram', nbytes=frames.nbytes):
+                if analyses is None:
+                    f, t, Sxx = Visualizer._spectrogram(frames, audio.sample_rate, n_cols)
+                    spectra = [(f, t, Sxx[ch]) for ch in range(audio.channels)]
+                    start = offset
+                else:
+                    spectra = [analysis.spectrogram(which, n_cols, offset, end_sec) for analysis in analyses]
+                    start = 0.0
+            for ch in range(audio.channels):
+                Visualizer.plot_spectrum(fig, axs[ch + plot_pos], None, audio.sample_rate,
+                                        f'{label} Spectrogram - {ch} channel', 'Time [sec]', 'Frequency [Hz]',
+                                        start, spectra[ch])
+            plot_pos += audio.channels
+
+        with Instrument.span('plot.render'):
+            fig.tight_layout(rect=[0, 0, 1, 0.96])
+            fig.savefig(path)
 
-        for ch in range(rec.channels):
-            Visualizer.plot_spectrum(fig, axs[ch + plot_pos], rec.getData(ch), rec.sample_rate,
-                                    f'Recorded Spectrogram - {ch} channel', 'Time [sec]', 'Frequency [Hz]')
-        plot_pos += rec.channels
+    @staticmethod
+    def plot_events(path, orig, rec, events, context_sec=0.02, max_events=16, n_cols=4):
+        """
+        Plot a zoomed view of the original and the recording around detected events.
+        :param events: Events of EventDetector.detect; the most severe of each type come first
+                       when there are more than `max_events`.
+        :param context_sec: Time shown before and after each event.
+        """
+        logger.info(f"[Visualizer] plot {min(len(events), max_events)} of {len(events)} events to '{path}'...")
+        shown = sorted(events, key=lambda e: -e['severity'])
+        # round-robin over the event types so one frequent type does not hide the others
+        by_type = {}
+        for event in shown:
+            by_type.setdefault(event['type'], []).append(event)
+        shown = [event for group in itertools.zip_longest(*by_type.values()) for event in group if event]
+        shown = sorted(shown[:max_events], key=lambda e: (e['start_sec'], e['channel']))
 
-        plt.tight_layout(rect=[0, 0, 1, 0.96])
-        plt.savefig(path)
-        #plt.show()
\ No newline at end of file
+        n_rows = max(1, -(-len(shown) // n_cols))
+        fig = Figure(figsize=(4 * n_cols, 3 * n_rows))
+        FigureCanvasAgg(fig)
+        axs = np.atleast_1d(fig.subplots(n_rows, n_cols)).ravel()
+        fig.suptitle('Detected events' if shown else 'No events detected', fontsize=16)
+        with Instrument.span('plot.events', events=len(shown)):
+            for ax, event in zip(axs, shown):
+                rate, ch = rec.sample_rate, event['channel']
+                start = max(int((event['start_sec'] - context_sec) * rate), 0)
+                end = min(int((event['end_sec'] + context_sec) * rate), rec.n_frames)
+                t = np.arange(start, end) / rate
+                # original frame = recorded frame + lag
+                orig_start = start + event['lag_samples']
+                first, last = max(orig_start, 0), min(orig_start + end - start, orig.n_frames)
+                if first < last:
+                    ax.plot(t[first - orig_start:last - orig_start], orig.frames[first:last, ch], 'b-',
+                            label='Original', alpha=0.8)
+                ax.plot(t, rec.frames[start:end, ch], 'r-', label='Recorded', alpha=0.6)
+                ax.axvspan(event['start_sec'], max(event['end_sec'], event['start_sec'] + 1 / rate),
+                           color='orange', alpha=0.3)
+                ax.set_title(f"{event['type']} ch{ch} @ {event['start_sec']:.4f}s ({event['severity']:.4g})",
+                             fontsize=9)
+                ax.set_xlabel('Time (s)')
+                ax.grid(True)
+            if shown:
+                axs[0].legend(fontsize=8)
+            for ax in axs[len(shown):]:
+                ax.set_visible(False)
+            fig.tight_layout(rect=[0, 0, 1, 0.95])
+            fig.savefig(path)
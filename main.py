@@ -1,14 +1,203 @@
 import argparse
-from lib.AudioData import AudioData
-from lib.Visualizer import Visualizer
-from lib.Testcase import Testcase
+import json
+import logging
+import sys
+# only light modules at startup: numpy/scipy/matplotlib are imported by the commands that need them
+from lib.Instrument import Instrument, LogSink
+from lib.ResultCache import ResultCache
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+def float_list(value):
+    return [float(v) for v in value.split(',')]
+
+def summarize(results):
+    return ', '.join(f"ch{ch.split('_')[-1]} corr {m['peak_cross_correlation']:.4f} "
+                     f"mse {m['mean_squared_error']:.4g} coh {m['average_spectral_coherence']:.4f}"
+                     for ch, m in results.items())
+
+def to_json(value):
+    """numpy scalars/arrays in results as plain JSON values."""
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def print_json(value):
+    print(json.dumps(ResultCache.plain_json(value), indent=2, default=to_json, allow_nan=False))
+
+def generate(args):
+    from lib.Stimulus import Stimulus
+    params = {name: getattr(args, name) for name in ('freq', 'freqs', 'f0', 'f1', 'seed', 'nbits')
+              if getattr(args, name) is not None}
+    if args.kind == 'sine':
+        params.setdefault('freq', 1000.)
+    n_frames = Stimulus.write(args.path, args.kind, args.duration, amp=args.amp, rate=args.rate, width=args.width,
+                              channels=args.channels, threads=args.threads, **params)
+    if args.json:
+        print_json({'path': args.path, 'kind': args.kind, 'frames': n_frames, 'params': params})
+
+def evaluate(args):
+    results = ResultCache.evaluate(args.original, args.recorded, args.max_lag, args.subsample, plot_path=args.plot,
+                                  drift=args.drift)
+    events = None
+    if args.events:
+        events = ResultCache.detect_events(args.original, args.recorded, args.max_lag)
+    if args.json:
+        print_json(results if events is None else {'results': results, 'events': events})
+        return
+    from lib.Testcase import Testcase
+    Testcase.print_evaluation(results)
+    if events is not None:
+        Testcase.print_events(events)
+
+def plot(args):
+    if args.events:
+        events = ResultCache.detect_events(args.original, args.recorded, plot_path=args.path)
+        if args.json:
+            print_json({'path': args.path, 'events': events})
+        return
+    ResultCache.plot(args.path, args.original, args.recorded, args.start_sec, args.end_sec)
+    if args.json:
+        print_json({'path': args.path})
+
+def batch(args):
+    from lib.BatchRunner import BatchRunner
+    n_ok, n_failed = BatchRunner.run(args.manifest, args.batch_output, workers=args.workers, max_lag=args.max_lag)
+    if args.json:
+        print_json({'output': args.batch_output, 'ok': n_ok, 'failed': n_failed})
+    if n_failed:
+        sys.exit(1)
+
+# subcommand name -> handler(args)
+COMMANDS = {'generate': generate, 'evaluate': evaluate, 'plot': plot, 'batch': batch}
+
+def main(args):
+    """Legacy mode without a subcommand: --test, --batch, --bench and --follow."""
+    if args.clear_cache:
+        from lib.Stimulus import Stimulus
+        print(f"Removed {ResultCache.clear()} cached results and {Stimulus.clear_cache()} cached stimuli")
+    if args.test:
+        from lib.Testcase import Testcase
+        Testcase.run_test(args)
+    if args.batch:
+        from lib.BatchRunner import BatchRunner
+        BatchRunner.run(args.batch, args.batch_output, workers=args.workers)
+    if args.bench:
+        from lib.Benchmark import Benchmark
+        report = Benchmark.run(args.bench_durations, args.bench_channels, args.bench_widths, args.bench_rates,
+                               stages=args.bench_stages, repeat=args.bench_repeat)
+        Benchmark.save(report, args.bench_output)
+        if args.bench_baseline:
+            regressions = Benchmark.compare(report, args.bench_baseline, args.bench_threshold)
+            if regressions:
+                print(f"\n{len(regressions)} benchmark regressions")
+                sys.exit(1)
+    if args.follow:
+        from lib.OnlineEvaluator import OnlineEvaluator
+        for update in OnlineEvaluator.follow(*args.follow, window_sec=args.follow_window):
+            if update['results']:
+                print(f"{update['time_sec']:9.2f}s lag {update['lag_samples']}: {summarize(update['results'])}")
+            if 'total' in update:
+                print(f"    total lag {update['lag_samples']}: {summarize(update['total'])}")
+
+def add_common_arguments(parser, suppress=False):
+    """
+    Options accepted before and after a subcommand.
+    With `suppress` unset options are left out, so a subcommand does not reset what was given before it.
+    """
+    def default(value):
+        return argparse.SUPPRESS if suppress else value
+    parser.add_argument('--json', action='store_true', default=default(False), help='print results as JSON (logs go to stderr)')
+    parser.add_argument('--no-cache', action='store_true', default=default(False), help='do not read or write the result cache')
+    parser.add_argument('--cache-max-mb', action='store', type=int, default=default(1024), help='size bound of the result cache in MiB')
+    parser.add_argument('--log-level', action='store', type=str, default=default('INFO'), help='log level (DEBUG, INFO, WARNING, ...)')
+    parser.add_argument('--profile', action='store_true', default=default(False), help='log the timing of every pipeline stage')
+    parser.add_argument('--profile-memory', action='store_true', default=default(False), help='also record the peak allocation of every stage (slower)')
+    parser.add_argument('--trace', action='store', type=str, default=default(None), help='write stage timings to a file (.jsonl: JSON lines, otherwise Chrome trace)')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Audio correlation checking tool")
     parser.add_argument('--test', action='store_true', help='run test')
     parser.add_argument('--input', action='store', type=str, default='test_audio', help='dir for test audio')
     parser.add_argument('--output', action='store', type=str, default='result', help='dir for test result')
+    parser.add_argument('--batch', action='store', type=str, default=None, help='manifest (csv/jsonl) of input/output pairs to evaluate')
+    parser.add_argument('--batch-output', action='store', type=str, default='result/batch_results.jsonl', help='result file of --batch (.jsonl or .csv)')
+    parser.add_argument('--workers', action='store', type=int, default=None, help='worker processes for --batch (default: all CPUs)')
+    parser.add_argument('--bench', action='store_true', help='run benchmark')
+    parser.add_argument('--bench-output', action='store', type=str, default='result/benchmark.json', help='result file of --bench')
+    parser.add_argument('--bench-baseline', action='store', type=str, default=None, help='baseline benchmark to compare with')
+    parser.add_argument('--bench-threshold', action='store', type=float, default=0.2, help='relative slowdown reported as regression')
+    parser.add_argument('--bench-repeat', action='store', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--bench-stages', action='store', type=lambda v: v.split(','), default=None, help='comma separated stages (default: all)')
+    parser.add_argument('--bench-durations', action='store', type=float_list, default=[1, 10], help='comma separated durations in seconds')
+    parser.add_argument('--bench-channels', action='store', type=int_list, default=[2], help='comma separated channel counts')
+    parser.add_argument('--bench-widths', action='store', type=int_list, default=[2, 4], help='comma separated sample widths in bytes')
+    parser.add_argument('--bench-rates', action='store', type=int_list, default=[48000], help='comma separated sample rates')
+    parser.add_argument('--follow', action='store', nargs=2, metavar=('REFERENCE', 'RECORDING'), default=None, help='evaluate a WAV recording while it is being written')
+    parser.add_argument('--follow-window', action='store', type=float, default=5.0, help='rolling window of --follow in seconds')
+    parser.add_argument('--clear-cache', action='store_true', help='remove cached results and stimuli')
+    add_common_arguments(parser)
+
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND',
+                                     help='run one step instead of the legacy options above')
+    sub = commands.add_parser('generate', help='write a stimulus to a WAV/FLAC file block by block')
+    sub.add_argument('kind', choices=['sine', 'multi_sine', 'chirp', 'white_noise', 'pink_noise', 'mls'], help='stimulus kind')
+    sub.add_argument('path', help='output file (.wav or .flac)')
+    sub.add_argument('--duration', action='store', type=float, default=3.0, help='length in seconds')
+    sub.add_argument('--amp', action='store', type=float, default=-1, help='peak amplitude (default: 90%% of full scale)')
+    sub.add_argument('--rate', action='store', type=int, default=48000, help='sample rate')
+    sub.add_argument('--width', action='store', type=int, default=4, help='sample width in bytes')
+    sub.add_argument('--channels', action='store', type=int, default=2, help='channel count')
+    sub.add_argument('--freq', action='store', type=float, default=None, help='frequency of sine (default: 1000)')
+    sub.add_argument('--freqs', action='store', type=float_list, default=None, help='comma separated frequencies of multi_sine')
+    sub.add_argument('--f0', action='store', type=float, default=None, help='start frequency of chirp')
+    sub.add_argument('--f1', action='store', type=float, default=None, help='end frequency of chirp')
+    sub.add_argument('--seed', action='store', type=int, default=None, help='seed of white_noise/pink_noise')
+    sub.add_argument('--nbits', action='store', type=int, default=None, help='order of mls')
+    sub.add_argument('--threads', action='store', type=int, default=None, help='FLAC encoder threads (default: all CPUs)')
+    add_common_arguments(sub, suppress=True)
+
+    sub = commands.add_parser('evaluate', help='evaluate a recording against its original')
+    sub.add_argument('original', help='original audio file')
+    sub.add_argument('recorded', help='recorded audio file')
+    sub.add_argument('--max-lag', action='store', type=int, default=None, help='largest absolute lag to search in samples')
+    sub.add_argument('--subsample', action='store_true', help='estimate the lag with sub-sample precision')
+    sub.add_argument('--plot', action='store', type=str, default=None, help='also plot the pair to this image')
+    sub.add_argument('--events', action='store_true', help='also detect pops, dropouts, cuts, DC steps and clipping')
+    sub.add_argument('--drift', action='store_true', help='track the lag along the recording and compensate clock drift')
+    add_common_arguments(sub, suppress=True)
+
+    sub = commands.add_parser('plot', help='plot a recording against its original')
+    sub.add_argument('original', help='original audio file')
+    sub.add_argument('recorded', help='recorded audio file')
+    sub.add_argument('path', help='output image')
+    sub.add_argument('--start-sec', action='store', type=float, default=None, help='start of the plotted range')
+    sub.add_argument('--end-sec', action='store', type=float, default=None, help='end of the plotted range')
+    sub.add_argument('--events', action='store_true', help='plot the detected events instead')
+    add_common_arguments(sub, suppress=True)
+
+    sub = commands.add_parser('batch', help='evaluate every pair of a manifest')
+    sub.add_argument('manifest', help='manifest (csv/jsonl) of input/output pairs')
+    sub.add_argument('--output', dest='batch_output', action='store', type=str, default=argparse.SUPPRESS, help='result file (.jsonl or .csv, default: result/batch_results.jsonl)')
+    sub.add_argument('--workers', action='store', type=int, default=argparse.SUPPRESS, help='worker processes (default: all CPUs)')
+    sub.add_argument('--max-lag', action='store', type=int, default=None, help='largest absolute lag to search in samples')
+    add_common_arguments(sub, suppress=True)
     args = parser.parse_args()
 
-    if args.test:
-        Testcase.run_test(args)
\ No newline at end of file
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s',
+                        stream=sys.stderr if args.json else sys.stdout)
+    sinks = []
+    if args.profile:
+        sinks.append(LogSink())
+    if args.trace:
+        sinks.append(Instrument.sink_for(args.trace))
+    Instrument.configure(sinks, track_memory=args.profile_memory)
+    ResultCache.enabled = not args.no_cache
+    ResultCache.max_bytes = args.cache_max_mb * 2 ** 20
+
+    try:
+        if args.command:
+            COMMANDS[args.command](args)
+        else:
+            main(args)
+    finally:
+        Instrument.close()
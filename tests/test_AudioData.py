@@ -0,0 +1,99 @@
+import wave
+import numpy as np
+import pytest
+from lib.AudioData import AudioData
+
+
+@pytest.mark.parametrize('layout', ['interleaved', 'planar'])
+def test_float_channel_converts_only_that_channel(layout):
+    frames = np.arange(30, dtype=np.int16).reshape(10, 3)
+    audio = AudioData(frames, 48000, sample_width=2, channels=3, layout=layout)
+    column = audio.float_channel(-1, np.float64)
+    assert column.dtype == np.float64 and column.flags.c_contiguous
+    assert np.array_equal(column, frames[:, 2])
+    assert column is audio.float_channel(2, np.float64)
+    # its own array, not a column of a float copy of every channel
+    assert column.base is None
+    # the whole-array copy, once made, serves the channels too
+    work = audio.float_frames(np.float64)
+    assert np.shares_memory(audio.float_channel(1, np.float64), work)
+
+
+def _write_wav(path, raw: bytes, sample_width: int, channels: int, rate: int = 48000):
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(sample_width)
+        f.setframerate(rate)
+        f.writeframes(raw)
+
+
+def test_from_wav_maps_16bit_data_without_copy(tmp_path):
+    frames = np.arange(-3000, 3000, dtype=np.int16).reshape(-1, 2)
+    _write_wav(tmp_path / 'a.wav', frames.astype('<i2').tobytes(), 2, 2)
+    audio = AudioData.from_wav(str(tmp_path / 'a.wav'))
+    assert np.array_equal(audio.frames, frames)
+    # a read-only view whose memory belongs to the mapped file
+    base = audio.frames
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap) and not audio.frames.flags.writeable
+
+
+def test_from_wav_decodes_8_and_24bit(tmp_path):
+    values = np.array([[-2 ** 23, 2 ** 23 - 1], [-1, 0], [1, 0x123456]], dtype=np.int32)
+    packed = values.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    _write_wav(tmp_path / '24.wav', packed, 3, 2)
+    audio = AudioData.from_wav(str(tmp_path / '24.wav'))
+    assert audio.sample_width == 3 and np.array_equal(audio.frames, values)
+
+    # 8-bit WAV stores unsigned samples offset by 128
+    _write_wav(tmp_path / '8.wav', bytes([0, 128, 255, 127]), 1, 1)
+    audio = AudioData.from_wav(str(tmp_path / '8.wav'))
+    assert np.array_equal(audio.frames[:, 0], [-128, 0, 127, -1])
+
+
+def test_from_wav_skips_chunks_before_data(tmp_path):
+    frames = np.arange(12, dtype=np.int16).reshape(-1, 3)
+    _write_wav(tmp_path / 'a.wav', frames.tobytes(), 2, 3)
+    raw = (tmp_path / 'a.wav').read_bytes()
+    # an odd-sized LIST chunk between fmt and data, padded to an even size
+    data = raw.index(b'data')
+    raw = raw[:data] + b'LIST' + (5).to_bytes(4, 'little') + b'INFO!\0' + raw[data:]
+    (tmp_path / 'b.wav').write_bytes(raw)
+    assert np.array_equal(AudioData.from_wav(str(tmp_path / 'b.wav')).frames, frames)
+
+
+@pytest.mark.parametrize('sample_width', [2, 3])
+def test_iter_file_blocks_match_the_whole_file(tmp_path, sample_width):
+    rng = np.random.default_rng(0)
+    full = 2 ** (sample_width * 8 - 1)
+    frames = rng.integers(-full, full, size=(1000, 2)).astype(np.int32)
+    raw = frames.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :sample_width].tobytes()
+    _write_wav(tmp_path / 'a.wav', raw, sample_width, 2)
+    blocks = list(AudioData.iter_file(str(tmp_path / 'a.wav'), 300, start_frame=150))
+    assert [block.n_frames for block in blocks] == [300, 300, 250]
+    assert np.array_equal(np.concatenate([block.frames for block in blocks]), frames[150:])
+
+
+def test_layouts_hold_the_same_frames_with_channel_views():
+    frames = np.arange(40, dtype=np.int16).reshape(10, 4)
+    audio = AudioData(frames.reshape(-1), 48000, sample_width=2, channels=4)
+    assert audio.layout == 'interleaved' and audio.frames.flags.c_contiguous
+    assert np.array_equal(audio.data, frames.reshape(-1))
+
+    audio.to_layout('planar')
+    assert audio.layout == 'planar' and np.array_equal(audio.frames, frames)
+    for ch in range(4):
+        view = audio.channel(ch)
+        # a contiguous view of the storage, created once
+        assert view.flags.c_contiguous and np.shares_memory(view, audio.frames) and view is audio.channel(ch)
+    with pytest.raises(IndexError):
+        audio.channel(4)
+
+    # new samples drop the cached views and float copies
+    audio.float_frames()
+    audio.frames = frames[::-1]
+    assert np.array_equal(audio.channel(0), frames[::-1, 0])
+    assert np.array_equal(audio.float_frames()[:, 0], frames[::-1, 0])
+    with pytest.raises(ValueError):
+        audio.frames = np.zeros((10, 3))
@@ -0,0 +1,96 @@
+import wave
+import numpy as np
+import pytest
+from scipy.signal import correlate
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+
+RATE = 48000
+
+
+def _tone_bursts(seed: int, n_frames: int, freq: float = 440, burst: int = 4800):
+    """440 Hz tone switched on and off in random bursts, the coarse lag search sees many similar peaks."""
+    rng = np.random.default_rng(seed)
+    gate = np.repeat(rng.random(n_frames // burst + 1) < 0.6, burst)[:n_frames]
+    return np.sin(2 * np.pi * freq * np.arange(n_frames) / RATE) * gate
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_find_lag_tone_bursts(seed):
+    rng = np.random.default_rng(100 + seed)
+    n_frames, margin = 10 * RATE, 4000
+    signal = _tone_bursts(seed, n_frames + 2 * margin)
+    lag = int(rng.integers(-3000, 3000))
+    orig = signal[margin:margin + n_frames]
+    # recorded frame i is original frame i + lag
+    rec = signal[margin + lag:margin + lag + n_frames] + 0.01 * rng.standard_normal(n_frames)
+
+    found, peak_corr = AudioEvaluator._find_lag(orig, rec)
+    assert found == lag
+    exact = AudioEvaluator._correlation_at(orig, rec, lag, AudioEvaluator._mean_std(orig),
+                                           AudioEvaluator._mean_std(rec))
+    assert peak_corr == pytest.approx(exact)
+
+
+def _shifted(signal, n_frames: int, lag: int, noise: float, seed: int, margin: int = 10000):
+    """Original and recorded windows of `signal` (a function of frame indices); recorded frame i is original i + lag."""
+    frames = signal(np.arange(n_frames + 2 * margin) - margin)
+    rng = np.random.default_rng(seed)
+    return (frames[margin:margin + n_frames],
+            frames[margin + lag:margin + lag + n_frames] + noise * rng.standard_normal(n_frames))
+
+
+@pytest.mark.parametrize('lag', [-269, 1234, -3980])
+def test_find_lag_long_periodic(lag):
+    """A 120 s 10 Hz sine has a correlation peak every period; the one with the most overlap wins."""
+    period = RATE // 10
+    orig, rec = _shifted(lambda t: np.sin(2 * np.pi * 10 * t / RATE), 120 * RATE, lag, 0.05, 1)
+    found, peak_corr = AudioEvaluator._find_lag(orig, rec)
+    assert found == (lag + period // 2) % period - period // 2
+    for bound in (5000, None):
+        assert AudioEvaluator._find_lag(orig, rec, bound)[0] == found
+
+
+@pytest.mark.parametrize('lag, mod, noise', [(-391, 4.14, 0.1), (1440, 3.0, 0.01), (64, 7.0, 0.0)])
+def test_find_lag_am_tone_matches_full_correlation(lag, mod, noise):
+    def am_tone(t):
+        return (1 + 0.5 * np.sin(2 * np.pi * mod * t / RATE)) * np.sin(2 * np.pi * 440 * t / RATE)
+
+    orig, rec = _shifted(am_tone, 20 * RATE, lag, noise, 0)
+    full = correlate((orig - orig.mean()) / (orig.std() * len(orig)), (rec - rec.mean()) / rec.std(), method='fft')
+    found, peak_corr = AudioEvaluator._find_lag(orig, rec)
+    assert found == int(np.argmax(full)) - (len(rec) - 1)
+    assert peak_corr == pytest.approx(full.max())
+
+
+def _write_wav(path, frames: np.ndarray):
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(frames.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(RATE)
+        f.writeframes(frames.astype('<i2').tobytes())
+
+
+@pytest.mark.parametrize('lag', [700, -1500])
+def test_evaluate_stream_matches_evaluate(tmp_path, lag):
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal((10 * RATE, 2)) * 3000
+    orig = signal[2000:-2000]
+    # recorded frame i is original frame i + lag
+    rec = signal[2000 + lag:len(signal) - 2000 + lag] + rng.standard_normal((len(orig), 2)) * 300
+    _write_wav(tmp_path / 'orig.wav', orig)
+    _write_wav(tmp_path / 'rec.wav', rec)
+
+    streamed = AudioEvaluator.evaluate_stream(str(tmp_path / 'orig.wav'), str(tmp_path / 'rec.wav'),
+                                              block_sec=1.0, align_sec=2.0)
+    expected = AudioEvaluator.evaluate(AudioData.from_file(str(tmp_path / 'orig.wav')),
+                                       AudioData.from_file(str(tmp_path / 'rec.wav')))
+    for ch in range(2):
+        result, reference = streamed[f'channel_{ch}'], expected[f'channel_{ch}']
+        assert result['lag_samples'] == reference['lag_samples'] == lag
+        assert result['mean_squared_error'] == pytest.approx(reference['mean_squared_error'])
+        assert result['average_spectral_coherence'] == pytest.approx(reference['average_spectral_coherence'],
+                                                                     abs=0.01)
+        # one entry per block of the aligned overlap
+        assert [block['start_sec'] for block in result['blocks']] == list(range(len(result['blocks'])))
+        assert len(result['blocks']) == int(np.ceil((len(orig) - abs(lag)) / RATE))
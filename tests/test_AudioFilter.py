@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from scipy.signal import butter, sosfilt
+from lib.AudioData import AudioData
+from lib.AudioFilter import AudioFilter, AudioNoise, FilterStream
+
+CHAINS = [
+    [(AudioNoise.clipping, {'multiple': 2.0}), (AudioNoise.dc_offset, {'offset': -20000})],
+    [(AudioNoise.dc_offset, {'offset': 20000}), (AudioNoise.clipping, {'multiple': 0.5})],
+    [(AudioNoise.clipping, {'multiple': 3.0}), (AudioNoise.pop_noise, {'target_sec': 0.01}),
+     (AudioNoise.dc_offset, {'offset': -30000})],
+]
+
+
+def _sine(frames: int = 4800, rate: int = 48000):
+    t = np.arange(frames) / rate
+    tone = np.round(30000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    return np.stack([tone, -tone], axis=1)
+
+
+def _run(chain, defer: bool, block_frames: int = None):
+    audio = AudioData(_sine(), 48000, sample_width=2, channels=2)
+    if defer:
+        audio.defer()
+    for func, kwargs in chain:
+        audio.apply(func, **kwargs)
+    return audio.materialize(block_frames).frames
+
+
+@pytest.mark.parametrize('chain', CHAINS)
+@pytest.mark.parametrize('block_frames', [None, 1000])
+def test_deferred_chain_matches_eager(chain, block_frames):
+    eager = _run(chain, defer=False)
+    deferred = _run(chain, defer=True, block_frames=block_frames)
+    assert np.array_equal(deferred, eager)
+
+
+def test_clipping_saturates_before_offset():
+    frames = _run(CHAINS[0], defer=True)
+    assert frames.max() == 32767 - 20000
+
+
+def test_overlapping_cuts_keep_every_uncut_frame():
+    frames = np.arange(1, 101, dtype=np.int16).reshape(-1, 1)
+    audio = AudioData(frames, 100, sample_width=2, channels=1)
+    # 10-frame cuts at frames 20 and 25 overlap and remove frames 20..34 only
+    cut = audio.apply(AudioNoise.cut_noise, target_sec=[0.2, 0.25], noise_duration_samples=10).frames[:, 0]
+    expected = np.concatenate([np.arange(1, 21), np.arange(36, 101), np.zeros(15)])
+    assert np.array_equal(cut, expected)
+
+
+@pytest.mark.parametrize('target_sec', [0.97, 0.99, 1.5])
+def test_cut_at_the_end_zeroes_the_last_frames(target_sec):
+    frames = np.arange(1, 101, dtype=np.int16).reshape(-1, 1)
+    audio = AudioData(frames, 100, sample_width=2, channels=1)
+    # a 5-frame cut starting in or past the last 5 frames zeroes exactly those, as a cut in the middle would
+    cut = audio.apply(AudioNoise.cut_noise, target_sec=target_sec, noise_duration_samples=5).frames[:, 0]
+    expected = np.concatenate([np.arange(1, 96), np.zeros(5)])
+    assert np.array_equal(cut, expected)
+
+
+def test_filter_runs_every_channel_like_a_single_channel_design():
+    rng = np.random.default_rng(0)
+    frames = rng.integers(-10000, 10000, size=(4800, 3)).astype(np.int16)
+    audio = AudioData(frames, 48000, sample_width=2, channels=3)
+    filtered = audio.apply(AudioFilter.band_stop_filter, low_cutoff=1000, high_cutoff=3000).frames
+    sos = butter(4, [1000 / 24000, 3000 / 24000], btype='bandstop', output='sos')
+    for ch in range(3):
+        expected = np.clip(sosfilt(sos, frames[:, ch].astype(np.float64)), -32768, 32767).astype(np.int16)
+        assert np.array_equal(filtered[:, ch], expected)
+
+
+@pytest.mark.parametrize('zero_phase', [False, True])
+def test_band_pass_keeps_the_passband_gain(zero_phase):
+    rate = 48000
+    # the geometric center of a 100-500 Hz band-pass
+    tone = 20000 * np.sin(2 * np.pi * np.sqrt(100 * 500) * np.arange(2 * rate) / rate)
+    audio = AudioData(np.round(tone).astype(np.int16)[:, None], rate, sample_width=2, channels=1)
+    filtered = audio.apply(AudioFilter.band_pass_filter, low_cutoff=100, high_cutoff=500,
+                           zero_phase=zero_phase).frames[rate // 2:-rate // 2, 0]
+    gain = np.sqrt(np.mean(filtered.astype(np.float64) ** 2) / np.mean(tone[rate // 2:-rate // 2] ** 2))
+    assert gain == pytest.approx(1.0, abs=2e-3 if zero_phase else 1e-3)
+
+
+def test_filter_stream_blocks_match_whole_signal():
+    rng = np.random.default_rng(1)
+    signal = rng.standard_normal((10000, 2))
+    stream = FilterStream('high', 200, 48000, 2)
+    blocks = [stream.process(signal[lo:lo + 777]) for lo in range(0, len(signal), 777)]
+    sos = butter(4, 200 / 24000, btype='high', output='sos')
+    np.testing.assert_allclose(np.concatenate(blocks), sosfilt(sos, signal, axis=0), atol=1e-12)
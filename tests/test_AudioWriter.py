@@ -0,0 +1,36 @@
+import os
+import numpy as np
+from lib.AudioData import AudioData
+from lib.AudioWriter import AudioWriter
+
+
+def test_round_trip_over_4gib(tmp_path):
+    path = str(tmp_path / 'large.wav')
+    rng = np.random.default_rng(0)
+    head = rng.integers(-2 ** 15, 2 ** 15, size=(1000, 2)).astype(np.int16)
+    tail = rng.integers(-2 ** 15, 2 ** 15, size=(1000, 2)).astype(np.int16)
+    # 5 GiB of silence between them, left as a hole in a sparse file instead of being written
+    gap = 5 * 2 ** 30 // 4
+    with AudioWriter(path, 48000, 2, 2) as writer:
+        writer.write(head)
+        writer._file.seek(gap * 4, os.SEEK_CUR)
+        writer.n_frames += gap
+        writer.write(tail)
+
+    audio = AudioData.from_wav(path)
+    assert audio.n_frames == len(head) + gap + len(tail)
+    assert np.array_equal(audio.frames[:len(head)], head)
+    assert np.array_equal(audio.frames[-len(tail):], tail)
+
+
+def test_round_trip_formats(tmp_path):
+    rng = np.random.default_rng(1)
+    for width, dtype in ((1, np.int8), (2, np.int16), (3, np.int32), (4, np.int32)):
+        full = 2 ** (width * 8 - 1) - 1
+        frames = rng.integers(-full, full, size=(1001, 3)).astype(dtype)
+        path = str(tmp_path / f'{width}.wav')
+        AudioData(frames, 44100, width, 3).save(path)
+        assert np.array_equal(AudioData.from_wav(path).frames, frames)
+    frames = rng.standard_normal((500, 2)).astype(np.float32)
+    AudioData(frames, 48000, 4, 2).save(str(tmp_path / 'float.wav'))
+    assert np.array_equal(AudioData.from_wav(str(tmp_path / 'float.wav')).frames, frames)
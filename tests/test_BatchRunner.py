@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+import numpy as np
+import pytest
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.BatchRunner import BatchRunner
+
+RATE = 8000
+
+
+def test_jsonl_results_are_strict_json():
+    result = {'id': 'pair', 'status': 'ok', 'results': {'channel_0': {'snr_db': float('inf'), 'lag_samples': 3}}}
+    out = io.StringIO()
+    BatchRunner._write_result(None, out, False, result)
+
+    def reject(constant):
+        raise ValueError(f"not JSON: {constant}")
+    line = json.loads(out.getvalue(), parse_constant=reject)
+    assert line['results']['channel_0'] == {'snr_db': None, 'lag_samples': 3}
+
+
+def _pair_files(tmp_path, lag: int):
+    rng = np.random.default_rng(lag)
+    signal = rng.standard_normal((RATE + 2000, 2)) * 3000
+    AudioData(signal[1000:-1000].astype(np.int16), RATE, 2, 2).save(str(tmp_path / f'in{lag}.wav'))
+    rec = signal[1000 + lag:len(signal) - 1000 + lag] + rng.standard_normal((RATE, 2)) * 300
+    AudioData(rec.astype(np.int16), RATE, 2, 2).save(str(tmp_path / f'out{lag}.wav'))
+    return f'in{lag}.wav', f'out{lag}.wav'
+
+
+def test_run_reports_failed_pairs_and_matches_evaluate(tmp_path, monkeypatch):
+    monkeypatch.setenv('KAST_CACHE_DIR', str(tmp_path / 'cache'))
+    good = _pair_files(tmp_path, 250)
+    AudioData(np.zeros((RATE, 1), dtype=np.int16), RATE, 2, 1).save(str(tmp_path / 'mono.wav'))
+    manifest = tmp_path / 'pairs.jsonl'
+    manifest.write_text('\n'.join(json.dumps(row) for row in [
+        {'id': 'missing', 'input': good[0], 'output': 'nothing.wav'},
+        {'id': 'good', 'input': good[0], 'output': good[1]},
+        {'id': 'mono', 'input': good[0], 'output': 'mono.wav'},
+    ]) + '\n')
+
+    result_path = str(tmp_path / 'results.jsonl')
+    # a failing pair does not stop the others
+    assert BatchRunner.run(str(manifest), result_path, workers=2) == (1, 2)
+    results = {row['id']: row for row in map(json.loads, open(result_path))}
+    assert results['missing']['status'] == results['mono']['status'] == 'error'
+    assert 'channels' in results['mono']['error']
+    expected = AudioEvaluator.evaluate(AudioData.from_file(str(tmp_path / good[0])),
+                                       AudioData.from_file(str(tmp_path / good[1])))
+    assert results['good']['status'] == 'ok' and not results['good']['cached']
+    for ch in range(2):
+        metrics = results['good']['results'][f'channel_{ch}']
+        assert metrics['lag_samples'] == expected[f'channel_{ch}']['lag_samples'] == 250
+        assert metrics['mean_squared_error'] == pytest.approx(expected[f'channel_{ch}']['mean_squared_error'])
+
+    # the second run takes the good pair from the cache
+    assert BatchRunner.run(str(manifest), result_path, workers=2) == (1, 2)
+    rerun = {row['id']: row for row in map(json.loads, open(result_path))}
+    assert rerun['good']['cached'] and rerun['good']['results'] == results['good']['results']
+
+    # CSV has one row per channel
+    csv_path = str(tmp_path / 'results.csv')
+    assert BatchRunner.run(str(manifest), csv_path, workers=2) == (1, 2)
+    rows = list(csv.DictReader(open(csv_path)))
+    assert [(row['id'], row['channel'], row['status']) for row in rows if row['id'] == 'good'] == \
+        [('good', '0', 'ok'), ('good', '1', 'ok')]
+    assert float(rows[[row['id'] for row in rows].index('good')]['lag_samples']) == 250
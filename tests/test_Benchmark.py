@@ -0,0 +1,30 @@
+import json
+import pytest
+from lib.Benchmark import Benchmark
+
+
+def test_run_times_every_stage_of_the_matrix():
+    report = Benchmark.run(durations=(0.2,), widths=(2, 4), stages=['load', 'align', 'evaluate'],
+                           repeat=2, warmup=0)
+    entries = [(entry['stage'], entry['width']) for entry in report['results']]
+    assert sorted(entries) == sorted((stage, width) for stage in ('load', 'align', 'evaluate') for width in (2, 4))
+    for entry in report['results']:
+        assert entry['repeat'] == 2 and 0 < entry['min_sec'] <= entry['median_sec']
+        assert entry['peak_mem_bytes'] >= 0
+    with pytest.raises(ValueError):
+        Benchmark.run(stages=['nothing'])
+
+
+def test_compare_flags_only_relevant_slowdowns(tmp_path):
+    def entry(stage, median_sec):
+        return {'stage': stage, 'duration': 1, 'channels': 2, 'width': 2, 'rate': 48000, 'median_sec': median_sec}
+    baseline = {'meta': {}, 'results': [entry('align', 0.100), entry('load', 0.0001), entry('plot', 0.5)]}
+    path = str(tmp_path / 'baseline.json')
+    Benchmark.save(baseline, path)
+    assert json.load(open(path)) == baseline
+
+    report = {'results': [entry('align', 0.130), entry('load', 0.0005), entry('plot', 0.55), entry('events', 1.0)]}
+    # align is 30% slower; load is 5x slower but by less than min_delta_sec; events has no baseline
+    regressions = Benchmark.compare(report, path, threshold=0.2, min_delta_sec=0.001)
+    assert [(r['stage'], r['baseline_median_sec']) for r in regressions] == [('align', 0.100)]
+    assert regressions[0]['ratio'] == pytest.approx(1.3)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from scipy.interpolate import CubicSpline
+from scipy.signal import firwin, lfilter
+from lib.AudioEvaluator import AudioEvaluator
+from lib.DriftTracker import DriftTracker, RESAMPLE_TAPS
+
+RATE = 8000
+PPM = 300
+LAG = 700
+
+
+@pytest.fixture(scope='module')
+def drifting():
+    n_frames = 300 * RATE
+    rng = np.random.default_rng(0)
+    orig = lfilter(firwin(255, 0.1), 1.0, rng.standard_normal(n_frames + 2000))
+    # a louder middle puts the lag of the whole recording there, ~360 samples from either end
+    orig[len(orig) // 3:2 * len(orig) // 3] *= 4
+    # recorded frame i is original frame LAG + (1 + PPM / 1e6) * i
+    rec = CubicSpline(np.arange(len(orig)), orig)(LAG + (1 + PPM * 1e-6) * np.arange(n_frames - 2000))
+    return orig, rec
+
+
+def test_track_follows_drift_beyond_the_search_window(drifting):
+    orig, rec = drifting
+    track = DriftTracker.track(orig, rec, RATE)
+    # every segment is tracked, including the early and late ones far from the initial lag
+    assert len(track['curve']) == len(rec) // DriftTracker.SEGMENT
+    assert track['drift_ppm'] == pytest.approx(PPM, abs=0.5)
+    assert track['lag'] == pytest.approx(LAG, abs=0.5)
+
+
+def test_compensation_improves_coherence(drifting):
+    orig, rec = drifting
+    compensated = AudioEvaluator.analyze_channel(orig, rec, RATE, drift=True)[0]
+    constant = AudioEvaluator.analyze_channel(orig, rec, RATE)[0]
+    assert compensated['average_spectral_coherence'] > 0.95
+    assert compensated['average_spectral_coherence'] > constant['average_spectral_coherence'] + 0.3
+    assert compensated['snr_db'] > constant['snr_db'] + 30
+
+
+def test_resample_matches_sine():
+    frequency = 0.2
+    signal = np.sin(2 * np.pi * frequency * np.arange(4000))
+    rng = np.random.default_rng(1)
+    positions = np.sort(rng.uniform(RESAMPLE_TAPS, len(signal) - RESAMPLE_TAPS, 1000))
+    resampled = DriftTracker.resample(signal, positions)
+    np.testing.assert_allclose(resampled, np.sin(2 * np.pi * frequency * positions), atol=1e-3)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from scipy.signal import firwin, lfilter
+from lib.AudioData import AudioData
+from lib.EventDetector import EventDetector
+
+RATE = 48000
+FULL_SCALE = 2 ** 15 - 1
+LAG = 300
+# the recording is driven into clipping between these times
+CLIP_SEC = (6.0, 6.1)
+
+
+def _recording(defects: bool):
+    rng = np.random.default_rng(0)
+    signal = lfilter(firwin(101, 0.2), 1.0, rng.standard_normal(12 * RATE + LAG))
+    signal *= 6000 / np.std(signal)
+    # recorded frame i is original frame i + LAG
+    rec = signal[LAG:].copy()
+    if defects:
+        rec[2 * RATE] += 15000                               # pop
+        rec[4 * RATE:4 * RATE + 2400] = 0                    # 50 ms dropout
+        # gain of 6 with 20 ms ramps, saturating at full scale
+        ramp = np.hanning(1920)
+        gain = np.ones(len(rec))
+        lo, hi = int(CLIP_SEC[0] * RATE), int(CLIP_SEC[1] * RATE)
+        gain[lo - 960:hi + 960] += 5 * np.concatenate((ramp[:960], np.ones(hi - lo), ramp[960:]))
+        rec = np.clip(rec * gain, -FULL_SCALE, FULL_SCALE)
+        rec[8 * RATE:10 * RATE] += 3000                      # DC step, back at 10 s
+        # cut: 480 frames missing at 11 s, the recording runs ahead of the original from there
+        rec[11 * RATE:-480] = rec[11 * RATE + 480:]
+    return (AudioData(np.round(signal).astype(np.int16)[:, None], RATE, sample_width=2, channels=1),
+            AudioData(np.round(rec).astype(np.int16)[:, None], RATE, sample_width=2, channels=1))
+
+
+def test_detects_every_injected_defect():
+    original, recorded = _recording(defects=True)
+    events = EventDetector.detect(original, recorded, max_lag=1000)
+    others = [event for event in events if event['type'] != 'clipping']
+    assert [(event['type'], round(event['start_sec'], 2)) for event in others] == \
+        [('pop', 2.0), ('dropout', 4.0), ('dc_step', 8.0), ('dc_step', 10.0), ('cut', 11.0)]
+    assert all(event['lag_samples'] == LAG and event['channel'] == 0 for event in events)
+    dropout = others[1]
+    assert dropout['end_sec'] - dropout['start_sec'] == pytest.approx(0.05, abs=2 / RATE)
+
+    # clipping runs (split where the signal crosses zero) cover the samples at full scale,
+    # but for runs shorter than CLIP_MIN_SAMPLES
+    clipping = [event for event in events if event['type'] == 'clipping']
+    assert clipping and all(CLIP_SEC[0] - 0.02 <= event['start_sec'] < CLIP_SEC[1] + 0.02 for event in clipping)
+    clipped = np.count_nonzero(np.abs(recorded.frames[:, 0]) >= FULL_SCALE * (1 - EventDetector.CLIP_TOLERANCE))
+    assert sum(event['severity'] for event in clipping) == pytest.approx(clipped, rel=0.01)
+
+
+def test_clean_copy_has_no_events():
+    assert EventDetector.detect(*_recording(defects=False), max_lag=1000) == []
+
+
+def test_chunk_borders_do_not_change_the_events(monkeypatch):
+    expected = EventDetector.detect(*_recording(defects=True), max_lag=1000)
+    # chunks much shorter than the defects, so chunk borders fall inside them
+    monkeypatch.setattr(EventDetector, 'CHUNK', 2 ** 12)
+    events = EventDetector.detect(*_recording(defects=True), max_lag=1000)
+    assert [dict(event, severity=None) for event in events] == [dict(event, severity=None) for event in expected]
+    assert [event['severity'] for event in events] == pytest.approx([event['severity'] for event in expected])
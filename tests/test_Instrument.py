@@ -0,0 +1,59 @@
+import json
+import numpy as np
+import pytest
+from lib.Instrument import Instrument, _NULL_SPAN
+
+
+class _ListSink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record: dict):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def closed():
+    yield
+    Instrument.close()
+
+
+def test_disabled_spans_are_shared_no_ops():
+    assert not Instrument.enabled()
+    with Instrument.span('load', nbytes=10) as span:
+        span.set(path='x')
+    assert span is _NULL_SPAN
+
+
+def test_nested_spans_record_depth_attributes_and_peak_memory():
+    sink = _ListSink()
+    Instrument.configure([sink], track_memory=True)
+    with Instrument.span('evaluate', nbytes=100, channels=2):
+        with Instrument.span('evaluate.channel') as span:
+            block = np.ones(2 ** 20)
+            span.set(nbytes=block.nbytes, ch=0)
+            del block
+    inner, outer = sink.records
+    assert (inner['name'], inner['depth'], inner['bytes']) == ('evaluate.channel', 1, 2 ** 23)
+    assert (outer['name'], outer['depth'], outer['bytes']) == ('evaluate', 0, 100)
+    assert inner['attrs'] == {'ch': 0} and outer['attrs'] == {'channels': 2}
+    assert 0 <= inner['wall_sec'] <= outer['wall_sec']
+    # the inner allocation counts towards the peak of the enclosing span too
+    assert inner['peak_bytes'] >= 2 ** 23 and outer['peak_bytes'] >= inner['peak_bytes']
+
+
+def test_file_sinks(tmp_path):
+    jsonl, trace = str(tmp_path / 'spans.jsonl'), str(tmp_path / 'trace.json')
+    Instrument.configure([Instrument.sink_for(jsonl), Instrument.sink_for(trace)])
+    for name in ('load', 'plot.render'):
+        with Instrument.span(name, nbytes=8, path='a.wav'):
+            pass
+    Instrument.close()
+    assert [json.loads(line)['name'] for line in open(jsonl)] == ['load', 'plot.render']
+    events = json.load(open(trace))['traceEvents']
+    assert [(event['name'], event['cat'], event['ph']) for event in events] == \
+        [('load', 'load', 'X'), ('plot.render', 'plot', 'X')]
+    assert events[0]['args']['path'] == 'a.wav' and events[0]['args']['bytes'] == 8
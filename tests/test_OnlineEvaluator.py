@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from lib.AudioData import AudioData
+from lib.OnlineEvaluator import OnlineEvaluator, _RingBuffer, _RunningStats
+
+RATE = 8000
+
+
+def test_ring_buffer_wraps_around():
+    ring = _RingBuffer(10, 2)
+    rng = np.random.default_rng(0)
+    expected = np.empty((0, 2))
+    for _ in range(200):
+        frames = rng.standard_normal((int(rng.integers(0, ring.free + 1)), 2))
+        ring.write(frames)
+        expected = np.concatenate((expected, frames))
+        n = int(rng.integers(0, ring.size + 1))
+        np.testing.assert_array_equal(ring.peek(n), expected[:n])
+        ring.consume(n)
+        expected = expected[n:]
+        assert ring.size == len(expected)
+    with pytest.raises(ValueError):
+        ring.write(np.zeros((ring.free + 1, 2)))
+
+
+def test_merged_stats_match_concatenated_blocks():
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((5000, 2)) * [1.0, 3.0] + [0.5, -2.0]
+    y = 0.8 * x + rng.standard_normal((5000, 2))
+    stats = _RunningStats(2)
+    for lo, hi in zip([0, 1, 700, 701, 3000], [1, 700, 701, 3000, 5000]):
+        stats.merge(_RunningStats.of_block(x[lo:hi], y[lo:hi]))
+    assert stats.n == len(x)
+    np.testing.assert_allclose(stats.mean_x, np.mean(x, axis=0))
+    np.testing.assert_allclose(stats.m2_y / stats.n, np.var(y, axis=0))
+    np.testing.assert_allclose(stats.mse(), np.mean((x - y) ** 2, axis=0))
+    np.testing.assert_allclose(stats.correlation(), [np.corrcoef(x[:, ch], y[:, ch])[0, 1] for ch in range(2)])
+
+
+def test_online_metrics_match_the_aligned_signals():
+    lag = 123
+    rng = np.random.default_rng(2)
+    signal = rng.standard_normal((10 * RATE, 2)) * 3000
+    reference = AudioData(signal.astype(np.int16), RATE, sample_width=2, channels=2)
+    # recorded frame i is reference frame i + lag
+    recorded = reference.frames[lag:].astype(np.float64) + rng.standard_normal((10 * RATE - lag, 2)) * 300
+
+    totals = []
+    for block_frames in (RATE // 10, 777):
+        evaluator = OnlineEvaluator(reference, window_sec=2.0, block_sec=0.5, align_sec=1.0)
+        updates = []
+        for start in range(0, len(recorded), block_frames):
+            updates.extend(evaluator.push(recorded[start:start + block_frames]))
+        updates.extend(evaluator.flush())
+        assert evaluator.lag == lag
+        assert [update['time_sec'] for update in updates] == pytest.approx(np.arange(len(updates)) * 0.5)
+        totals.append(evaluator.metrics())
+
+    aligned = reference.frames[lag:].astype(np.float64)
+    for ch in range(2):
+        total = totals[0][f'channel_{ch}']
+        assert total['mean_squared_error'] == pytest.approx(np.mean((aligned[:, ch] - recorded[:, ch]) ** 2))
+        assert total['peak_cross_correlation'] == pytest.approx(np.corrcoef(aligned[:, ch], recorded[:, ch])[0, 1])
+        assert total['average_spectral_coherence'] > 0.95
+        # the block size of the pushes does not change the result
+        assert totals[1][f'channel_{ch}'] == pytest.approx(total)
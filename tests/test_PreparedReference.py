@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from lib.AudioData import AudioData
+from lib.AudioEvaluator import AudioEvaluator
+from lib.PreparedReference import PreparedReference
+
+RATE = 48000
+
+
+def _pair(lag: int, n_frames: int = 3 * RATE):
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal((n_frames + 4000, 2)) * 3000
+    signal[:, 1] += 8000 * np.sin(2 * np.pi * 1000 * np.arange(len(signal)) / RATE)
+    orig = signal[2000:2000 + n_frames]
+    # recorded frame i is original frame i + lag
+    rec = signal[2000 + lag:2000 + lag + n_frames] + rng.standard_normal((n_frames, 2)) * 300
+    return (AudioData(orig.astype(np.int16), RATE, sample_width=2, channels=2),
+            AudioData(rec.astype(np.int16), RATE, sample_width=2, channels=2))
+
+
+def test_reference_spectra_are_reused_for_any_lag(monkeypatch):
+    lags = [1000, -333, 0]
+    original = _pair(0)[0]
+    recordings = [_pair(lag)[1] for lag in lags]
+    reference = PreparedReference(original)
+
+    transformed = []
+    segment_spectra = AudioEvaluator._segment_spectra
+
+    def counted(data, nperseg):
+        transformed.append(len(data))
+        return segment_spectra(data, nperseg)
+    monkeypatch.setattr(AudioEvaluator, '_segment_spectra', staticmethod(counted))
+    results = reference.evaluate(recordings)
+    # only the recordings are transformed, the original segments come from the reference
+    assert len(transformed) == len(recordings) * original.channels
+    monkeypatch.undo()
+
+    for lag, recording, result in zip(lags, recordings, results):
+        expected = AudioEvaluator.evaluate(original, recording)
+        for ch in ('channel_0', 'channel_1'):
+            assert result[ch]['lag_samples'] == expected[ch]['lag_samples'] == lag
+            assert result[ch]['mean_squared_error'] == pytest.approx(expected[ch]['mean_squared_error'])
+            assert result[ch]['average_spectral_coherence'] == pytest.approx(
+                expected[ch]['average_spectral_coherence'], abs=0.01)
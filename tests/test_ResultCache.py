@@ -0,0 +1,56 @@
+import os
+import pytest
+import lib.ResultCache
+from lib.ResultCache import ResultCache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('KAST_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(ResultCache, 'max_bytes', 2 ** 30)
+    return tmp_path
+
+
+def _result_path(key: str):
+    return os.path.join(ResultCache.cache_dir(), 'entries', key, 'result.json')
+
+
+def test_evicts_least_recently_used():
+    keys = [ResultCache.key('test', [str(i)]) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        ResultCache.put(key, {'data': 'x' * 1000})
+        os.utime(_result_path(key), (1000 + i, 1000 + i))
+    # the oldest entry is read again, the second one becomes the least recently used
+    assert ResultCache.get(keys[0]) is not None
+    entry_size = os.path.getsize(_result_path(keys[0]))
+    ResultCache.max_bytes = 3 * entry_size
+    ResultCache.put(keys[3], {'data': 'x' * 1000})
+    assert [ResultCache.get(key) is not None for key in keys] == [True, False, True, True]
+
+
+def test_put_walks_the_cache_only_above_the_bound(monkeypatch):
+    walks = []
+    evict = ResultCache.evict
+    monkeypatch.setattr(ResultCache, 'evict', staticmethod(lambda *args: walks.append(args) or evict(*args)))
+    for i in range(50):
+        ResultCache.put(ResultCache.key('test', [str(i)]), {'data': i})
+    # only the first store, which has no size estimate yet
+    assert len(walks) == 1
+    ResultCache.max_bytes = 1
+    ResultCache.put(ResultCache.key('test', ['last']), {'data': 'last'})
+    assert len(walks) == 2
+    assert not os.listdir(os.path.join(ResultCache.cache_dir(), 'entries'))
+
+
+def test_key_changes_with_the_library_fingerprint(monkeypatch):
+    key = ResultCache.key('test', ['input'], {'param': 1})
+    ResultCache.put(key, {'value': 1})
+    with monkeypatch.context() as patch:
+        patch.setattr(lib.ResultCache, 'CACHE_VERSION', lib.ResultCache.CACHE_VERSION + 1)
+        ResultCache.fingerprint.cache_clear()
+        other = ResultCache.key('test', ['input'], {'param': 1})
+    ResultCache.fingerprint.cache_clear()
+    assert other != key
+    assert ResultCache.get(other) is None
+    assert ResultCache.key('test', ['input'], {'param': 1}) == key
+    assert ResultCache.get(key) == {'value': 1}
@@ -0,0 +1,79 @@
+import warnings
+import numpy as np
+import pytest
+from scipy.signal import coherence, lfilter
+from lib.AudioEvaluator import AudioEvaluator
+from lib.SpectralAnalysis import METRICS, OCTAVE_BANDS, SpectralAnalysis, metric
+
+
+def test_coherence_of_silent_recording_is_zero():
+    orig = np.sin(2 * np.pi * 440 * np.arange(8192) / 48000)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        metrics = SpectralAnalysis(orig, np.zeros_like(orig), 48000).metrics(['average_spectral_coherence'])
+    assert metrics['average_spectral_coherence'] == 0.0
+
+
+RATE = 48000
+
+
+def test_coherence_matches_scipy():
+    rng = np.random.default_rng(0)
+    orig = rng.standard_normal(5 * RATE)
+    rec = lfilter([1, 0.5], [1], orig) + rng.standard_normal(len(orig))
+    analysis = SpectralAnalysis(orig, rec, RATE)
+    _, expected = coherence(orig, rec, fs=RATE, nperseg=analysis.nperseg)
+    assert analysis.metrics(['average_spectral_coherence'])['average_spectral_coherence'] == \
+        pytest.approx(np.mean(expected), rel=1e-6)
+
+
+def test_metrics_of_known_signals():
+    t = np.arange(2 * RATE) / RATE
+    orig = 0.5 * np.sin(2 * np.pi * 1000 * t)
+    # 1% third harmonic, a DC offset of 0.01 and two samples at full scale
+    rec = orig + 0.005 * np.sin(2 * np.pi * 3000 * t) + 0.01
+    rec[[100, 200]] = 1.0
+    metrics = SpectralAnalysis(orig, rec, RATE, full_scale=1.0).metrics()
+    assert metrics['mean_squared_error'] == pytest.approx(np.mean((orig - rec) ** 2))
+    assert metrics['snr_db'] == pytest.approx(10 * np.log10(np.mean(orig ** 2) / np.mean((orig - rec) ** 2)))
+    assert metrics['thd_n_db'] == pytest.approx(-40, abs=0.5)
+    assert metrics['dc_offset'] == pytest.approx(np.mean(rec))
+    assert metrics['clipping_ratio'] == 2 / len(rec)
+    # the band of the tone is excited, the ones around it are not
+    assert metrics['band_response_db']['1000'] == pytest.approx(0, abs=0.1)
+    assert all(metrics['band_response_db'][band] is None for band in ('125', '500', '2000', '16000'))
+
+
+def test_band_response_of_a_gain():
+    rng = np.random.default_rng(1)
+    orig = rng.standard_normal(2 * RATE)
+    bands = SpectralAnalysis(orig, 0.5 * orig, RATE).metrics(['band_response_db'])['band_response_db']
+    assert bands.keys() == {f'{center:g}' for center in OCTAVE_BANDS}
+    for value in bands.values():
+        assert value == pytest.approx(-6.02, abs=0.01)
+
+
+def test_new_metric_reuses_the_shared_spectra(monkeypatch):
+    calls = []
+    segment_spectra = AudioEvaluator._segment_spectra
+
+    def counted(data, nperseg):
+        calls.append(len(data))
+        return segment_spectra(data, nperseg)
+    monkeypatch.setattr(AudioEvaluator, '_segment_spectra', staticmethod(counted))
+
+    def peak_rec_bin(analysis):
+        return int(np.argmax(analysis.product('rec_psd')))
+    # registering adds the metric to METRICS, monkeypatch removes it again
+    monkeypatch.setitem(METRICS, 'peak_rec_bin', None)
+    metric('rec_psd')(peak_rec_bin)
+
+    t = np.arange(RATE) / RATE
+    tone = np.sin(2 * np.pi * 1500 * t)
+    analysis = SpectralAnalysis(tone, tone, RATE)
+    metrics = analysis.metrics(SpectralAnalysis.DEFAULT_METRICS + ['peak_rec_bin'])
+    assert analysis.freqs[metrics['peak_rec_bin']] == pytest.approx(1500, abs=RATE / analysis.nperseg)
+    # one FFT pass per signal for all metrics
+    assert len(calls) == 2
+    with pytest.raises(ValueError):
+        analysis.metrics(['nothing'])
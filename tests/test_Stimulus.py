@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+from lib.AudioData import AudioData
+from lib.Stimulus import Stimulus
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('KAST_CACHE_DIR', str(tmp_path / 'cache'))
+    return Stimulus.cache_dir()
+
+
+def test_multi_sine_matches_direct_synthesis():
+    freqs = [50, 997, 15000]
+    n_frames = 2 * Stimulus.BLOCK + 1234
+    audio = Stimulus.generate('multi_sine', n_frames / 48000, rate=48000, width=2, channels=2, cache=False,
+                              freqs=freqs)
+    t = np.arange(n_frames)[:, None] / 48000
+    expected = np.sin(2 * np.pi * np.array(freqs) * t).mean(axis=1) * (2 ** 15 - 1) * 0.9
+    # the rotated float32 tables stay within one quantization step (plus float32 rounding) across block borders
+    assert np.max(np.abs(audio.frames[:, 0] - expected)) <= 1.01
+    assert np.array_equal(audio.frames[:, 0], audio.frames[:, 1])
+
+
+def test_cached_stimulus_is_loaded_instead_of_synthesized(cache_dir, monkeypatch):
+    first = Stimulus.generate('pink_noise', 0.5, width=2, seed=3)
+    assert len(os.listdir(cache_dir)) == 1
+
+    def fail(*args):
+        raise AssertionError("synthesized again")
+    monkeypatch.setattr(Stimulus, '_blocks', staticmethod(fail))
+    second = Stimulus.generate('pink_noise', 0.5, width=2, seed=3)
+    assert not second.frames.flags.writeable
+    assert np.array_equal(first.frames, second.frames)
+
+
+def test_noise_without_seed_is_not_cached(cache_dir):
+    first = Stimulus.generate('white_noise', 0.1, width=2)
+    second = Stimulus.generate('white_noise', 0.1, width=2)
+    assert not os.path.isdir(cache_dir) or not os.listdir(cache_dir)
+    assert not np.array_equal(first.frames, second.frames)
+
+
+@pytest.mark.parametrize('kind, params', [('chirp', {'f0': 100, 'f1': 8000}), ('mls', {'nbits': 10})])
+def test_written_stimulus_matches_generated(tmp_path, kind, params):
+    path = str(tmp_path / f'{kind}.wav')
+    n_frames = Stimulus.write(path, kind, 1.5, rate=44100, width=3, channels=2, **params)
+    generated = Stimulus.generate(kind, 1.5, rate=44100, width=3, channels=2, **params)
+    written = AudioData.from_wav(path)
+    assert written.n_frames == n_frames == generated.n_frames
+    assert np.array_equal(written.frames, generated.frames)
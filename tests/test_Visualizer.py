@@ -0,0 +1,43 @@
+import numpy as np
+from scipy import signal
+from lib.AudioData import AudioData
+from lib.Visualizer import Visualizer
+
+
+def test_envelope_keeps_the_extremes_of_every_column():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal(100003)
+    index, values = Visualizer._envelope(data, 1000)
+    assert len(index) == len(values) == 2000
+    edges = index[::2]
+    assert edges[0] == 0 and np.all(np.diff(edges) > 0)
+    for col in (0, 1, 500, 999):
+        stop = edges[col + 1] if col + 1 < len(edges) else len(data)
+        assert values[2 * col] == data[edges[col]:stop].min()
+        assert values[2 * col + 1] == data[edges[col]:stop].max()
+    # short signals are drawn sample by sample
+    index, values = Visualizer._envelope(data[:1500], 1000)
+    assert np.array_equal(values, data[:1500])
+
+
+def test_spectrogram_matches_scipy_and_caps_the_frames():
+    rng = np.random.default_rng(1)
+    frames = rng.standard_normal((20000, 2))
+    f, t, Sxx = Visualizer._spectrogram(frames, 48000, n_cols=1000)
+    f_ref, t_ref, Sxx_ref = signal.spectrogram(frames, 48000, nperseg=Visualizer.NPERSEG, axis=0)
+    np.testing.assert_allclose(f, f_ref)
+    np.testing.assert_allclose(t, t_ref)
+    # scipy puts the channels between frequencies and times
+    np.testing.assert_allclose(Sxx, Sxx_ref.transpose(1, 0, 2), rtol=1e-4, atol=1e-12)
+    # a long signal gets a larger hop instead of more frames
+    f, t, Sxx = Visualizer._spectrogram(rng.standard_normal((10 ** 6, 1)), 48000, n_cols=500)
+    assert Sxx.shape == (1, Visualizer.NPERSEG // 2 + 1, len(t)) and len(t) <= 500
+
+
+def test_plot_audio_data_writes_a_png(tmp_path):
+    rng = np.random.default_rng(2)
+    frames = rng.integers(-10000, 10000, size=(10 * 48000, 2)).astype(np.int16)
+    audio = AudioData(frames, 48000, sample_width=2, channels=2)
+    path = tmp_path / 'plot.png'
+    Visualizer.plot_audio_data(str(path), audio, audio, start_sec=1.0, end_sec=9.0)
+    assert path.read_bytes()[:8] == b'\x89PNG\r\n\x1a\n'
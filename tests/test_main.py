@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import main
+
+
+def _strict(text: str):
+    def reject(constant):
+        raise ValueError(f"not JSON: {constant}")
+    return json.loads(text, parse_constant=reject)
+
+
+def test_print_json_writes_non_finite_values_as_null(capsys):
+    main.print_json({'snr_db': float('inf'), 'thd_n_db': -np.inf, 'bands': [np.float64('nan'), np.float32(1.5)]})
+    assert _strict(capsys.readouterr().out) == {'snr_db': None, 'thd_n_db': None, 'bands': [None, 1.5]}
+
+
+def test_startup_imports_no_numpy():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print(sorted(m for m in ('numpy', 'scipy', 'matplotlib') if m in sys.modules))"
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'